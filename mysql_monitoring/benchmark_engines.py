@@ -0,0 +1,192 @@
+"""
+Benchmark the 'threads' and 'asyncio' collection engines of mysql_metrics_exporter
+against simulated MySQL targets.
+
+Each (engine, target count) combination runs in its own Python process so memory
+numbers do not leak between runs. Simulated targets answer SHOW GLOBAL STATUS,
+SHOW GLOBAL VARIABLES and SHOW SLAVE STATUS after a fixed network latency, so
+no MySQL server is needed.
+
+Usage:
+    python benchmark_engines.py [--targets 10 100 1000] [--duration 15] [--latency 0.002]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+from prometheus_client import generate_latest
+
+import mysql_metrics_exporter as exporter
+
+# A realistic SHOW GLOBAL STATUS result: ~150 Com_% variables plus ~300 others
+SIMULATED_STATUS = [{'Variable_name': f'Com_command_{i}', 'Value': str(i)} for i in range(150)]
+SIMULATED_STATUS += [{'Variable_name': f'Status_variable_{i}', 'Value': str(i * 7)} for i in range(300)]
+SIMULATED_STATUS += [{'Variable_name': 'Uptime', 'Value': '1000'}, {'Variable_name': 'Queries', 'Value': '5000'}]
+SIMULATED_VARIABLES = [{'Variable_name': 'max_connections', 'Value': '151'}, {'Variable_name': 'version', 'Value': '8.0.36'}]
+
+pass_started = {}
+pass_latencies = []
+
+def simulated_rows(statement, instance):
+    if statement.startswith('SHOW GLOBAL STATUS'):
+        pass_started[instance] = time.perf_counter()
+        return SIMULATED_STATUS
+    if statement.startswith('SHOW GLOBAL VARIABLES'):
+        return SIMULATED_VARIABLES
+    return []
+
+class SimulatedCursor:
+    def __init__(self, instance, latency):
+        self.instance = instance
+        self.latency = latency
+        self.rows = []
+        self.with_rows = True
+
+    def execute(self, statement, params=None):
+        time.sleep(self.latency)
+        self.rows = simulated_rows(statement, self.instance)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class SimulatedConnection:
+    def __init__(self, instance, latency):
+        self.instance = instance
+        self.latency = latency
+
+    def cursor(self, dictionary=True):
+        return SimulatedCursor(self.instance, self.latency)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+class SimulatedAsyncCursor(SimulatedCursor):
+    async def execute(self, statement, params=None):
+        await asyncio.sleep(self.latency)
+        self.rows = simulated_rows(statement, self.instance)
+
+    async def fetchall(self):
+        return self.rows
+
+    async def close(self):
+        pass
+
+class SimulatedAsyncConnection(SimulatedConnection):
+    async def cursor(self, dictionary=True):
+        return SimulatedAsyncCursor(self.instance, self.latency)
+
+    async def ping(self, reconnect=False):
+        pass
+
+    async def close(self):
+        pass
+
+def instrument(latency):
+    """
+    Points the exporter at simulated targets and records the latency of every collection pass.
+    """
+    import mysql.connector.aio
+
+    def connect(**kwargs):
+        return SimulatedConnection(f"sim{kwargs['port']}", latency)
+
+    async def connect_async(**kwargs):
+        return SimulatedAsyncConnection(f"sim{kwargs['port']}", latency)
+
+    exporter.mysql.connector.connect = connect
+    mysql.connector.aio.connect = connect_async
+
+    update_mysql_metrics = exporter.update_mysql_metrics
+
+    def timed_update(instance, status, variables, slave_status):
+        update_mysql_metrics(instance, status, variables, slave_status)
+        pass_latencies.append(time.perf_counter() - pass_started[instance])
+
+    exporter.update_mysql_metrics = timed_update
+
+def run_child(engine, targets, duration, latency):
+    instrument(latency)
+    servers = [
+        {'instance': f'sim{port}', 'host': '127.0.0.1', 'port': port, 'user': 'root',
+         'password': '', 'database': 'replicated_db', 'data_dir': ''}
+        for port in range(20000, 20000 + targets)
+    ]
+    process = psutil.Process()
+    baseline_rss = process.memory_info().rss
+
+    # Measure /metrics rendering while the engine is busy collecting
+    scrape_latencies = []
+
+    def scrape():
+        while True:
+            started = time.perf_counter()
+            generate_latest()
+            scrape_latencies.append(time.perf_counter() - started)
+            time.sleep(1)
+
+    if engine == 'threads':
+        for server in servers:
+            threading.Thread(target=exporter.collect_mysql_metrics, args=(server,), daemon=True).start()
+        threading.Thread(target=scrape, daemon=True).start()
+        time.sleep(duration)
+    else:
+        async def main():
+            semaphore = asyncio.Semaphore(exporter.ASYNC_MAX_CONCURRENCY)
+            tasks = [asyncio.ensure_future(exporter.collect_mysql_metrics_async(server, semaphore)) for server in servers]
+            threading.Thread(target=scrape, daemon=True).start()
+            await asyncio.sleep(duration)
+            for task in tasks:
+                task.cancel()
+        asyncio.run(main())
+
+    latencies = sorted(pass_latencies)
+    print(json.dumps({
+        'engine': engine,
+        'targets': targets,
+        'threads': threading.active_count(),
+        'rss_mb': (process.memory_info().rss - baseline_rss) / 2 ** 20,
+        'passes': len(latencies),
+        'pass_p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+        'pass_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        'scrape_p50_ms': statistics.median(scrape_latencies) * 1000 if scrape_latencies else None,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=15, help='seconds to run each combination')
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated per-query latency in seconds')
+    parser.add_argument('--child', nargs=2, metavar=('ENGINE', 'TARGETS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], int(args.child[1]), args.duration, args.latency)
+        return
+
+    print(f"{'engine':<8} {'targets':>7} {'threads':>7} {'rss MB':>8} {'passes/s':>9} {'pass p50 ms':>11} {'pass p99 ms':>11} {'scrape p50 ms':>13}")
+    for targets in args.targets:
+        for engine in ('threads', 'asyncio'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--child', engine, str(targets),
+                 '--duration', str(args.duration), '--latency', str(args.latency)],
+                capture_output=True, text=True, check=True
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(f"{r['engine']:<8} {r['targets']:>7} {r['threads']:>7} {r['rss_mb']:>8.1f} "
+                  f"{r['passes'] / args.duration:>9.0f} {r['pass_p50_ms'] or 0:>11.1f} "
+                  f"{r['pass_p99_ms'] or 0:>11.1f} {r['scrape_p50_ms'] or 0:>13.1f}")
+
+if __name__ == '__main__':
+    main()
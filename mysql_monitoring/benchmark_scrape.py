@@ -0,0 +1,120 @@
+"""
+Benchmark /metrics under concurrent scrapers, with the exposition rendered on every
+scrape ('live') and served from the pre-rendered gzip buffer ('cached').
+
+Each (mode, target count) combination runs the exporter in its own process against
+simulated MySQL targets (see benchmark_engines.py) and hits it with --scrapers
+concurrent scrapers from this process. The exporter's CPU time per scrape is its
+CPU time while being scraped minus its CPU time over an equally long idle period.
+
+Usage:
+    python benchmark_scrape.py [--targets 3 30] [--scrapers 10] [--duration 10] [--port 18000]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import psutil
+
+def run_child(mode, targets, port):
+    import benchmark_engines
+    import mysql_metrics_exporter as exporter
+
+    benchmark_engines.instrument(0.0005)
+    servers = [
+        {'instance': f'sim{target_port}', 'host': '127.0.0.1', 'port': target_port, 'user': 'root',
+         'password': '', 'database': 'replicated_db', 'data_dir': ''}
+        for target_port in range(20000, 20000 + targets)
+    ]
+    for server in servers:
+        threading.Thread(target=exporter.collect_mysql_metrics, args=(server,), daemon=True).start()
+
+    exposition_cache = None
+    if mode == 'cached':
+        exposition_cache = exporter.ExpositionCache()
+        threading.Thread(target=exposition_cache.run, daemon=True).start()
+    exporter.start_exporter_http_server(port, exposition_cache=exposition_cache)
+    while True:
+        time.sleep(60)
+
+def scrape(url):
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request) as response:
+        return len(response.read())
+
+def measure(mode, targets, scrapers, duration, port):
+    child = subprocess.Popen([sys.executable, __file__, '--child', mode, str(targets), str(port)])
+    try:
+        url = f'http://127.0.0.1:{port}/metrics'
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                scrape(url)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+        time.sleep(3)  # Let every target finish a few passes
+
+        process = psutil.Process(child.pid)
+        cpu = process.cpu_times()
+        time.sleep(duration)
+        idle_cpu = sum(process.cpu_times()[:2]) - sum(cpu[:2])
+
+        latencies = []
+        sizes = []
+        stop = time.monotonic() + duration
+
+        def scraper():
+            while time.monotonic() < stop:
+                started = time.perf_counter()
+                sizes.append(scrape(url))
+                latencies.append(time.perf_counter() - started)
+
+        cpu = process.cpu_times()
+        threads = [threading.Thread(target=scraper) for _ in range(scrapers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        scrape_cpu = sum(process.cpu_times()[:2]) - sum(cpu[:2])
+    finally:
+        child.kill()
+        child.wait()
+
+    latencies.sort()
+    return {
+        'scrapes_per_s': len(latencies) / duration,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'cpu_ms_per_scrape': max(0.0, scrape_cpu - idle_cpu) / len(latencies) * 1000,
+        'kb': statistics.median(sizes) / 1024,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=int, nargs='+', default=[3, 30])
+    parser.add_argument('--scrapers', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10, help='seconds of idle and of scraping per combination')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--child', nargs=3, metavar=('MODE', 'TARGETS', 'PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], int(args.child[1]), int(args.child[2]))
+        return
+
+    print(f"{'mode':<7} {'targets':>7} {'scrapes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'cpu ms/scrape':>13} {'gzip kB':>8}")
+    for targets in args.targets:
+        for mode in ('live', 'cached'):
+            r = measure(mode, targets, args.scrapers, args.duration, args.port)
+            print(f"{mode:<7} {targets:>7} {r['scrapes_per_s']:>9.0f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+                  f"{r['cpu_ms_per_scrape']:>13.2f} {r['kb']:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,39 @@
-from prometheus_client import start_http_server, Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram, CollectorRegistry, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, GaugeHistogramMetricFamily
+from prometheus_client.exposition import make_wsgi_app, generate_latest, gzip_accepted, CONTENT_TYPE_PLAIN_0_0_4, ThreadingWSGIServer
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from urllib.parse import parse_qs
 import mysql.connector
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import copy
+import re
+import bisect
+import heapq
+import fnmatch
+from array import array
 import time
 import psutil  # For system metrics
-from threading import Thread
+from threading import Thread, Event, Lock
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import logging
+import logging.handlers
+import queue
+import atexit
 import os
+import random
 import signal
+import socket
 import sys
 
-# Configure logging
-logging.basicConfig(
-    filename='mysql_exporter.log',
-    level=logging.INFO,
-    format='%(asctime)s:%(levelname)s:%(message)s'
-)
-
 # Define Prometheus metrics with 'instance' label
 mysql_up = Gauge('mysql_up', 'MySQL server availability', ['instance'])  # Indicates if the MySQL server is up (1) or down (0).
+mysql_scrape_success = Gauge('mysql_scrape_success', 'Whether the last collection pass of the instance succeeded', ['instance'])  # While 0, the instance's MySQL series are absent rather than zero.
+mysql_last_scrape_success_timestamp_seconds = Gauge('mysql_last_scrape_success_timestamp_seconds', 'Unix time of the last successful collection pass', ['instance'])  # time() - this is the age of the instance's data.
 mysql_connections = Gauge('mysql_connections', 'Number of active connections', ['instance'])  # Current number of active connections to the MySQL server.
 mysql_max_connections = Gauge('mysql_max_connections', 'Maximum allowed connections', ['instance'])  # Maximum number of connections allowed by the MySQL server.
 mysql_queries_total = Counter('mysql_queries_total', 'Total number of queries executed', ['instance'])  # Total count of all queries executed on the server.
@@ -64,8 +81,83 @@ mysql_tmp_table_size = Gauge('mysql_tmp_table_size', 'Maximum size of internal i
 mysql_handler_read_rnd_next = Counter('mysql_handler_read_rnd_next', 'Number of requests to read the next row in data files', ['instance'])  # Total count of requests to read the next row in data files.
 mysql_perf_schema_events_waits = Counter('mysql_perf_schema_events_waits', 'Number of wait events in Performance Schema', ['instance'])  # Total count of wait events recorded in the Performance Schema.
 mysql_perf_schema_events_statements = Counter('mysql_perf_schema_events_statements', 'Number of statements in Performance Schema', ['instance'])  # Total count of statements recorded in the Performance Schema.
+mysql_master_binlog_file_number = Gauge('mysql_master_binlog_file_number', 'Sequence number of the current binary log file', ['instance'])  # Numeric suffix of File from SHOW MASTER STATUS.
+mysql_master_binlog_position = Gauge('mysql_master_binlog_position', 'Write position in the current binary log file', ['instance'])  # Position from SHOW MASTER STATUS.
+mysql_master_gtid_executed_transactions = Gauge('mysql_master_gtid_executed_transactions', 'Number of transactions in gtid_executed on the source', ['instance'])  # Size of Executed_Gtid_Set from SHOW MASTER STATUS.
+mysql_slave_read_master_log_file_number = Gauge('mysql_slave_read_master_log_file_number', 'Source binary log file the I/O thread is reading', ['instance'])  # Numeric suffix of Master_Log_File.
+mysql_slave_read_master_log_position = Gauge('mysql_slave_read_master_log_position', 'Source binary log position the I/O thread has read up to', ['instance'])  # Read_Master_Log_Pos.
+mysql_slave_exec_master_log_file_number = Gauge('mysql_slave_exec_master_log_file_number', 'Source binary log file the SQL thread is executing', ['instance'])  # Numeric suffix of Relay_Master_Log_File.
+mysql_slave_exec_master_log_position = Gauge('mysql_slave_exec_master_log_position', 'Source binary log position the SQL thread has executed up to', ['instance'])  # Exec_Master_Log_Pos.
+mysql_slave_relay_log_space = Gauge('mysql_slave_relay_log_space', 'Total size of all relay log files in bytes', ['instance'])  # Relay_Log_Space.
+mysql_slave_gtid_retrieved_transactions = Gauge('mysql_slave_gtid_retrieved_transactions', 'Number of transactions in Retrieved_Gtid_Set', ['instance'])  # GTIDs received by the I/O thread.
+mysql_slave_gtid_executed_transactions = Gauge('mysql_slave_gtid_executed_transactions', 'Number of transactions in Executed_Gtid_Set', ['instance'])  # GTIDs applied by the replica.
+mysql_replication_fetch_backlog_bytes = Gauge('mysql_replication_fetch_backlog_bytes', 'Source binlog bytes not yet received by the replica', ['instance'])  # Source write position minus Read_Master_Log_Pos.
+mysql_replication_apply_backlog_bytes = Gauge('mysql_replication_apply_backlog_bytes', 'Received binlog bytes not yet applied by the replica', ['instance'])  # Read_Master_Log_Pos minus Exec_Master_Log_Pos.
+mysql_replication_transactions_behind = Gauge('mysql_replication_transactions_behind', 'Transactions executed on the source but not yet on the replica (GTID)', ['instance'])  # Only with GTID replication.
+mysql_replication_apply_rate_bytes = Gauge('mysql_replication_apply_rate_bytes', 'Smoothed rate at which the replica applies source binlog, in bytes per second', ['instance'])  # EWMA of Exec_Master_Log_Pos growth.
+mysql_replication_backlog_change_rate_bytes = Gauge('mysql_replication_backlog_change_rate_bytes', 'Smoothed change of the total binlog backlog in bytes per second (negative while catching up)', ['instance'])  # Tells whether lag is shrinking or growing.
+mysql_replication_catchup_eta_seconds = Gauge('mysql_replication_catchup_eta_seconds', 'Estimated time until the replica catches up (-1 while the backlog is growing)', ['instance'])  # Backlog divided by the net drain rate.
+mysql_innodb_history_list_length = Gauge('mysql_innodb_history_list_length', 'InnoDB history list length (undo records not yet purged)', ['instance'])  # From SHOW ENGINE INNODB STATUS.
+mysql_innodb_checkpoint_age_bytes = Gauge('mysql_innodb_checkpoint_age_bytes', 'Redo log bytes written since the last checkpoint', ['instance'])  # Log sequence number minus Last checkpoint at.
+mysql_innodb_pending_log_flushes = Gauge('mysql_innodb_pending_log_flushes', 'Pending redo log flushes', ['instance'])  # LOG section.
+mysql_innodb_pending_fsyncs = Gauge('mysql_innodb_pending_fsyncs', 'Pending fsync calls', ['instance', 'target'])  # FILE I/O section, target is log or buffer_pool, or all where the server prints only the total.
+mysql_innodb_pending_writes = Gauge('mysql_innodb_pending_writes', 'Pending buffer pool page writes', ['instance', 'type'])  # BUFFER POOL AND MEMORY section, type is lru, flush_list or single_page (where printed).
+mysql_innodb_semaphore_waits = Gauge('mysql_innodb_semaphore_waits', 'Threads currently waiting on an InnoDB semaphore', ['instance'])  # SEMAPHORES section.
+mysql_innodb_os_wait_reservations = Counter('mysql_innodb_os_wait_reservations', 'InnoDB OS wait array reservations', ['instance'])  # SEMAPHORES section, reservation count.
+mysql_innodb_deadlocks_detected = Counter('mysql_innodb_deadlocks_detected', 'New InnoDB deadlocks seen in LATEST DETECTED DEADLOCK', ['instance'])  # Deduplicated by hash of the deadlock report.
+mysql_heartbeat_lag_seconds = Gauge('mysql_heartbeat_lag_seconds', 'Replication lag measured from the exporter heartbeat table', ['instance'])  # Sub-second replication lag on replicas when HEARTBEAT_ENABLED is set.
 mysql_cpu_usage = Gauge('mysql_cpu_usage', 'CPU usage percentage of MySQL process', ['instance'])  # Current CPU usage percentage of the MySQL server process. # Add this line
 
+# Exporter self-monitoring metrics
+mysql_exporter_queries_per_scrape = Gauge('mysql_exporter_queries_per_scrape', 'Number of queries issued by the exporter during the last collection pass', ['instance'])  # Round trips per pass; stays O(1) regardless of how many metrics are exported.
+mysql_exporter_heartbeat_writes = Counter('mysql_exporter_heartbeat_writes', 'Number of heartbeat rows written by the exporter', ['instance'])  # Writes to HEARTBEAT_TABLE on the heartbeat master.
+mysql_exporter_collector_duration_seconds = Gauge('mysql_exporter_collector_duration_seconds', 'Duration of the last run of an optional collector', ['instance', 'group'])  # Measures the cost of each INSTANCE_COLLECTORS entry.
+mysql_exporter_reconnects = Counter('mysql_exporter_reconnects', 'Number of times the exporter had to re-establish its MySQL connection', ['instance'])  # Reconnects after a failed query or a failed health check.
+mysql_exporter_config_reload_success = Gauge('mysql_exporter_config_reload_success', 'Whether the last configuration file (re)load succeeded')  # 0 while the file on disk is invalid; the previous configuration stays active.
+mysql_exporter_config_last_reload_success_timestamp_seconds = Gauge('mysql_exporter_config_last_reload_success_timestamp_seconds', 'Unix time of the last successful configuration file (re)load')  # Changes on every applied edit.
+mysql_exporter_discovered_replicas = Gauge('mysql_exporter_discovered_replicas', 'Replicas discovered from a source and collected automatically', ['instance'])  # Per REPLICA_DISCOVERY_MASTERS entry, including replicas within their retention period.
+mysql_exporter_exposition_render_seconds = Gauge('mysql_exporter_exposition_render_seconds', 'Time spent rendering and compressing the cached /metrics exposition')  # Paid once per cycle instead of once per scrape.
+mysql_exporter_exposition_bytes = Gauge('mysql_exporter_exposition_bytes', 'Size of the cached /metrics exposition', ['encoding'])  # encoding is identity or gzip.
+mysql_exporter_dropped_series = Gauge('mysql_exporter_dropped_series', 'Series folded into an "other" rollup by a cardinality cap', ['instance', 'metric'])  # See COMMAND_SERIES_LIMIT.
+mysql_exporter_connect_duration_seconds = Histogram('mysql_exporter_connect_duration_seconds', 'Time spent on the MySQL TCP and authentication handshake', ['instance'])  # Handshake latency of each (re)connect.
+mysql_exporter_circuit_state = Gauge('mysql_exporter_circuit_state', 'State of a circuit breaker (0 closed, 1 open, 2 half-open)', ['instance', 'breaker'])  # breaker is mysql, data_dir, mysqld_process, heartbeat or table_sizes.
+mysql_exporter_circuit_consecutive_failures = Gauge('mysql_exporter_circuit_consecutive_failures', 'Failed attempts since the circuit breaker last closed', ['instance', 'breaker'])  # Drives the exponential backoff.
+mysql_exporter_circuit_backoff_seconds = Gauge('mysql_exporter_circuit_backoff_seconds', 'Length of the current circuit breaker backoff window (0 while closed)', ['instance', 'breaker'])  # Jittered, see CIRCUIT_BREAKER_BACKOFF.
+mysql_exporter_log_messages_suppressed = Counter('mysql_exporter_log_messages_suppressed', 'Log messages not written because they repeated an earlier one within LOG_DEDUP_WINDOW')  # Reported in the log as a count per message.
+mysql_exporter_log_messages_dropped = Counter('mysql_exporter_log_messages_dropped', 'Log messages dropped because the log queue was full')  # Non-zero means the log file cannot keep up.
+mysql_exporter_collection_errors = Counter('mysql_exporter_collection_errors', 'Failed collection attempts by failure class', ['instance', 'breaker', 'reason'])  # reason is auth, network, path, process or other.
+
+# Every metric above that is labelled by instance: the series /probe renders for a target,
+# and those removed when an instance goes down or is no longer collected
+INSTANCE_METRICS = [
+    mysql_up, mysql_scrape_success, mysql_last_scrape_success_timestamp_seconds, mysql_connections,
+    mysql_max_connections, mysql_queries_total, mysql_slow_queries, mysql_questions, mysql_commands,
+    mysql_replication_lag_seconds, mysql_slave_io_running, mysql_slave_sql_running, mysql_slave_retried_transactions,
+    mysql_innodb_buffer_pool_size, mysql_innodb_buffer_pool_used, mysql_innodb_buffer_pool_pages_data,
+    mysql_innodb_buffer_pool_pages_free, mysql_innodb_row_lock_time_avg, mysql_innodb_row_lock_time_max,
+    mysql_innodb_row_lock_time_total, mysql_innodb_transactions, mysql_innodb_read_io_requests,
+    mysql_innodb_write_io_requests, mysql_innodb_data_reads, mysql_innodb_data_writes, mysql_query_cache_size,
+    mysql_query_cache_hits, mysql_query_cache_misses, mysql_query_cache_free_memory, mysql_memory_used,
+    mysql_memory_free, mysql_max_memory_usage, mysql_disk_usage_percent, mysql_disk_read_io_requests,
+    mysql_disk_write_io_requests, mysql_disk_read_bytes, mysql_disk_write_bytes, mysql_threads_running,
+    mysql_threads_created, mysql_threads_cached, mysql_errors_total, mysql_aborted_clients, mysql_aborted_connects,
+    mysql_uptime_seconds, mysql_tmp_tables, mysql_tmp_disk_tables, mysql_tmp_table_size, mysql_handler_read_rnd_next,
+    mysql_perf_schema_events_waits, mysql_perf_schema_events_statements, mysql_master_binlog_file_number,
+    mysql_master_binlog_position, mysql_master_gtid_executed_transactions, mysql_slave_read_master_log_file_number,
+    mysql_slave_read_master_log_position, mysql_slave_exec_master_log_file_number, mysql_slave_exec_master_log_position,
+    mysql_slave_relay_log_space, mysql_slave_gtid_retrieved_transactions, mysql_slave_gtid_executed_transactions,
+    mysql_replication_fetch_backlog_bytes, mysql_replication_apply_backlog_bytes, mysql_replication_transactions_behind,
+    mysql_replication_apply_rate_bytes, mysql_replication_backlog_change_rate_bytes,
+    mysql_replication_catchup_eta_seconds, mysql_innodb_history_list_length, mysql_innodb_checkpoint_age_bytes,
+    mysql_innodb_pending_log_flushes, mysql_innodb_pending_fsyncs, mysql_innodb_pending_writes,
+    mysql_innodb_semaphore_waits, mysql_innodb_os_wait_reservations, mysql_innodb_deadlocks_detected,
+    mysql_heartbeat_lag_seconds, mysql_cpu_usage, mysql_exporter_queries_per_scrape, mysql_exporter_heartbeat_writes,
+    mysql_exporter_collector_duration_seconds, mysql_exporter_reconnects, mysql_exporter_discovered_replicas,
+    mysql_exporter_dropped_series, mysql_exporter_connect_duration_seconds, mysql_exporter_circuit_state,
+    mysql_exporter_circuit_consecutive_failures, mysql_exporter_circuit_backoff_seconds,
+    mysql_exporter_collection_errors
+]
+
 # Configuration for multiple MySQL servers
 MYSQL_SERVERS = [
     {
@@ -98,303 +190,3104 @@ MYSQL_SERVERS = [
     # Add more servers if needed
 ]
 
-def collect_mysql_metrics(server):
+# JSON configuration file, polled every CONFIG_RELOAD_INTERVAL seconds. It replaces the
+# servers above and may override the settings in CONFIG_SETTINGS, e.g.
+#   {"servers": [{"instance": "master", "host": "127.0.0.1", "port": 3306, "user": "root",
+#                 "password": "", "database": "replicated_db", "data_dir": "C:/mysql/master/bin/data"}],
+#    "settings": {"MYSQL_METRICS_INTERVAL": 2, "TABLE_SIZE_SCHEMAS": ["replicated_db", "app_*"]}}
+# On a change only the added, removed or modified servers are started or stopped. Settings
+# in CONFIG_STARTUP_SETTINGS are only read from the file at startup.
+CONFIG_FILE = os.environ.get('MYSQL_EXPORTER_CONFIG', 'mysql_exporter.json')
+CONFIG_RELOAD_INTERVAL = 5
+CONFIG_STARTUP_SETTINGS = {'EXPORTER_PORT', 'COLLECTION_MODE', 'COLLECTION_ENGINE', 'SCRAPE_MAX_WORKERS', 'PROBE_MAX_WORKERS',
+                           'ASYNC_MAX_CONCURRENCY', 'EXPOSITION_CACHE_ENABLED', 'SHARD_INDEX', 'SHARD_COUNT', 'SHARD_VIRTUAL_NODES',
+                           'LOG_FILE', 'LOG_LEVEL', 'LOG_FORMAT', 'LOG_MAX_BYTES', 'LOG_BACKUP_COUNT', 'LOG_QUEUE_SIZE'}
+
+# Settings the file may override. A value must have the type and shape of the setting's
+# default: a number > 0 (>= 0 where the default is 0), the same keys for a dict, and elements
+# like the default's for a list (strings for an empty list). Enumerated settings must be one
+# of their CONFIG_SETTING_CHOICES (for a dict, every value). A file that breaks any of this is
+# rejected as a whole.
+CONFIG_SETTINGS = {
+    'CONFIG_RELOAD_INTERVAL', 'EXPORTER_PORT', 'EXPOSITION_CACHE_ENABLED', 'EXPOSITION_GZIP_LEVEL',
+    'MYSQL_METRICS_INTERVAL', 'SYSTEM_METRICS_INTERVAL', 'COLLECTION_ENGINE', 'ASYNC_MAX_CONCURRENCY',
+    'ASYNC_COLLECTION_TIMEOUT', 'COLLECTION_MODE', 'SCRAPE_CACHE_TTL', 'SCRAPE_MAX_WORKERS',
+    'PROBE_ALLOWED_TARGETS', 'PROBE_SERVER_DEFAULTS', 'PROBE_MAX_WORKERS', 'PROBE_TIMEOUT', 'PROBE_TARGET_IDLE_TIMEOUT',
+    'PROBE_MAX_TARGETS',
+    'SHARD_INDEX', 'SHARD_COUNT', 'SHARD_VIRTUAL_NODES',
+    'HEARTBEAT_ENABLED', 'HEARTBEAT_MASTER', 'HEARTBEAT_TABLE', 'HEARTBEAT_INTERVAL_MS', 'MYSQL_MEMORY_METRIC',
+    'COLLECTION_TIERS', 'METRIC_GROUP_TIERS', 'STATEMENT_DIGEST_TOP_N', 'STATEMENT_DIGEST_ORDER_BY',
+    'STATEMENT_DIGEST_TEXT_CACHE_SIZE', 'GLOBAL_STATUS_ALLOWLIST', 'GLOBAL_STATUS_DENYLIST', 'GLOBAL_STATUS_TYPES',
+    'COMMAND_SERIES_LIMIT', 'PROCESSLIST_TABLE', 'PROCESSLIST_AGE_BUCKETS', 'LOCK_WAIT_TOP_BLOCKERS',
+    'LOCK_WAIT_LOG_THRESHOLD', 'TABLE_SIZE_SCHEMAS', 'TABLE_SIZE_REFRESH_PERIOD',
+    'REPLICA_DISCOVERY_MASTERS', 'REPLICA_DISCOVERY_TEMPLATE', 'REPLICA_DISCOVERY_RETENTION',
+    'CONNECTION_HEALTH_CHECK_INTERVAL', 'CONNECTION_TIMEOUT', 'CIRCUIT_BREAKER_BACKOFF',
+    'INNODB_METRICS_ENABLE', 'INNODB_METRICS_GAUGES', 'INNODB_DEADLOCK_LOG_LINES',
+    'LOG_FILE', 'LOG_LEVEL', 'LOG_FORMAT', 'LOG_MAX_BYTES', 'LOG_BACKUP_COUNT', 'LOG_QUEUE_SIZE', 'LOG_DEDUP_WINDOW',
+}
+CONFIG_SETTING_CHOICES = {
+    'COLLECTION_ENGINE': ('threads', 'asyncio'),
+    'COLLECTION_MODE': ('loop', 'scrape', 'probe'),
+    'MYSQL_MEMORY_METRIC': ('rss', 'pss'),
+    'STATEMENT_DIGEST_ORDER_BY': ('time', 'rows_examined'),
+    'GLOBAL_STATUS_TYPES': ('counter', 'gauge'),
+    'PROCESSLIST_TABLE': ('information_schema.PROCESSLIST', 'performance_schema.processlist'),
+    'LOG_LEVEL': ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+    'LOG_FORMAT': ('text', 'json'),
+}
+
+# Logging: threads only put records on a queue of LOG_QUEUE_SIZE records (dropping them when it
+# is full, so a slow disk never blocks collection) and a background thread writes them to
+# LOG_FILE, rotated at LOG_MAX_BYTES with LOG_BACKUP_COUNT old files kept. LOG_FORMAT is 'text'
+# or 'json' (one object per line). A message repeated within LOG_DEDUP_WINDOW seconds is only
+# written once, followed by the number of repeats that were suppressed.
+LOG_FILE = 'mysql_exporter.log'
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'text'
+LOG_MAX_BYTES = 10 * 2 ** 20
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000
+LOG_DEDUP_WINDOW = 60
+
+# Port of the /metrics and /probe HTTP server
+EXPORTER_PORT = 8000
+
+# Loop mode: render /metrics once per MYSQL_METRICS_INTERVAL into a gzip-compressed buffer
+# that every scrape is served from, instead of serializing the registry on each request
+EXPOSITION_CACHE_ENABLED = True
+EXPOSITION_GZIP_LEVEL = 6
+
+# Seconds between MySQL metrics passes (the scheduler tick) and between system metrics passes
+MYSQL_METRICS_INTERVAL = 1
+SYSTEM_METRICS_INTERVAL = 5
+
+# Collection engine: 'threads' starts two OS threads per server, 'asyncio' runs the
+# collection of every server on a single event loop (requires mysql.connector.aio)
+COLLECTION_ENGINE = 'threads'
+
+# asyncio engine: maximum number of instances collected at once, and the time
+# after which a single instance's pass is abandoned, in seconds
+ASYNC_MAX_CONCURRENCY = 50
+ASYNC_COLLECTION_TIMEOUT = 5
+
+# Collection mode: 'loop' refreshes metrics every MYSQL_METRICS_INTERVAL seconds,
+# 'scrape' queries MySQL only when /metrics is scraped (see ScrapeDrivenCollector),
+# 'probe' collects nothing in the background and serves only /probe?target= requests
+COLLECTION_MODE = 'loop'
+
+# Scrape mode: seconds a refresh is reused by later scrapes, and the size of the worker pool
+SCRAPE_CACHE_TTL = 5
+SCRAPE_MAX_WORKERS = 16
+
+# /probe?target= (served in every mode): a target is the instance name of a MYSQL_SERVERS
+# entry or of a discovered replica. In loop and scrape mode the series the exporter already
+# collects for such an instance are served as they are. Any other host[:port] is refused
+# unless host:port (with the default port filled in) matches one of PROBE_ALLOWED_TARGETS,
+# case-insensitive fnmatch patterns such as ['10.0.1.*:3306', 'db-*.example.internal:*'];
+# it is then connected to with PROBE_SERVER_DEFAULTS. The HTTP listener has no
+# authentication, so keep the list as narrow as the fleet allows.
+PROBE_ALLOWED_TARGETS = []
+PROBE_SERVER_DEFAULTS = {
+    'port': 3306,
+    'user': 'root',
+    'password': '',
+    'database': 'replicated_db',
+    'data_dir': '',  # Remote targets have no local data directory
+}
+
+# Probe worker pool size (the maximum number of targets queried at once), the time a probe
+# waits for its target, and the idle time after which a target's pooled connection is closed,
+# in seconds
+PROBE_MAX_WORKERS = 32
+PROBE_TIMEOUT = 10
+PROBE_TARGET_IDLE_TIMEOUT = 600
+
+# Maximum number of PROBE_ALLOWED_TARGETS targets kept at once; probes of further new
+# targets are answered with 503 until idle ones have been dropped
+PROBE_MAX_TARGETS = 100
+
+# Sharding: SHARD_COUNT exporter replicas share MYSQL_SERVERS and each one collects and
+# exposes only the servers that a consistent-hash ring (SHARD_VIRTUAL_NODES points per
+# replica) assigns to its SHARD_INDEX. Adding or removing a replica only moves about
+# 1/SHARD_COUNT of the servers. The environment overrides these so that every replica
+# can run the same file.
+SHARD_INDEX = int(os.environ.get('MYSQL_EXPORTER_SHARD_INDEX', 0))
+SHARD_COUNT = int(os.environ.get('MYSQL_EXPORTER_SHARD_COUNT', 1))
+SHARD_VIRTUAL_NODES = 128
+
+# Heartbeat replication lag: the exporter writes a microsecond timestamp row into
+# HEARTBEAT_TABLE on the HEARTBEAT_MASTER instance every HEARTBEAT_INTERVAL_MS and every
+# other instance reads it back, giving lag with far better than 1 s resolution
+HEARTBEAT_ENABLED = False
+HEARTBEAT_MASTER = 'master'
+HEARTBEAT_TABLE = 'replicated_db.exporter_heartbeat'
+HEARTBEAT_INTERVAL_MS = 250
+
+# What mysql_memory_used reports for each mysqld process: 'rss', or 'pss' (proportional
+# set size, Linux only and slower to read; falls back to RSS where unavailable)
+MYSQL_MEMORY_METRIC = 'rss'
+
+# Collection tiers and their refresh intervals, in seconds
+COLLECTION_TIERS = {
+    'fast': 1,      # Changes every second and drives alerting
+    'medium': 15,   # Changes slowly or is comparatively expensive to read
+    'slow': 300,    # Effectively static
+}
+
+# Tier of each metric group; a group is only queried when its tier is due
+METRIC_GROUP_TIERS = {
+    'global_status': 'fast',        # SHOW GLOBAL STATUS (Threads_running, counters, ...)
+    'slave_status': 'fast',         # SHOW SLAVE STATUS (replication lag, thread states)
+    'disk_usage': 'medium',         # Data directory disk usage
+    'global_variables': 'slow',     # SHOW GLOBAL VARIABLES (max_connections, innodb_buffer_pool_size, tmp_table_size, ...)
+    'statement_digests': 'medium',  # performance_schema.events_statements_summary_by_digest
+    'heartbeat': 'fast',            # Heartbeat row read back on replicas (HEARTBEAT_ENABLED)
+    'innodb_status': 'medium',      # SHOW ENGINE INNODB STATUS
+    'innodb_metrics': 'medium',     # information_schema.INNODB_METRICS
+    'master_status': 'fast',        # SHOW MASTER STATUS, on binlog-writing instances that are not replicas
+    'processlist': 'medium',        # Processlist snapshot joined with INNODB_TRX
+    'replica_discovery': 'slow',    # SHOW REPLICAS on REPLICA_DISCOVERY_MASTERS (background thread)
+    'lock_waits': 'fast',           # InnoDB lock wait-for graph (performance_schema.data_lock_waits / sys.innodb_lock_waits)
+}
+
+# performance_schema statement digests: number of digests exported per instance (the
+# rest are summed into digest="other") and what they are ranked by ('time' or 'rows_examined')
+STATEMENT_DIGEST_TOP_N = 20
+STATEMENT_DIGEST_ORDER_BY = 'time'
+
+# Maximum number of digest texts kept in memory, shared by all instances
+STATEMENT_DIGEST_TEXT_CACHE_SIZE = 1000
+
+# Generic SHOW GLOBAL STATUS mapping: every numeric status variable that matches the
+# allowlist and not the denylist (case-insensitive fnmatch patterns) is exported as
+# mysql_global_status_<variable_name>. Com_% is covered by mysql_commands.
+GLOBAL_STATUS_ALLOWLIST = ['*']
+GLOBAL_STATUS_DENYLIST = ['Com_*', 'Ssl_*', 'Rsa_public_key', 'Caching_sha2_password_rsa_public_key']
+
+# Per-variable type overrides ('counter' or 'gauge') for the generic mapping, applied
+# before the built-in STATUS_VARIABLE_TYPES table and the name heuristics
+GLOBAL_STATUS_TYPES = {}
+
+# mysql_commands: a Com_% variable gets its own series once it has been non-zero, up to this
+# many commands per instance; commands beyond the cap are summed into command="other"
+COMMAND_SERIES_LIMIT = 50
+
+# Processlist snapshot source: 'information_schema.PROCESSLIST', or 'performance_schema.processlist'
+# on MySQL 8.0.22+ (requires performance_schema_show_processlist=ON, does not take the global mutex)
+PROCESSLIST_TABLE = 'information_schema.PROCESSLIST'
+
+# Upper bounds of the query age buckets of mysql_processlist_query_age_seconds, in seconds
+PROCESSLIST_AGE_BUCKETS = [0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600]
+
+# InnoDB lock waits: number of blocking threads exported per instance, and the wait age
+# in seconds above which the top blockers are written to the log
+LOCK_WAIT_TOP_BLOCKERS = 5
+LOCK_WAIT_LOG_THRESHOLD = 10
+
+# Schemas (fnmatch patterns) whose table sizes are exported, e.g. ['replicated_db', 'app_*'].
+# Sizes are refreshed in the background on a separate connection per server (a thread, or a
+# task with the asyncio engine), one schema per tick, so that a full sweep takes
+# TABLE_SIZE_REFRESH_PERIOD seconds and slow information_schema.TABLES queries never delay the
+# collection loop. The refresher runs in every collection mode, also between scrapes. The
+# default empty list disables it.
+TABLE_SIZE_SCHEMAS = []
+TABLE_SIZE_REFRESH_PERIOD = 300
+
+# Replica discovery: the replicas of these MYSQL_SERVERS instances are found with SHOW REPLICAS
+# (SHOW SLAVE HOSTS before 8.0.22, or the binlog dump threads in the processlist when replicas do
+# not set report_host) and collected like configured servers. A discovered replica is built
+# from REPLICA_DISCOVERY_TEMPLATE, whose string values may use {master}, {host}, {port} and
+# {server_id}, and is kept for REPLICA_DISCOVERY_RETENTION seconds after it was last seen, so a
+# replica that stopped replicating is still monitored. Replicas that match a configured server
+# by host and port are skipped.
+REPLICA_DISCOVERY_MASTERS = []
+REPLICA_DISCOVERY_TEMPLATE = {
+    'instance': '{host}:{port}',
+    'port': 3306,  # Used when the replica's port is unknown (processlist fallback)
+    'user': 'root',
+    'password': '',
+    'database': 'replicated_db',
+    'data_dir': '',
+}
+REPLICA_DISCOVERY_RETENTION = 86400
+
+# Connections idle for longer than this are pinged before reuse, in seconds
+CONNECTION_HEALTH_CHECK_INTERVAL = 30
+
+# Timeout for the MySQL TCP and authentication handshake, in seconds
+CONNECTION_TIMEOUT = 5
+
+# Circuit breakers: after a failed attempt a target (its MySQL connection, data directory,
+# heartbeat writer or table size refresher) is not retried until a backoff window has passed.
+# The window starts at the first value and doubles with every consecutive failure up to the
+# second, in seconds, with jitter so that targets that broke together do not retry together.
+# The first attempt after the window is a half-open probe: a success closes the breaker, a
+# failure reopens it for the next, longer window.
+CIRCUIT_BREAKER_BACKOFF = {
+    'auth': (60, 1800),     # Access denied: only a configuration or grant change fixes it
+    'network': (2, 300),    # Connection refused, lost or timed out: usually a restart
+    'path': (60, 3600),     # Missing data directory
+    'process': (30, 900),   # mysqld process of a local server not found (system-wide connection scan)
+    'other': (5, 300),      # Any other error, e.g. a missing privilege for one of the queries
+}
+
+class TierScheduler:
     """
-    Collects MySQL metrics for a given server and updates Prometheus gauges/counters.
+    Decides which metric groups are due on a collection pass, based on the tier
+    each group is assigned to in METRIC_GROUP_TIERS.
     """
-    instance = server['instance']
-    host = server['host']
-    port = server['port']
-    user = server['user']
-    password = server['password']
-    database = server['database']
-    data_dir = server['data_dir']
 
-    while True:
-        try:
-            connection = mysql.connector.connect(
-                host=host,
-                port=port,
-                user=user,
-                password=password,
-                database=database
-            )
-            cursor = connection.cursor(dictionary=True)
-
-            # Set mysql_up to 1 (up)
-            mysql_up.labels(instance=instance).set(1)
-
-            # Get number of active connections
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_connected';")
-            result = cursor.fetchone()
-            connections = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_connections.labels(instance=instance).set(connections)
-
-            # Get maximum connections
-            cursor.execute("SHOW VARIABLES LIKE 'max_connections';")
-            result = cursor.fetchone()
-            max_connections = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_max_connections.labels(instance=instance).set(max_connections)
-
-            # Get total number of queries
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Queries';")
-            result = cursor.fetchone()
-            queries = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_queries_total.labels(instance=instance).inc(queries - mysql_queries_total.labels(instance=instance)._value.get())
-
-            # Get slow queries
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Slow_queries';")
-            result = cursor.fetchone()
-            slow_queries = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_slow_queries.labels(instance=instance).inc(slow_queries - mysql_slow_queries.labels(instance=instance)._value.get())
-
-            # Get number of statements executed
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Questions';")
-            result = cursor.fetchone()
-            questions = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_questions.labels(instance=instance).inc(questions - mysql_questions.labels(instance=instance)._value.get())
-
-            # Get number of SQL commands executed
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Com_%';")
-            results = cursor.fetchall()
-            for row in results:
-                command = row['Variable_name']
-                value = int(row['Value']) if row['Value'].isdigit() else 0
-                mysql_commands.labels(instance=instance, command=command).inc(value - mysql_commands.labels(instance=instance, command=command)._value.get())
-
-            # Get replication lag (for slaves)
-            cursor.execute("SHOW SLAVE STATUS;")
-            slave_status = cursor.fetchone()
-            if slave_status:
-                replication_lag = slave_status.get('Seconds_Behind_Master', 0)
-                mysql_replication_lag_seconds.labels(instance=instance).set(float(replication_lag) if replication_lag else 0)
-
-                # Get slave thread statuses
-                io_running = 1 if slave_status.get('Slave_IO_Running', '').lower() == 'yes' else 0
-                sql_running = 1 if slave_status.get('Slave_SQL_Running', '').lower() == 'yes' else 0
-                mysql_slave_io_running.labels(instance=instance).set(io_running)
-                mysql_slave_sql_running.labels(instance=instance).set(sql_running)
-
-                # Get retried transactions
-                retried_transactions = int(slave_status.get('Retrieved_Rows', 0))
-                mysql_slave_retried_transactions.labels(instance=instance).inc(retried_transactions - mysql_slave_retried_transactions.labels(instance=instance)._value.get())
+    def __init__(self, group_tiers=None, tiers=None):
+        # None means the module settings, looked up on every call so reloads apply to running collectors
+        self.group_tiers = group_tiers
+        self.tiers = tiers
+        self.last_run = {}
+
+    def due(self, group):
+        """
+        Returns True if the group has never run or its tier interval has elapsed.
+        """
+        last_run = self.last_run.get(group)
+        if last_run is None:
+            return True
+        group_tiers = METRIC_GROUP_TIERS if self.group_tiers is None else self.group_tiers
+        tiers = COLLECTION_TIERS if self.tiers is None else self.tiers
+        return time.monotonic() - last_run >= tiers[group_tiers[group]]
+
+    def mark_run(self, group):
+        """
+        Records a successful refresh of the group.
+        """
+        self.last_run[group] = time.monotonic()
+
+class InstanceConnection:
+    """
+    Long-lived, health-checked MySQL connection for one MYSQL_SERVERS entry.
+
+    The connection is opened lazily, reused across collection passes and only
+    re-established after invalidate() or a failed health check, so the exporter
+    no longer inflates Connections/Threads_created on the server it observes.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.instance = server['instance']
+        self.connection = None
+        self.last_used = 0
+        self.has_connected = False
+
+    def _connect(self):
+        start = time.perf_counter()
+        self.connection = mysql.connector.connect(
+            host=self.server['host'],
+            port=self.server['port'],
+            user=self.server['user'],
+            password=self.server['password'],
+            database=self.server['database'],
+            connection_timeout=CONNECTION_TIMEOUT,
+            autocommit=True
+        )
+        mysql_exporter_connect_duration_seconds.labels(instance=self.instance).observe(time.perf_counter() - start)
+        if self.has_connected:
+            mysql_exporter_reconnects.labels(instance=self.instance).inc()
+            logging.info(f"Reconnected to MySQL for {self.instance}")
+        self.has_connected = True
+
+    def get(self):
+        """
+        Returns an open connection, reconnecting if it was invalidated or went stale while idle.
+        """
+        now = time.monotonic()
+        if self.connection is not None and now - self.last_used >= CONNECTION_HEALTH_CHECK_INTERVAL:
+            try:
+                self.connection.ping(reconnect=False)
+            except mysql.connector.Error:
+                self.invalidate()
+        if self.connection is None:
+            self._connect()
+        self.last_used = now
+        return self.connection
+
+    def invalidate(self):
+        """
+        Drops the current connection so the next get() performs a fresh handshake.
+        """
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+# MySQL error numbers of each failure class of CIRCUIT_BREAKER_BACKOFF
+AUTH_ERRNOS = {1044, 1045, 1698}  # ER_DBACCESS_DENIED_ERROR, ER_ACCESS_DENIED_ERROR, ER_ACCESS_DENIED_NO_PASSWORD_ERROR
+NETWORK_ERRNOS = {2002, 2003, 2005, 2006, 2013, 2055}  # Cannot connect, unknown host, server gone away, lost connection
+
+def classify_error(e):
+    """
+    Returns the failure class of an exception: 'auth', 'network', 'path' or 'other'.
+    """
+    errno = getattr(e, 'errno', None)
+    if errno in AUTH_ERRNOS:
+        return 'auth'
+    if errno in NETWORK_ERRNOS or isinstance(e, (mysql.connector.InterfaceError, TimeoutError, ConnectionError)):
+        return 'network'
+    if isinstance(e, FileNotFoundError):
+        return 'path'
+    return 'other'
+
+class CircuitBreaker:
+    """
+    Exponential backoff with jitter for one failing target of one instance.
+
+    A closed breaker allows every attempt. A failure opens it for a backoff window
+    (see CIRCUIT_BREAKER_BACKOFF) during which allow() returns False, so a broken
+    target costs one attempt, and one log line, per window instead of one per pass.
+    Once the window has passed the breaker is half-open and allows one attempt,
+    whose success closes it and whose failure reopens it for a longer window.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, instance, name):
+        self.instance = instance
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reason = None
+        self.retry_at = 0
+        self.export(0)
+
+    def export(self, backoff):
+        labels = {'instance': self.instance, 'breaker': self.name}
+        mysql_exporter_circuit_state.labels(**labels).set(self.state)
+        mysql_exporter_circuit_consecutive_failures.labels(**labels).set(self.failures)
+        mysql_exporter_circuit_backoff_seconds.labels(**labels).set(backoff)
+
+    def allow(self):
+        """
+        Returns whether the target may be tried now.
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() < self.retry_at:
+                return False
+            self.state = self.HALF_OPEN
+            mysql_exporter_circuit_state.labels(instance=self.instance, breaker=self.name).set(self.state)
+        return True
+
+    def record_success(self):
+        if self.state == self.CLOSED:
+            return
+        logging.info(f"{self.name} of {self.instance} recovered after {self.failures} failed attempts")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reason = None
+        self.export(0)
+
+    def record_failure(self, reason, error):
+        """
+        Opens the breaker for the next backoff window of the failure class.
+        """
+        mysql_exporter_collection_errors.labels(instance=self.instance, breaker=self.name, reason=reason).inc()
+        if reason != self.reason:
+            # A different failure (e.g. the server is back but rejects the password) restarts the backoff
+            self.failures = 0
+            self.reason = reason
+        self.failures += 1
+        first, maximum = CIRCUIT_BREAKER_BACKOFF[reason]
+        backoff = min(maximum, first * 2 ** (self.failures - 1))
+        backoff = random.uniform(backoff / 2, backoff)
+        self.state = self.OPEN
+        self.retry_at = time.monotonic() + backoff
+        self.export(backoff)
+        logging.error(f"{self.name} of {self.instance} failed ({reason}, attempt {self.failures}): {error}; "
+                      f"next attempt in {backoff:.1f}s")
+
+class CircuitBreakers:
+    """
+    The CircuitBreaker of every (instance, target) pair, created on first use.
+    """
+
+    def __init__(self):
+        self.breakers = {}
+        self.lock = Lock()
+
+    def get(self, instance, name):
+        with self.lock:
+            breaker = self.breakers.get((instance, name))
+            if breaker is None:
+                breaker = self.breakers[(instance, name)] = CircuitBreaker(instance, name)
+            return breaker
+
+    def forget(self, instance):
+        with self.lock:
+            for key in [key for key in self.breakers if key[0] == instance]:
+                del self.breakers[key]
+        for metric in (mysql_exporter_circuit_state, mysql_exporter_circuit_consecutive_failures, mysql_exporter_circuit_backoff_seconds):
+            metric.remove_by_labels({'instance': instance})
+
+circuit_breakers = CircuitBreakers()
+
+def data_dir_available(instance, data_dir):
+    """
+    Returns whether a server's data directory can be read, behind the instance's data_dir breaker.
+    """
+    breaker = circuit_breakers.get(instance, 'data_dir')
+    if not breaker.allow():
+        return False
+    if os.path.exists(data_dir):
+        breaker.record_success()
+        return True
+    breaker.record_failure('path', f"data directory {data_dir} does not exist")
+    # Absent rather than a fake 0% until the directory is back
+    mysql_disk_usage_percent.remove_by_labels({'instance': instance})
+    return False
+
+def run_query_plan(plan, cursor):
+    """
+    Drives a collector's query plan on a blocking cursor and returns the number of
+    queries issued.
+
+    A plan is a generator that yields (statement, params) tuples and receives the
+    rows of each statement back, so the same collector code runs on both the
+    threads engine (here) and the asyncio engine (run_query_plan_async).
+    """
+    queries_issued = 0
+    rows = None
+    try:
+        while True:
+            statement, params = plan.send(rows)
+            cursor.execute(statement, params)
+            rows = cursor.fetchall() if cursor.with_rows else []
+            queries_issued += 1
+    except StopIteration:
+        return queries_issued
+
+def run_optional_collector(collector, instance, cursor):
+    """
+    Runs an INSTANCE_COLLECTORS entry and returns the number of queries issued.
+
+    Errors caused by the server lacking a feature or privilege, and any error
+    raised while parsing the results (e.g. an unexpected SHOW ENGINE INNODB STATUS
+    line), are logged and swallowed, so an optional collector cannot mark the
+    whole instance down; connection errors still propagate.
+    """
+    started = time.perf_counter()
+    try:
+        return run_query_plan(collector.plan(instance), cursor)
+    except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+        raise
+    except mysql.connector.Error as e:
+        logging.warning(f"{collector.group} collection failed for {instance}: {e}")
+        return 1
+    except Exception:
+        logging.exception(f"{collector.group} collector failed for {instance}")
+        return 1
+    finally:
+        mysql_exporter_collector_duration_seconds.labels(instance=instance, group=collector.group).set(time.perf_counter() - started)
+
+def snapshot_int(snapshot, name):
+    """
+    Returns a snapshot value as an int, or 0 if it is missing or not numeric.
+    """
+    value = snapshot.get(name)
+    return int(value) if value and value.isdigit() else 0
+
+def snapshot_float(snapshot, name):
+    """
+    Returns a snapshot value as a float, or 0.0 if it is missing or not numeric.
+    """
+    try:
+        return float(snapshot.get(name) or 0)
+    except ValueError:
+        return 0.0
+
+class CounterDeltaStore:
+    """
+    Turns successive raw readings of MySQL's cumulative status variables into
+    increments for Prometheus counters.
+
+    The last raw value of every (instance, variable) pair lives in one flat
+    array('d'), indexed through a dict of slots, so a collection pass allocates
+    nothing per counter once the slots exist. The first reading of a variable
+    advances the counter to the raw value; afterwards it advances by the growth
+    since the previous reading. A reading below the previous one, or a server
+    restart detected from Uptime going backwards, is treated as a counter reset.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.values = array('d')
+        self.free_slots = []
+        self.uptimes = {}
+        self.lock = Lock()
+
+    def observe_uptime(self, instance, uptime):
+        """
+        Records the instance's Uptime and returns True if the server restarted since the last reading.
+        """
+        previous = self.uptimes.get(instance)
+        self.uptimes[instance] = uptime
+        return previous is not None and uptime < previous
+
+    def delta(self, instance, variable, raw, restarted=False):
+        """
+        Returns how much a counter grew since the last reading and stores the new raw value.
+        """
+        key = (instance, variable)
+        slot = self.slots.get(key)
+        if slot is None:
+            # Slots are only allocated under the lock; each slot is then written by one collector
+            with self.lock:
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                    self.values[slot] = raw
+                else:
+                    slot = len(self.values)
+                    self.values.append(raw)
+                self.slots[key] = slot
+            return raw
+        previous = self.values[slot]
+        self.values[slot] = raw
+        if restarted or raw < previous:
+            return raw
+        return raw - previous
+
+    def advance(self, counter, instance, variable, raw, restarted=False):
+        """
+        Increments a labelled counter child by the growth of its status variable.
+        """
+        delta = self.delta(instance, variable, raw, restarted)
+        if delta:
+            counter.inc(delta)
+
+    def forget(self, instance):
+        """
+        Drops the baselines of an instance; its slots are reused by later instances.
+        """
+        with self.lock:
+            for key in [key for key in self.slots if key[0] == instance]:
+                self.free_slots.append(self.slots.pop(key))
+            self.uptimes.pop(instance, None)
+
+# Baselines of every counter fed from SHOW GLOBAL STATUS
+counter_deltas = CounterDeltaStore()
+
+# Built-in types of individual status variables, checked before the name patterns below
+STATUS_VARIABLE_TYPES = {
+    'Uptime': 'gauge',
+    'Uptime_since_flush_status': 'gauge',
+    'Max_used_connections': 'gauge',
+    'Innodb_buffer_pool_bytes_data': 'gauge',
+    'Innodb_buffer_pool_bytes_dirty': 'gauge',
+    'Innodb_row_lock_current_waits': 'gauge',
+    'Innodb_row_lock_time_avg': 'gauge',
+    'Innodb_row_lock_time_max': 'gauge',
+    'Innodb_page_size': 'gauge',
+    'Innodb_redo_log_current_lsn': 'gauge',
+    'Innodb_redo_log_checkpoint_lsn': 'gauge',
+    'Innodb_redo_log_flushed_to_disk_lsn': 'gauge',
+    'Innodb_redo_log_logical_size': 'gauge',
+    'Innodb_redo_log_physical_size': 'gauge',
+    'Innodb_num_open_files': 'gauge',
+    'Innodb_undo_tablespaces_active': 'gauge',
+    'Key_blocks_not_flushed': 'gauge',
+    'Key_blocks_unused': 'gauge',
+    'Key_blocks_used': 'gauge',
+    'Qcache_free_blocks': 'gauge',
+    'Qcache_free_memory': 'gauge',
+    'Qcache_queries_in_cache': 'gauge',
+    'Qcache_total_blocks': 'gauge',
+    'Slave_open_temp_tables': 'gauge',
+    'Replica_open_temp_tables': 'gauge',
+    'Threads_cached': 'gauge',
+    'Threads_connected': 'gauge',
+    'Threads_running': 'gauge',
+    'Prepared_stmt_count': 'gauge',
+    'Not_flushed_delayed_rows': 'gauge',
+    'Delayed_insert_threads': 'gauge',
+    'Binlog_cache_use': 'counter',
+    'Binlog_cache_disk_use': 'counter',
+    'Binlog_stmt_cache_use': 'counter',
+    'Binlog_stmt_cache_disk_use': 'counter',
+    'Innodb_buffer_pool_pages_flushed': 'counter',
+    'Innodb_buffer_pool_wait_free': 'counter',
+    'Innodb_row_lock_time': 'counter',
+    'Innodb_row_lock_waits': 'counter',
+    'Max_execution_time_exceeded': 'counter',
+    'Max_execution_time_set': 'counter',
+    'Max_execution_time_set_failed': 'counter',
+    'Questions': 'counter',
+    'Queries': 'counter',
+    'Slow_queries': 'counter',
+    'Connections': 'counter',
+    'Flush_commands': 'counter',
+}
+
+# Name heuristics, checked in order: point-in-time values first, cumulative counts second
+STATUS_GAUGE_PATTERNS = ['*_current', '*_current_*', '*_pending', '*_pending_*', 'Open_*', 'Innodb_buffer_pool_pages_*',
+                         '*_connected', '*_running', '*_cached', '*_free', '*_size', '*_avg', '*_max', '*_in_use', '*_active']
+STATUS_COUNTER_PATTERNS = ['Com_*', 'Handler_*', 'Select_*', 'Sort_*', 'Bytes_*', 'Created_*', 'Aborted_*',
+                           'Connection_errors_*', 'Innodb_data_*', 'Innodb_rows_*', 'Innodb_pages_*', 'Innodb_log_*',
+                           'Innodb_os_log_*', 'Innodb_dblwr_*', 'Innodb_buffer_pool_read*', 'Innodb_buffer_pool_write*',
+                           'Performance_schema_*_lost', 'Key_*', 'Table_locks_*', 'Table_open_cache_*',
+                           '*_total', '*_count', '*_reads', '*_writes', '*_requests', '*_hits', '*_misses',
+                           '*_inserts', '*_lost', '*_errors', '*_created', '*_opened', '*_deleted', '*_updated',
+                           '*_read', '*_written', '*_fsyncs', '*_waits', '*_timeouts', '*_failures', '*_loops',
+                           '*_retried_transactions', 'Opened_*']
+
+def infer_status_type(name):
+    """
+    Returns 'counter' or 'gauge' for a status variable, or None if it is filtered out.
+    """
+    lowered = name.lower()
+    if not any(fnmatch.fnmatchcase(lowered, pattern.lower()) for pattern in GLOBAL_STATUS_ALLOWLIST):
+        return None
+    if any(fnmatch.fnmatchcase(lowered, pattern.lower()) for pattern in GLOBAL_STATUS_DENYLIST):
+        return None
+    if name in GLOBAL_STATUS_TYPES:
+        return GLOBAL_STATUS_TYPES[name]
+    if name in STATUS_VARIABLE_TYPES:
+        return STATUS_VARIABLE_TYPES[name]
+    if any(fnmatch.fnmatchcase(lowered, pattern.lower()) for pattern in STATUS_GAUGE_PATTERNS):
+        return 'gauge'
+    if any(fnmatch.fnmatchcase(lowered, pattern.lower()) for pattern in STATUS_COUNTER_PATTERNS):
+        return 'counter'
+    # Unknown variables are exported as gauges: a gauge mistyped as a counter would
+    # turn every decrease into a fake reset, while the reverse only loses rate() hints
+    return 'gauge'
+
+def parse_status_value(raw_value):
+    """
+    Returns a status value as a float (ON/YES as 1, OFF/NO as 0), or None if it is not numeric.
+    """
+    if raw_value is None:
+        return None
+    if raw_value.isdigit():
+        return float(raw_value)
+    upper = raw_value.upper()
+    if upper in ('ON', 'YES'):
+        return 1.0
+    if upper in ('OFF', 'NO'):
+        return 0.0
+    try:
+        return float(raw_value)
+    except ValueError:
+        return None
+
+def instance_items(state, instances=None):
+    """
+    Returns the (instance, value) pairs of a per-instance dict, for every instance or
+    only for those in instances, so a collector can render one instance without
+    walking the others.
+    """
+    if instances is None:
+        return list(state.items())
+    return [(instance, state[instance]) for instance in instances if instance in state]
+
+class GlobalStatusCollector:
+    """
+    Table-driven collector that exports every numeric SHOW GLOBAL STATUS variable
+    as mysql_global_status_<variable_name>, typed as a counter or a gauge.
+
+    update() parses a snapshot in a single pass; the type (or exclusion) of each
+    variable name is inferred once and cached. Counters are fed through their
+    own CounterDeltaStore so they stay monotonic across server restarts.
+    """
+
+    metric_prefix = 'mysql_global_status_'
+    help_text = 'MySQL global status variable {}'
+
+    def __init__(self):
+        self.types = {}
+        self.deltas = CounterDeltaStore()
+        self.gauges = {}
+        self.counters = {}
+
+    def update(self, instance, status):
+        """
+        Parses one SHOW GLOBAL STATUS snapshot of an instance.
+        """
+        types = self.types
+        deltas = self.deltas
+        restarted = deltas.observe_uptime(instance, snapshot_int(status, 'Uptime'))
+        gauges = {}
+        counters = self.counters.setdefault(instance, {})
+        for name, raw_value in status.items():
+            metric_type = types.get(name, '')
+            if metric_type == '':
+                metric_type = types[name] = infer_status_type(name)
+            if metric_type is None:
+                continue
+            value = parse_status_value(raw_value)
+            if value is None:
+                continue
+            if metric_type == 'counter':
+                counters[name] = counters.get(name, 0.0) + deltas.delta(instance, name, value, restarted)
             else:
-                # If not a slave, set replication lag and slave threads to 0
-                mysql_replication_lag_seconds.labels(instance=instance).set(0)
-                mysql_slave_io_running.labels(instance=instance).set(0)
-                mysql_slave_sql_running.labels(instance=instance).set(0)
-                mysql_slave_retried_transactions.labels(instance=instance).inc(0)
-
-            # Get InnoDB Buffer Pool Size
-            cursor.execute("SHOW VARIABLES LIKE 'innodb_buffer_pool_size';")
-            result = cursor.fetchone()
-            buffer_pool_size = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_buffer_pool_size.labels(instance=instance).set(buffer_pool_size)
-
-            # Get InnoDB Buffer Pool Used
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_buffer_pool_pages_data';")
-            result = cursor.fetchone()
-            buffer_pool_used_pages = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_buffer_pool_used.labels(instance=instance).set(buffer_pool_used_pages)
-
-            # Get InnoDB Buffer Pool Pages Free
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_buffer_pool_pages_free';")
-            result = cursor.fetchone()
-            buffer_pool_free_pages = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_buffer_pool_pages_free.labels(instance=instance).set(buffer_pool_free_pages)
-
-            # Get InnoDB Row Lock Times
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_time_avg';")
-            result = cursor.fetchone()
-            row_lock_time_avg = float(result['Value']) if result and result['Value'] else 0.0
-            mysql_innodb_row_lock_time_avg.labels(instance=instance).set(row_lock_time_avg)
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_time_max';")
-            result = cursor.fetchone()
-            row_lock_time_max = float(result['Value']) if result and result['Value'] else 0.0
-            mysql_innodb_row_lock_time_max.labels(instance=instance).set(row_lock_time_max)
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_time_total';")
-            result = cursor.fetchone()
-            row_lock_time_total = float(result['Value']) if result and result['Value'] else 0.0
-            mysql_innodb_row_lock_time_total.labels(instance=instance).set(row_lock_time_total)
-
-            # Get InnoDB Transactions
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_transactions';")
-            result = cursor.fetchone()
-            innodb_transactions = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_transactions.labels(instance=instance).set(innodb_transactions)
-
-            # Get InnoDB Read/Write I/O Requests
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_data_reads';")
-            result = cursor.fetchone()
-            innodb_data_reads = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_data_reads.labels(instance=instance).set(innodb_data_reads)
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_data_writes';")
-            result = cursor.fetchone()
-            innodb_data_writes = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_innodb_data_writes.labels(instance=instance).set(innodb_data_writes)
-
-            # Get Query Cache Metrics
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Qcache_size';")
-            result = cursor.fetchone()
-            query_cache_size = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_query_cache_size.labels(instance=instance).set(query_cache_size)
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Qcache_hits';")
-            result = cursor.fetchone()
-            query_cache_hits = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_query_cache_hits.labels(instance=instance).inc(query_cache_hits)
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Qcache_inserts';")
-            result = cursor.fetchone()
-            query_cache_inserts = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_query_cache_misses.labels(instance=instance).inc(query_cache_inserts)  # Adjust accordingly
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Qcache_free_memory';")
-            result = cursor.fetchone()
-            query_cache_free_memory = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_query_cache_free_memory.labels(instance=instance).set(query_cache_free_memory)
-
-            # Get Memory Metrics
-            cursor.execute("SHOW STATUS LIKE 'Max_used_connections';")
-            result = cursor.fetchone()
-            max_used_connections = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_max_memory_usage.labels(instance=instance).set(max_used_connections)
-
-            # Get Disk Usage Metrics
-            if os.path.exists(data_dir):
+                gauges[name] = value
+        self.gauges[instance] = gauges
+
+    def forget(self, instance):
+        self.gauges.pop(instance, None)
+        self.counters.pop(instance, None)
+        self.deltas.forget(instance)
+
+    def reset_types(self):
+        """
+        Forgets the cached type of every name, after a setting it is inferred from was
+        reloaded. Counters restart from their next reading, since a name may have become
+        a gauge or been filtered out.
+        """
+        self.types = {}
+        self.counters = {}
+        self.deltas = CounterDeltaStore()
+
+    def describe(self):
+        return []
+
+    def collect(self, instances=None):
+        families = {}
+        for instance, gauges in instance_items(self.gauges, instances):
+            for name, value in gauges.items():
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(self.metric_prefix + name.lower(), self.help_text.format(name), labels=['instance'])
+                family.add_metric([instance], value)
+        for instance, counters in instance_items(self.counters, instances):
+            for name, value in list(counters.items()):
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = CounterMetricFamily(self.metric_prefix + name.lower(), self.help_text.format(name), labels=['instance'])
+                family.add_metric([instance], value)
+        return families.values()
+
+# Every numeric status variable, exported through the default registry
+global_status_collector = GlobalStatusCollector()
+REGISTRY.register(global_status_collector)
+
+class CommandSeriesGuard:
+    """
+    Bounds the cardinality of mysql_commands.
+
+    Com_% variables that have never been non-zero get no series (and no counter
+    baseline). The first COMMAND_SERIES_LIMIT commands to be used on an instance
+    get their own series, which they keep for good; later ones are added to
+    command="other" and counted in mysql_exporter_dropped_series.
+    """
+
+    def __init__(self):
+        self.emitted = {}
+        self.rolled_up = {}
+
+    def update(self, instance, status, restarted):
+        emitted = self.emitted.setdefault(instance, set())
+        rolled_up = self.rolled_up.setdefault(instance, set())
+        other = 0
+        for command, raw_value in status.items():
+            if not command.startswith('Com_'):
+                continue
+            value = int(raw_value) if raw_value.isdigit() else 0
+            if command in emitted:
+                counter_deltas.advance(mysql_commands.labels(instance=instance, command=command), instance, command, value, restarted)
+            elif command in rolled_up:
+                other += counter_deltas.delta(instance, command, value, restarted)
+            elif value:
+                if len(emitted) < COMMAND_SERIES_LIMIT:
+                    emitted.add(command)
+                    counter_deltas.advance(mysql_commands.labels(instance=instance, command=command), instance, command, value, restarted)
+                else:
+                    rolled_up.add(command)
+                    other += counter_deltas.delta(instance, command, value, restarted)
+        if rolled_up:
+            mysql_commands.labels(instance=instance, command='other').inc(other)
+        mysql_exporter_dropped_series.labels(instance=instance, metric='mysql_commands').set(len(rolled_up))
+
+    def forget(self, instance):
+        self.emitted.pop(instance, None)
+        self.rolled_up.pop(instance, None)
+
+command_series_guard = CommandSeriesGuard()
+
+def update_mysql_metrics(instance, status, variables, slave_status):
+    """
+    Updates every MySQL gauge/counter for an instance from an in-memory snapshot of
+    SHOW GLOBAL STATUS, SHOW GLOBAL VARIABLES and SHOW SLAVE STATUS.
+    """
+    # Set mysql_up to 1 (up)
+    mysql_up.labels(instance=instance).set(1)
+
+    # Counters are advanced by the growth of their status variable since the last
+    # snapshot; a server restart (Uptime going backwards) resets every baseline
+    restarted = counter_deltas.observe_uptime(instance, snapshot_int(status, 'Uptime'))
+
+    # Every other numeric status variable, through the table-driven mapping
+    global_status_collector.update(instance, status)
+
+    # Connections
+    mysql_connections.labels(instance=instance).set(snapshot_int(status, 'Threads_connected'))
+    mysql_max_connections.labels(instance=instance).set(snapshot_int(variables, 'max_connections'))
+
+    # Queries, slow queries and statements executed
+    counter_deltas.advance(mysql_queries_total.labels(instance=instance), instance, 'Queries', snapshot_int(status, 'Queries'), restarted)
+    counter_deltas.advance(mysql_slow_queries.labels(instance=instance), instance, 'Slow_queries', snapshot_int(status, 'Slow_queries'), restarted)
+    counter_deltas.advance(mysql_questions.labels(instance=instance), instance, 'Questions', snapshot_int(status, 'Questions'), restarted)
+
+    # SQL commands executed, one series per Com_% variable in use (see CommandSeriesGuard)
+    command_series_guard.update(instance, status, restarted)
+
+    # Replication lag and slave thread statuses (for slaves)
+    if slave_status:
+        replication_lag = slave_status.get('Seconds_Behind_Master', 0)
+        mysql_replication_lag_seconds.labels(instance=instance).set(float(replication_lag) if replication_lag else 0)
+
+        io_running = 1 if slave_status.get('Slave_IO_Running', '').lower() == 'yes' else 0
+        sql_running = 1 if slave_status.get('Slave_SQL_Running', '').lower() == 'yes' else 0
+        mysql_slave_io_running.labels(instance=instance).set(io_running)
+        mysql_slave_sql_running.labels(instance=instance).set(sql_running)
+
+        # Retried transactions is a status variable (renamed Replica_* in MySQL 8.0.26)
+        retried_transactions = snapshot_int(status, 'Slave_retried_transactions') or snapshot_int(status, 'Replica_retried_transactions')
+        counter_deltas.advance(mysql_slave_retried_transactions.labels(instance=instance), instance, 'Slave_retried_transactions', retried_transactions, restarted)
+
+        # Binlog positions, GTID sets, apply rate and catch-up estimate
+        replication_tracker.update_replica(instance, slave_status)
+    else:
+        # If not a slave, set replication lag and slave threads to 0
+        mysql_replication_lag_seconds.labels(instance=instance).set(0)
+        mysql_slave_io_running.labels(instance=instance).set(0)
+        mysql_slave_sql_running.labels(instance=instance).set(0)
+        mysql_slave_retried_transactions.labels(instance=instance).inc(0)
+        replication_tracker.replicas.discard(instance)
+
+    # InnoDB buffer pool
+    mysql_innodb_buffer_pool_size.labels(instance=instance).set(snapshot_int(variables, 'innodb_buffer_pool_size'))
+    buffer_pool_pages_data = snapshot_int(status, 'Innodb_buffer_pool_pages_data')
+    mysql_innodb_buffer_pool_used.labels(instance=instance).set(buffer_pool_pages_data)
+    mysql_innodb_buffer_pool_pages_data.labels(instance=instance).set(buffer_pool_pages_data)
+    mysql_innodb_buffer_pool_pages_free.labels(instance=instance).set(snapshot_int(status, 'Innodb_buffer_pool_pages_free'))
+
+    # InnoDB row lock times
+    mysql_innodb_row_lock_time_avg.labels(instance=instance).set(snapshot_float(status, 'Innodb_row_lock_time_avg'))
+    mysql_innodb_row_lock_time_max.labels(instance=instance).set(snapshot_float(status, 'Innodb_row_lock_time_max'))
+    mysql_innodb_row_lock_time_total.labels(instance=instance).set(snapshot_float(status, 'Innodb_row_lock_time'))
+
+    # InnoDB transactions and data reads/writes
+    mysql_innodb_transactions.labels(instance=instance).set(snapshot_int(status, 'Innodb_transactions'))
+    mysql_innodb_data_reads.labels(instance=instance).set(snapshot_int(status, 'Innodb_data_reads'))
+    mysql_innodb_data_writes.labels(instance=instance).set(snapshot_int(status, 'Innodb_data_writes'))
+
+    # Query cache (query_cache_size is a server variable, the rest are status variables)
+    mysql_query_cache_size.labels(instance=instance).set(snapshot_int(variables, 'query_cache_size'))
+    counter_deltas.advance(mysql_query_cache_hits.labels(instance=instance), instance, 'Qcache_hits', snapshot_int(status, 'Qcache_hits'), restarted)
+    counter_deltas.advance(mysql_query_cache_misses.labels(instance=instance), instance, 'Qcache_inserts', snapshot_int(status, 'Qcache_inserts'), restarted)  # Adjust accordingly
+    mysql_query_cache_free_memory.labels(instance=instance).set(snapshot_int(status, 'Qcache_free_memory'))
+
+    # Memory
+    mysql_max_memory_usage.labels(instance=instance).set(snapshot_int(status, 'Max_used_connections'))
+
+    # Uptime
+    mysql_uptime_seconds.labels(instance=instance).set(snapshot_int(status, 'Uptime'))
+
+    # Temporary tables
+    counter_deltas.advance(mysql_tmp_tables.labels(instance=instance), instance, 'Created_tmp_tables', snapshot_int(status, 'Created_tmp_tables'), restarted)
+    counter_deltas.advance(mysql_tmp_disk_tables.labels(instance=instance), instance, 'Created_tmp_disk_tables', snapshot_int(status, 'Created_tmp_disk_tables'), restarted)
+    mysql_tmp_table_size.labels(instance=instance).set(snapshot_int(variables, 'tmp_table_size'))
+
+    # Handler
+    counter_deltas.advance(mysql_handler_read_rnd_next.labels(instance=instance), instance, 'Handler_read_rnd_next', snapshot_int(status, 'Handler_read_rnd_next'), restarted)
+
+    # Performance Schema
+    counter_deltas.advance(mysql_perf_schema_events_waits.labels(instance=instance), instance, 'Performance_schema_events_waits_current', snapshot_int(status, 'Performance_schema_events_waits_current'), restarted)
+    counter_deltas.advance(mysql_perf_schema_events_statements.labels(instance=instance), instance, 'Performance_schema_events_statements_current', snapshot_int(status, 'Performance_schema_events_statements_current'), restarted)
+
+class StatementDigestCollector:
+    """
+    Collector over performance_schema.events_statements_summary_by_digest that
+    exports the STATEMENT_DIGEST_TOP_N most expensive digests per instance.
+
+    Each pass computes per-digest deltas against the previous pass, ranks the
+    digests by STATEMENT_DIGEST_ORDER_BY and adds the deltas of the top N to
+    their counters; everything else is summed into digest="other", so the number
+    of series stays bounded. Digest texts are fetched only for digests that are
+    not in the shared text cache yet.
+    """
+
+    group = 'statement_digests'
+
+    def __init__(self):
+        self.previous = {}
+        self.totals = {}
+        self.texts = OrderedDict()
+        self.lock = Lock()
+
+    def plan(self, instance):
+        rows = yield ("SELECT SCHEMA_NAME, DIGEST, COUNT_STAR, SUM_TIMER_WAIT, SUM_ROWS_EXAMINED, SUM_ROWS_SENT "
+                      "FROM performance_schema.events_statements_summary_by_digest;", None)
+        previous = self.previous.get(instance, {})
+        current = {}
+        deltas = []
+        for row in rows:
+            key = (row['SCHEMA_NAME'] or '', row['DIGEST'] or 'other')
+            values = (int(row['COUNT_STAR']), int(row['SUM_TIMER_WAIT']), int(row['SUM_ROWS_EXAMINED']), int(row['SUM_ROWS_SENT']))
+            current[key] = values
+            last = previous.get(key)
+            if last is None or values[0] < last[0]:
+                # New digest, or the summary table was truncated
+                last = (0, 0, 0, 0)
+            if values[0] != last[0]:
+                deltas.append((key, values[0] - last[0], values[1] - last[1], values[2] - last[2], values[3] - last[3]))
+        first_pass = instance not in self.previous
+        self.previous[instance] = current
+        if first_pass:
+            # The first pass only establishes baselines; the whole history is not "last interval" load
+            return
+
+        rank = 2 if STATEMENT_DIGEST_ORDER_BY == 'time' else 3
+        top = heapq.nlargest(STATEMENT_DIGEST_TOP_N, deltas, key=lambda delta: delta[rank])
+        top_keys = {delta[0] for delta in top}
+
+        missing = [key[1] for key in top_keys if key[1] != 'other' and key[1] not in self.texts]
+        if missing:
+            placeholders = ', '.join(['%s'] * len(missing))
+            text_rows = yield (f"SELECT DISTINCT DIGEST, DIGEST_TEXT FROM performance_schema.events_statements_summary_by_digest "
+                               f"WHERE DIGEST IN ({placeholders});", tuple(missing))
+        else:
+            text_rows = []
+        # The text cache is shared by every instance's collector thread
+        with self.lock:
+            for row in text_rows:
+                self.texts[row['DIGEST']] = (row['DIGEST_TEXT'] or '')[:200]
+            for key in top_keys:
+                if key[1] in self.texts:
+                    self.texts.move_to_end(key[1])
+            while len(self.texts) > STATEMENT_DIGEST_TEXT_CACHE_SIZE:
+                self.texts.popitem(last=False)
+
+        # Digests that left the top N are dropped; "other" keeps accumulating
+        old_totals = self.totals.get(instance, {})
+        other_key = ('', 'other')
+        totals = {key: old_totals.get(key, [0, 0, 0, 0]) for key in top_keys}
+        totals[other_key] = old_totals.get(other_key, [0, 0, 0, 0])
+        for key, calls, timer_wait, rows_examined, rows_sent in deltas:
+            total = totals[key] if key in top_keys else totals[other_key]
+            total[0] += calls
+            total[1] += timer_wait
+            total[2] += rows_examined
+            total[3] += rows_sent
+        self.totals[instance] = totals
+
+    def forget(self, instance):
+        self.previous.pop(instance, None)
+        self.totals.pop(instance, None)
+
+    def describe(self):
+        return []
+
+    def collect(self, instances=None):
+        calls = CounterMetricFamily('mysql_perf_schema_digest_calls', 'Statements executed per digest (top N digests, the rest in digest="other")', labels=['instance', 'schema', 'digest'])
+        seconds = CounterMetricFamily('mysql_perf_schema_digest_seconds', 'Statement execution time per digest in seconds', labels=['instance', 'schema', 'digest'])
+        rows_examined = CounterMetricFamily('mysql_perf_schema_digest_rows_examined', 'Rows examined per digest', labels=['instance', 'schema', 'digest'])
+        rows_sent = CounterMetricFamily('mysql_perf_schema_digest_rows_sent', 'Rows sent per digest', labels=['instance', 'schema', 'digest'])
+        info = GaugeMetricFamily('mysql_perf_schema_digest_info', 'Normalized statement text of each exported digest', labels=['instance', 'schema', 'digest', 'digest_text'])
+        for instance, totals in instance_items(self.totals, instances):
+            for (schema, digest), total in list(totals.items()):
+                labels = [instance, schema, digest]
+                calls.add_metric(labels, total[0])
+                seconds.add_metric(labels, total[1] / 1e12)  # Timer columns are in picoseconds
+                rows_examined.add_metric(labels, total[2])
+                rows_sent.add_metric(labels, total[3])
+                text = self.texts.get(digest)
+                if text is not None:
+                    info.add_metric(labels + [text], 1)
+        return [calls, seconds, rows_examined, rows_sent, info]
+
+class HeartbeatWriter:
+    """
+    Writes heartbeat rows on the heartbeat master and remembers recent write times.
+
+    Each write is a single-row upsert of the exporter's own clock, in microseconds.
+    Because the write history is kept in memory, a replica's lag can be measured
+    against the oldest heartbeat it has not applied yet, instead of being rounded
+    up by a whole write interval, and without trusting the servers' clocks.
+    """
+
+    def __init__(self, history=4096):
+        self.writes = deque(maxlen=history)
+        self.lock = Lock()
+
+    def record(self, ts_us):
+        with self.lock:
+            self.writes.append(ts_us)
+
+    def lag_seconds(self, replica_ts_us, now_us):
+        """
+        Returns the replication lag of a replica whose heartbeat row holds replica_ts_us.
+        """
+        with self.lock:
+            if self.writes and replica_ts_us >= self.writes[-1]:
+                return 0.0
+            # The replica is missing every heartbeat written after the one it holds
+            index = bisect.bisect_right(self.writes, replica_ts_us)
+            missing_since = self.writes[index] if index < len(self.writes) else replica_ts_us
+        return max(0.0, (now_us - missing_since) / 1e6)
+
+    def run(self, server, stop=None):
+        """
+        Heartbeat write loop for the HEARTBEAT_MASTER server, until stop is set.
+        """
+        stop = stop or Event()
+        instance = server['instance']
+        mysql_connection = InstanceConnection(server)
+        breaker = circuit_breakers.get(instance, 'heartbeat')
+        table_ready = False
+        while not stop.is_set():
+            if not breaker.allow():
+                stop.wait(HEARTBEAT_INTERVAL_MS / 1000)
+                continue
+            try:
+                cursor = mysql_connection.get().cursor()
+                if not table_ready:
+                    cursor.execute(f"CREATE TABLE IF NOT EXISTS {HEARTBEAT_TABLE} ("
+                                   "id TINYINT UNSIGNED NOT NULL PRIMARY KEY, ts_us BIGINT UNSIGNED NOT NULL) ENGINE=InnoDB;")
+                    table_ready = True
+                ts_us = time.time_ns() // 1000
+                cursor.execute(f"INSERT INTO {HEARTBEAT_TABLE} (id, ts_us) VALUES (1, %s) "
+                               "ON DUPLICATE KEY UPDATE ts_us = VALUES(ts_us);", (ts_us,))
+                cursor.close()
+                self.record(ts_us)
+                mysql_exporter_heartbeat_writes.labels(instance=instance).inc()
+                breaker.record_success()
+            except mysql.connector.Error as e:
+                mysql_connection.invalidate()
+                breaker.record_failure(classify_error(e), e)
+            stop.wait(HEARTBEAT_INTERVAL_MS / 1000)
+        mysql_connection.invalidate()
+
+heartbeat_writer = HeartbeatWriter()
+
+class HeartbeatCollector:
+    """
+    Reads the heartbeat row back on replicas (the instances with a SHOW SLAVE STATUS
+    row, see ReplicationTracker) other than HEARTBEAT_MASTER and sets
+    mysql_heartbeat_lag_seconds. Standalone servers have no heartbeat table to read;
+    an instance that stops replicating loses its lag series.
+    """
+
+    group = 'heartbeat'
+
+    def __init__(self):
+        self.exported = set()
+
+    def plan(self, instance):
+        if not HEARTBEAT_ENABLED or instance == HEARTBEAT_MASTER or instance not in replication_tracker.replicas:
+            if instance in self.exported:
+                self.forget(instance)
+                mysql_heartbeat_lag_seconds.remove_by_labels({'instance': instance})
+            return
+        rows = yield (f"SELECT ts_us FROM {HEARTBEAT_TABLE} WHERE id = 1;", None)
+        if rows:
+            lag = heartbeat_writer.lag_seconds(int(rows[0]['ts_us']), time.time_ns() // 1000)
+            mysql_heartbeat_lag_seconds.labels(instance=instance).set(lag)
+            self.exported.add(instance)
+
+    def forget(self, instance):
+        self.exported.discard(instance)
+
+def count_gtid_set(gtid_set):
+    """
+    Returns the number of transactions in a GTID set such as 'uuid:1-100:205,uuid2:1-7'.
+    """
+    total = 0
+    for uuid_set in (gtid_set or '').replace('\n', '').split(','):
+        for interval in uuid_set.split(':')[1:]:
+            if not interval or not interval[0].isdigit():
+                continue  # Tagged GTIDs (MySQL 8.3+) carry a tag before their intervals
+            start, _, end = interval.partition('-')
+            total += int(end or start) - int(start) + 1
+    return total
+
+def binlog_file_number(file_name):
+    """
+    Returns the numeric suffix of a binary log file name ('master-bin.000042' -> 42).
+    """
+    suffix = (file_name or '').rpartition('.')[2]
+    return int(suffix) if suffix.isdigit() else 0
+
+class ReplicationTracker:
+    """
+    Turns successive SHOW MASTER STATUS / SHOW SLAVE STATUS snapshots into
+    backlog, apply-rate and catch-up estimates.
+
+    Binlog coordinates are linearized as file_number * max_binlog_size + position,
+    so backlogs and rates stay meaningful across binlog rotation (backlogs that
+    span files are approximate, since files are rotated at roughly
+    max_binlog_size). Replicas need nothing beyond the SHOW SLAVE STATUS row the
+    exporter already reads; the source side comes from MasterStatusCollector.
+    """
+
+    # Weight of the newest sample in the smoothed rates
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self):
+        self.masters = {}
+        self.replicas = set()
+        self.previous = {}
+        self.rates = {}
+
+    def update_master(self, instance, master_status):
+        variables = instance_variables.get(instance, {})
+        max_binlog_size = snapshot_int(variables, 'max_binlog_size') or 1073741824
+        file_number = binlog_file_number(master_status.get('File'))
+        position = int(master_status.get('Position') or 0)
+        gtid_executed = count_gtid_set(master_status.get('Executed_Gtid_Set'))
+        self.masters[instance] = {
+            'host_port': (variables.get('hostname'), snapshot_int(variables, 'port')),
+            'offset': file_number * max_binlog_size + position,
+            'max_binlog_size': max_binlog_size,
+            'gtid_executed': gtid_executed,
+        }
+        mysql_master_binlog_file_number.labels(instance=instance).set(file_number)
+        mysql_master_binlog_position.labels(instance=instance).set(position)
+        mysql_master_gtid_executed_transactions.labels(instance=instance).set(gtid_executed)
+
+    def master_for(self, slave_status):
+        """
+        Returns the tracked source of a replica, matched on Master_Port (and Master_Host
+        where it matches the source's hostname); falls back to the only tracked source.
+        """
+        port = int(slave_status.get('Master_Port') or 0)
+        host = slave_status.get('Master_Host')
+        candidates = [master for master in self.masters.values() if master['host_port'][1] == port]
+        for master in candidates:
+            if master['host_port'][0] == host:
+                return master
+        if len(candidates) == 1:
+            return candidates[0]
+        if len(self.masters) == 1:
+            return next(iter(self.masters.values()))
+        return None
+
+    def update_replica(self, instance, slave_status):
+        self.replicas.add(instance)
+        master = self.master_for(slave_status)
+        max_binlog_size = master['max_binlog_size'] if master else 1073741824
+
+        read_file = binlog_file_number(slave_status.get('Master_Log_File'))
+        read_position = int(slave_status.get('Read_Master_Log_Pos') or 0)
+        exec_file = binlog_file_number(slave_status.get('Relay_Master_Log_File'))
+        exec_position = int(slave_status.get('Exec_Master_Log_Pos') or 0)
+        read_offset = read_file * max_binlog_size + read_position
+        exec_offset = exec_file * max_binlog_size + exec_position
+        mysql_slave_read_master_log_file_number.labels(instance=instance).set(read_file)
+        mysql_slave_read_master_log_position.labels(instance=instance).set(read_position)
+        mysql_slave_exec_master_log_file_number.labels(instance=instance).set(exec_file)
+        mysql_slave_exec_master_log_position.labels(instance=instance).set(exec_position)
+        mysql_slave_relay_log_space.labels(instance=instance).set(int(slave_status.get('Relay_Log_Space') or 0))
+
+        apply_backlog = max(0, read_offset - exec_offset)
+        fetch_backlog = max(0, master['offset'] - read_offset) if master else 0
+        backlog = apply_backlog + fetch_backlog
+        mysql_replication_apply_backlog_bytes.labels(instance=instance).set(apply_backlog)
+        mysql_replication_fetch_backlog_bytes.labels(instance=instance).set(fetch_backlog)
+
+        retrieved_gtid_set = slave_status.get('Retrieved_Gtid_Set')
+        executed_gtid_set = slave_status.get('Executed_Gtid_Set')
+        if retrieved_gtid_set or executed_gtid_set:
+            executed = count_gtid_set(executed_gtid_set)
+            mysql_slave_gtid_retrieved_transactions.labels(instance=instance).set(count_gtid_set(retrieved_gtid_set))
+            mysql_slave_gtid_executed_transactions.labels(instance=instance).set(executed)
+            if master and master['gtid_executed']:
+                mysql_replication_transactions_behind.labels(instance=instance).set(max(0, master['gtid_executed'] - executed))
+
+        # Rates from the previous snapshot of this replica
+        now = time.monotonic()
+        previous = self.previous.get(instance)
+        self.previous[instance] = (now, exec_offset, backlog)
+        if previous is None or now <= previous[0]:
+            return
+        elapsed = now - previous[0]
+        apply_rate = max(0.0, (exec_offset - previous[1]) / elapsed)
+        backlog_change = (backlog - previous[2]) / elapsed
+        smoothed = self.rates.get(instance)
+        if smoothed is not None:
+            apply_rate = smoothed[0] + self.RATE_SMOOTHING * (apply_rate - smoothed[0])
+            backlog_change = smoothed[1] + self.RATE_SMOOTHING * (backlog_change - smoothed[1])
+        self.rates[instance] = (apply_rate, backlog_change)
+        mysql_replication_apply_rate_bytes.labels(instance=instance).set(apply_rate)
+        mysql_replication_backlog_change_rate_bytes.labels(instance=instance).set(backlog_change)
+        if backlog == 0:
+            eta = 0
+        elif backlog_change < 0:
+            eta = backlog / -backlog_change
+        else:
+            eta = -1
+        mysql_replication_catchup_eta_seconds.labels(instance=instance).set(eta)
+
+    def forget(self, instance):
+        self.masters.pop(instance, None)
+        self.replicas.discard(instance)
+        self.previous.pop(instance, None)
+        self.rates.pop(instance, None)
+
+replication_tracker = ReplicationTracker()
+
+class MasterStatusCollector:
+    """
+    Reads SHOW MASTER STATUS on instances that write a binary log and are not
+    replicas themselves, for the source side of ReplicationTracker.
+    """
+
+    group = 'master_status'
+
+    def plan(self, instance):
+        if instance in replication_tracker.replicas or instance_variables.get(instance, {}).get('log_bin') == 'OFF':
+            return
+        rows = yield ("SHOW MASTER STATUS;", None)
+        if rows:
+            replication_tracker.update_master(instance, rows[0])
+
+# InnoDB monitor modules/counters switched on with SET GLOBAL innodb_monitor_enable the first
+# time each instance is collected, e.g. ['module_buffer', 'module_log', 'module_purge',
+# 'module_undo', 'module_adaptive_hash'] (needs SYSTEM_VARIABLES_ADMIN or SUPER). Every
+# counter that is enabled on the server is exported either way.
+INNODB_METRICS_ENABLE = []
+
+# INNODB_METRICS counters that are levels rather than running totals and are exported as
+# gauges whatever their TYPE (case-insensitive fnmatch patterns). Only TYPE 'value' marks a
+# level reliably; 'counter' and 'status_counter' rows such as os_pending_reads,
+# trx_active_transactions or lock_row_lock_current_waits go down as well.
+INNODB_METRICS_GAUGES = ['*_pending_*', '*_current_*', '*_active_*', 'ddl_*', 'trx_undo_slots_*',
+                         'buffer_pool_size', 'buffer_pool_pages_total', 'buffer_pool_pages_data', 'buffer_pool_pages_dirty',
+                         'buffer_pool_pages_free', 'buffer_pool_pages_misc', 'buffer_pool_bytes_data', 'buffer_pool_bytes_dirty',
+                         'innodb_page_size', 'lock_threads_waiting', 'file_num_open_files', 'trx_rseg_current_size']
+
+# Lines of the LATEST DETECTED DEADLOCK section kept for the log
+INNODB_DEADLOCK_LOG_LINES = 40
+
+# Values read from SHOW ENGINE INNODB STATUS: per section, a pattern matched at the start of
+# each line and the result key of its number. Every field has its own pattern, since the
+# layout of these lines differs between versions (e.g. 'Pending flushes (fsync) log: 0;
+# buffer pool: 0' on 5.7 and 8.0, 'Pending flushes (fsync): 0' on later 8.x); a field a
+# server does not print is simply absent from the result.
+INNODB_STATUS_FIELDS = {
+    'TRANSACTIONS': [
+        (re.compile(r'History list length (\d+)'), 'history_list_length'),
+    ],
+    'LOG': [
+        (re.compile(r'Log sequence number\s+(\d+)'), 'log_sequence_number'),
+        (re.compile(r'Last checkpoint at\s+(\d+)'), 'last_checkpoint'),
+        (re.compile(r'(\d+) pending log flushes'), 'pending_log_flushes'),
+    ],
+    'FILE I/O': [
+        (re.compile(r'Pending flushes \(fsync\) log: (\d+)'), 'pending_fsync_log'),
+        (re.compile(r'Pending flushes \(fsync\).*buffer pool: (\d+)'), 'pending_fsync_buffer_pool'),
+        (re.compile(r'Pending flushes \(fsync\): (\d+)'), 'pending_fsync_all'),
+    ],
+    'BUFFER POOL AND MEMORY': [
+        (re.compile(r'Pending writes: LRU (\d+)'), 'pending_writes_lru'),
+        (re.compile(r'Pending writes:.*flush list (\d+)'), 'pending_writes_flush_list'),
+        (re.compile(r'Pending writes:.*single page (\d+)'), 'pending_writes_single_page'),
+    ],
+    'SEMAPHORES': [
+        (re.compile(r'OS WAIT ARRAY INFO: reservation count (\d+)'), 'os_wait_reservations'),
+    ],
+}
+
+class InnodbStatusParser:
+    """
+    Single-pass streaming parser for the output of SHOW ENGINE INNODB STATUS.
+
+    A section title is a line framed by two lines of dashes, so every line is
+    handled one line late: only then is it known whether it was a title or
+    content. The state is just the current section and that one held line; each
+    content line is matched against the few INNODB_STATUS_FIELDS patterns of its
+    section, one per value, so a line in an unexpected format only loses its own
+    values.
+    The LATEST DETECTED DEADLOCK section is hashed incrementally (and its first
+    INNODB_DEADLOCK_LOG_LINES lines kept) so a deadlock can be deduplicated.
+    """
+
+    def __init__(self):
+        self.result = {}
+        self.section = None
+        self.held = None
+        self.held_after_dashes = False
+        self.after_dashes = False
+        self.deadlock = None
+        self.deadlock_lines = []
+
+    def feed(self, line):
+        dashes = len(line) >= 3 and line.strip('-') == ''
+        closes_title = False
+        if self.held is not None:
+            if self.held_after_dashes and dashes:
+                self.start_section(self.held)
+                closes_title = True
+            else:
+                self.handle(self.held)
+        self.held = None if dashes else line
+        self.held_after_dashes = self.after_dashes
+        # Dashes that close a title cannot also open the next one
+        self.after_dashes = dashes and not closes_title
+
+    def close(self):
+        """
+        Handles the last held line and returns the parsed values.
+        """
+        if self.held is not None:
+            self.handle(self.held)
+            self.held = None
+        if self.deadlock is not None:
+            self.result['deadlock_hash'] = self.deadlock.hexdigest()
+            self.result['deadlock_lines'] = self.deadlock_lines
+        return self.result
+
+    def start_section(self, title):
+        self.section = title
+        if title == 'LATEST DETECTED DEADLOCK':
+            self.deadlock = hashlib.sha1()
+
+    def handle(self, line):
+        section = self.section
+        if section == 'LATEST DETECTED DEADLOCK':
+            self.deadlock.update(line.encode('utf-8', 'replace'))
+            if len(self.deadlock_lines) < INNODB_DEADLOCK_LOG_LINES:
+                self.deadlock_lines.append(line)
+            return
+        if section == 'SEMAPHORES' and line.startswith('--Thread'):
+            self.result['semaphore_waits'] = self.result.get('semaphore_waits', 0) + 1
+            return
+        for pattern, key in INNODB_STATUS_FIELDS.get(section, ()):
+            match = pattern.match(line)
+            if match:
+                self.result[key] = int(match.group(1))
+
+def parse_innodb_status(text):
+    """
+    Parses SHOW ENGINE INNODB STATUS output line by line with InnodbStatusParser.
+    """
+    parser = InnodbStatusParser()
+    for line in io.StringIO(text):
+        parser.feed(line.rstrip('\n'))
+    return parser.close()
+
+class InnodbStatusCollector:
+    """
+    Exports the parts of SHOW ENGINE INNODB STATUS that SHOW GLOBAL STATUS lacks:
+    history list length, checkpoint age, pending flushes/writes, semaphore waits
+    and new deadlocks (each one counted and logged once).
+    """
+
+    group = 'innodb_status'
+
+    def __init__(self):
+        self.deadlock_hashes = {}
+
+    def plan(self, instance):
+        rows = yield ("SHOW ENGINE INNODB STATUS;", None)
+        if not rows:
+            return
+        parsed = parse_innodb_status(rows[0]['Status'])
+        if 'history_list_length' in parsed:
+            mysql_innodb_history_list_length.labels(instance=instance).set(parsed['history_list_length'])
+        if 'log_sequence_number' in parsed and 'last_checkpoint' in parsed:
+            mysql_innodb_checkpoint_age_bytes.labels(instance=instance).set(parsed['log_sequence_number'] - parsed['last_checkpoint'])
+        if 'pending_log_flushes' in parsed:
+            mysql_innodb_pending_log_flushes.labels(instance=instance).set(parsed['pending_log_flushes'])
+        for target in ('log', 'buffer_pool', 'all'):
+            if f'pending_fsync_{target}' in parsed:
+                mysql_innodb_pending_fsyncs.labels(instance=instance, target=target).set(parsed[f'pending_fsync_{target}'])
+        for write_type in ('lru', 'flush_list', 'single_page'):
+            if f'pending_writes_{write_type}' in parsed:
+                mysql_innodb_pending_writes.labels(instance=instance, type=write_type).set(parsed[f'pending_writes_{write_type}'])
+        mysql_innodb_semaphore_waits.labels(instance=instance).set(parsed.get('semaphore_waits', 0))
+        if 'os_wait_reservations' in parsed:
+            counter_deltas.advance(mysql_innodb_os_wait_reservations.labels(instance=instance), instance, 'innodb_status:os_wait_reservations', parsed['os_wait_reservations'])
+
+        deadlock_hash = parsed.get('deadlock_hash')
+        if deadlock_hash is not None and deadlock_hash != self.deadlock_hashes.get(instance):
+            # The deadlock already on the server when the exporter starts is only used as a baseline
+            if instance in self.deadlock_hashes:
+                mysql_innodb_deadlocks_detected.labels(instance=instance).inc()
+                logging.warning(f"New InnoDB deadlock on {instance}:\n" + "\n".join(parsed['deadlock_lines']))
+            self.deadlock_hashes[instance] = deadlock_hash
+        else:
+            mysql_innodb_deadlocks_detected.labels(instance=instance).inc(0)
+
+    def forget(self, instance):
+        self.deadlock_hashes.pop(instance, None)
+
+class InnodbMetricsCollector(GlobalStatusCollector):
+    """
+    Exports every enabled counter of information_schema.INNODB_METRICS, read in
+    one query, as mysql_innodb_metrics_<name>.
+
+    Counters whose TYPE is 'value' or whose name matches INNODB_METRICS_GAUGES are
+    gauges; every other counter is cumulative and goes through the same
+    CounterDeltaStore machinery as the status counters (a drop, e.g. after
+    innodb_monitor_reset or a restart, is a counter reset). The type of each name
+    is decided once and cached.
+    """
+
+    group = 'innodb_metrics'
+    metric_prefix = 'mysql_innodb_metrics_'
+    help_text = 'InnoDB metrics counter {}'
+
+    def __init__(self):
+        super().__init__()
+        self.modules_enabled = set()
+
+    def plan(self, instance):
+        if INNODB_METRICS_ENABLE and instance not in self.modules_enabled:
+            self.modules_enabled.add(instance)
+            for module in INNODB_METRICS_ENABLE:
+                yield ("SET GLOBAL innodb_monitor_enable = %s;", (module,))
+            logging.info(f"Enabled InnoDB monitor counters on {instance}: {', '.join(INNODB_METRICS_ENABLE)}")
+        rows = yield ("SELECT NAME, TYPE, COUNT FROM information_schema.INNODB_METRICS WHERE STATUS = 'enabled';", None)
+        types = self.types
+        deltas = self.deltas
+        gauges = {}
+        counters = self.counters.setdefault(instance, {})
+        for row in rows:
+            name = row['NAME']
+            value = float(row['COUNT'] or 0)
+            metric_type = types.get(name)
+            if metric_type is None:
+                metric_type = types[name] = self.infer_type(name, row['TYPE'])
+            if metric_type == 'gauge':
+                gauges[name] = value
+            else:
+                counters[name] = counters.get(name, 0.0) + deltas.delta(instance, name, value)
+        self.gauges[instance] = gauges
+
+    @staticmethod
+    def infer_type(name, counter_type):
+        """
+        Returns 'gauge' or 'counter' for an INNODB_METRICS row.
+        """
+        lowered = name.lower()
+        if counter_type == 'value' or any(fnmatch.fnmatchcase(lowered, pattern.lower()) for pattern in INNODB_METRICS_GAUGES):
+            return 'gauge'
+        return 'counter'
+
+    def forget(self, instance):
+        super().forget(instance)
+        self.modules_enabled.discard(instance)
+
+# COMMAND and STATE values exported by the processlist collector. Anything else is
+# counted as 'other', so the number of series per instance is fixed.
+PROCESSLIST_COMMANDS = ('Sleep', 'Query', 'Execute', 'Prepare', 'Fetch', 'Close stmt', 'Reset stmt', 'Long Data',
+                        'Connect', 'Connect Out', 'Binlog Dump', 'Binlog Dump GTID', 'Register Slave', 'Daemon',
+                        'Killed', 'Init DB', 'Field List', 'Change user', 'Set option', 'Ping', 'Statistics',
+                        'Processlist', 'Refresh', 'Quit', 'other')
+PROCESSLIST_STATES = ('', 'starting', 'init', 'checking permissions', 'Opening tables', 'System lock', 'optimizing',
+                      'statistics', 'preparing', 'executing', 'Sending data', 'Sending to client', 'Sorting result',
+                      'Creating sort index', 'Creating tmp table', 'Copying to tmp table', 'converting HEAP to ondisk',
+                      'update', 'updating', 'Searching rows for update', 'query end', 'waiting for handler commit',
+                      'closing tables', 'freeing items', 'cleaning up', 'Waiting for table metadata lock',
+                      'Waiting for table level lock', 'Waiting for global read lock', 'Waiting for commit lock',
+                      'Waiting for table flush', 'altering table', 'copy to tmp table', 'User sleep', 'Killed',
+                      'other')
+
+class ProcesslistCollector:
+    """
+    Collector over a snapshot of the processlist, read in one query together with
+    the start time of each thread's open InnoDB transaction.
+
+    Exports thread counts by command and by state, the age of the oldest running
+    query and of the oldest open transaction, and the distribution of running query
+    ages as a gauge histogram. Rows are folded into fixed-size arrays in a single
+    pass; query text is never read, let alone used as a label.
+    """
+
+    group = 'processlist'
+
+    def __init__(self):
+        self.command_index = {command: i for i, command in enumerate(PROCESSLIST_COMMANDS)}
+        self.state_index = {state: i for i, state in enumerate(PROCESSLIST_STATES)}
+        self.snapshots = {}
+
+    def plan(self, instance):
+        rows = yield (f"SELECT p.COMMAND, p.STATE, p.TIME, TIMESTAMPDIFF(SECOND, t.trx_started, NOW()) AS TRX_AGE "
+                      f"FROM {PROCESSLIST_TABLE} p LEFT JOIN information_schema.INNODB_TRX t ON t.trx_mysql_thread_id = p.ID "
+                      f"WHERE p.ID <> CONNECTION_ID();", None)
+        command_index, state_index = self.command_index, self.state_index
+        other_command, other_state = len(PROCESSLIST_COMMANDS) - 1, len(PROCESSLIST_STATES) - 1
+        bounds = PROCESSLIST_AGE_BUCKETS
+        commands = array('l', [0]) * len(PROCESSLIST_COMMANDS)
+        states = array('l', [0]) * len(PROCESSLIST_STATES)
+        ages = array('l', [0]) * (len(bounds) + 1)
+        age_sum = 0
+        oldest_query = 0
+        oldest_transaction = 0
+        for row in rows:
+            command = row['COMMAND']
+            commands[command_index.get(command, other_command)] += 1
+            states[state_index.get(row['STATE'] or '', other_state)] += 1
+            if command == 'Query' or command == 'Execute':
+                age = row['TIME'] or 0
+                ages[bisect.bisect_left(bounds, age)] += 1
+                age_sum += age
+                if age > oldest_query:
+                    oldest_query = age
+            trx_age = row['TRX_AGE']
+            if trx_age is not None and trx_age > oldest_transaction:
+                oldest_transaction = trx_age
+        # Replaced as a whole so a concurrent scrape never sees a half-filled snapshot; the bucket
+        # bounds are kept with it, since PROCESSLIST_AGE_BUCKETS may be reloaded in between
+        self.snapshots[instance] = (bounds, commands, states, ages, age_sum, oldest_query, oldest_transaction)
+
+    def forget(self, instance):
+        self.snapshots.pop(instance, None)
+
+    def describe(self):
+        return []
+
+    def collect(self, instances=None):
+        by_command = GaugeMetricFamily('mysql_processlist_threads_by_command', 'Threads by processlist COMMAND', labels=['instance', 'command'])
+        by_state = GaugeMetricFamily('mysql_processlist_threads_by_state', 'Threads by processlist STATE', labels=['instance', 'state'])
+        oldest_query = GaugeMetricFamily('mysql_processlist_oldest_query_seconds', 'Age of the longest running query', labels=['instance'])
+        oldest_transaction = GaugeMetricFamily('mysql_processlist_oldest_transaction_seconds', 'Age of the oldest open InnoDB transaction', labels=['instance'])
+        query_ages = GaugeHistogramMetricFamily('mysql_processlist_query_age_seconds', 'Ages of the currently running queries', labels=['instance'])
+        for instance, (bounds, commands, states, ages, age_sum, oldest_query_age, oldest_trx_age) in instance_items(self.snapshots, instances):
+            for command, count in zip(PROCESSLIST_COMMANDS, commands):
+                by_command.add_metric([instance, command], count)
+            for state, count in zip(PROCESSLIST_STATES, states):
+                by_state.add_metric([instance, state or 'none'], count)
+            oldest_query.add_metric([instance], oldest_query_age)
+            oldest_transaction.add_metric([instance], oldest_trx_age)
+            buckets = []
+            cumulative = 0
+            for bound, count in zip([str(float(bound)) for bound in bounds] + ['+Inf'], ages):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            query_ages.add_metric([instance], buckets, age_sum)
+        return [by_command, by_state, oldest_query, oldest_transaction, query_ages]
+
+class LockWaitCollector:
+    """
+    Builds the InnoDB wait-for graph (waiting thread -> blocking thread) on each
+    pass, from performance_schema.data_lock_waits on MySQL 8.0 or from
+    sys.innodb_lock_waits on 5.7.
+
+    Exports the number of waiting threads, the depth of the longest blocking
+    chain and, for the LOCK_WAIT_TOP_BLOCKERS blockers with the longest waiting
+    thread, that wait. Building the graph and measuring chain depths are both
+    linear in the number of wait edges. When a wait exceeds LOCK_WAIT_LOG_THRESHOLD,
+    newly seen top blockers are logged.
+    """
+
+    group = 'lock_waits'
+
+    def __init__(self):
+        self.snapshots = {}
+        self.logged_blockers = {}
+
+    def plan(self, instance):
+        if instance_variables.get(instance, {}).get('version', '').startswith('5.'):
+            rows = yield ("SELECT waiting_pid AS WAITING_THREAD, blocking_pid AS BLOCKING_THREAD, wait_age_secs AS WAIT_AGE, "
+                          "blocking_query AS BLOCKING_QUERY FROM sys.innodb_lock_waits;", None)
+        else:
+            rows = yield ("SELECT r.trx_mysql_thread_id AS WAITING_THREAD, b.trx_mysql_thread_id AS BLOCKING_THREAD, "
+                          "TIMESTAMPDIFF(SECOND, r.trx_wait_started, NOW()) AS WAIT_AGE, b.trx_query AS BLOCKING_QUERY "
+                          "FROM performance_schema.data_lock_waits w "
+                          "JOIN information_schema.INNODB_TRX r ON r.trx_id = w.REQUESTING_ENGINE_TRANSACTION_ID "
+                          "JOIN information_schema.INNODB_TRX b ON b.trx_id = w.BLOCKING_ENGINE_TRANSACTION_ID;", None)
+
+        # Adjacency lists of the wait-for graph, plus per blocker: longest wait, direct waiters, last query
+        blocked_by = {}
+        blockers = {}
+        longest_wait = 0
+        for row in rows:
+            waiter, blocker = row['WAITING_THREAD'], row['BLOCKING_THREAD']
+            wait_age = row['WAIT_AGE'] or 0
+            blocked_by.setdefault(waiter, []).append(blocker)
+            stats = blockers.get(blocker)
+            if stats is None:
+                stats = blockers[blocker] = [0, set(), None]
+            if wait_age > stats[0]:
+                stats[0] = wait_age
+            stats[1].add(waiter)
+            if row['BLOCKING_QUERY']:
+                stats[2] = row['BLOCKING_QUERY']
+            if wait_age > longest_wait:
+                longest_wait = wait_age
+
+        chain_depth = self.longest_chain(blocked_by)
+        top = heapq.nlargest(LOCK_WAIT_TOP_BLOCKERS, blockers.items(), key=lambda item: item[1][0])
+        self.snapshots[instance] = (len(blocked_by), chain_depth, [(str(blocker), stats[0]) for blocker, stats in top])
+
+        if longest_wait >= LOCK_WAIT_LOG_THRESHOLD:
+            top_ids = {blocker for blocker, _ in top}
+            if not top_ids <= self.logged_blockers.get(instance, set()):
+                lines = [f"thread {blocker}{' (root)' if blocker not in blocked_by else ''}: "
+                         f"{len(stats[1])} waiting, longest wait {stats[0]}s, query: {(stats[2] or 'idle in transaction')[:200]}"
+                         for blocker, stats in top]
+                logging.warning(f"InnoDB lock waits on {instance} ({len(blocked_by)} waiting, chain depth {chain_depth}), top blockers:\n" + "\n".join(lines))
+            self.logged_blockers[instance] = top_ids
+        else:
+            self.logged_blockers.pop(instance, None)
+
+    def forget(self, instance):
+        self.snapshots.pop(instance, None)
+        self.logged_blockers.pop(instance, None)
+
+    @staticmethod
+    def longest_chain(blocked_by):
+        """
+        Returns the number of edges on the longest path of the wait-for graph, visiting
+        every edge once. Cycles (a deadlock InnoDB has not resolved yet, or an
+        inconsistent snapshot) are cut where they close.
+        """
+        depth = {}
+        longest = 0
+        for start in blocked_by:
+            if start in depth:
+                continue
+            depth[start] = None  # On the current path
+            stack = [(start, iter(blocked_by[start]))]
+            while stack:
+                node, blockers = stack[-1]
+                blocker = next(blockers, None)
+                if blocker is None:
+                    # Blockers that are not waiting themselves have depth 0, so do blockers still on the path
+                    stack.pop()
+                    depth[node] = 1 + max(depth.get(b) or 0 for b in blocked_by[node])
+                    longest = max(longest, depth[node])
+                elif blocker in blocked_by and blocker not in depth:
+                    depth[blocker] = None
+                    stack.append((blocker, iter(blocked_by[blocker])))
+        return longest
+
+    def describe(self):
+        return []
+
+    def collect(self, instances=None):
+        waiters = GaugeMetricFamily('mysql_innodb_lock_waiters', 'Threads waiting for an InnoDB row lock', labels=['instance'])
+        chain_depth = GaugeMetricFamily('mysql_innodb_lock_wait_chain_depth', 'Length of the longest chain of threads blocking each other', labels=['instance'])
+        blocker_wait = GaugeMetricFamily('mysql_innodb_lock_blocker_longest_wait_seconds', 'Longest current wait on a lock held by a blocking thread (top blockers only)', labels=['instance', 'blocking_thread'])
+        for instance, (waiter_count, depth, top) in instance_items(self.snapshots, instances):
+            waiters.add_metric([instance], waiter_count)
+            chain_depth.add_metric([instance], depth)
+            for blocker, wait_age in top:
+                blocker_wait.add_metric([instance, blocker], wait_age)
+        return [waiters, chain_depth, blocker_wait]
+
+statement_digest_collector = StatementDigestCollector()
+REGISTRY.register(statement_digest_collector)
+innodb_metrics_collector = InnodbMetricsCollector()
+REGISTRY.register(innodb_metrics_collector)
+processlist_collector = ProcesslistCollector()
+REGISTRY.register(processlist_collector)
+lock_wait_collector = LockWaitCollector()
+REGISTRY.register(lock_wait_collector)
+
+# Optional collectors run by every instance on their METRIC_GROUP_TIERS tier
+INSTANCE_COLLECTORS = [statement_digest_collector, HeartbeatCollector(), MasterStatusCollector(), InnodbStatusCollector(),
+                       innodb_metrics_collector, processlist_collector, lock_wait_collector]
+
+class TableSizeRefresher:
+    """
+    Background refresher and collector for per-table and per-schema sizes.
+
+    Each server gets its own thread (or asyncio task) and connection that walk the
+    schemas matching TABLE_SIZE_SCHEMAS, reading information_schema.TABLES for one
+    schema per tick. Scrapes only read the cached results, and every schema carries
+    the time it was last refreshed so stale sizes are visible.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.ticks = {}
+
+    def plan(self, instance, sweep):
+        """
+        Query plan of one tick: lists the matching schemas when a sweep starts, then
+        refreshes the next schema of the sweep.
+        """
+        cache = self.cache.setdefault(instance, {})
+        if not sweep:
+            rows = yield ("SELECT SCHEMA_NAME FROM information_schema.SCHEMATA "
+                          "WHERE SCHEMA_NAME NOT IN ('mysql', 'information_schema', 'performance_schema', 'sys');", None)
+            schemas = [row['SCHEMA_NAME'] for row in rows
+                       if any(fnmatch.fnmatchcase(row['SCHEMA_NAME'], pattern) for pattern in TABLE_SIZE_SCHEMAS)]
+            for schema in set(cache) - set(schemas):
+                del cache[schema]
+            sweep.extend(schemas)
+            self.ticks[instance] = max(1.0, TABLE_SIZE_REFRESH_PERIOD / max(1, len(schemas)))
+        if sweep:
+            schema = sweep.popleft()
+            rows = yield ("SELECT TABLE_NAME, DATA_LENGTH, INDEX_LENGTH, DATA_FREE FROM information_schema.TABLES "
+                          "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE';", (schema,))
+            tables = [(row['TABLE_NAME'], int(row['DATA_LENGTH'] or 0), int(row['INDEX_LENGTH'] or 0), int(row['DATA_FREE'] or 0))
+                      for row in rows]
+            cache[schema] = (time.time(), tables)
+
+    def run(self, server, stop=None):
+        """
+        Refresh loop for one server, until stop is set.
+        """
+        stop = stop or Event()
+        instance = server['instance']
+        mysql_connection = InstanceConnection(server)
+        prepared_connection = None
+        sweep = deque()
+        breaker = circuit_breakers.get(instance, 'table_sizes')
+        while not stop.is_set():
+            if not breaker.allow():
+                stop.wait(1)
+                continue
+            try:
+                connection = mysql_connection.get()
+                cursor = connection.cursor(dictionary=True)
+                if connection is not prepared_connection:
+                    try:
+                        # MySQL 8.0 caches table statistics for a day by default; read them fresh
+                        cursor.execute("SET SESSION information_schema_stats_expiry = 0;")
+                    except mysql.connector.ProgrammingError:
+                        pass  # 5.7 has no statistics cache
+                    prepared_connection = connection
+                run_query_plan(self.plan(instance, sweep), cursor)
+                cursor.close()
+                breaker.record_success()
+            except mysql.connector.Error as e:
+                mysql_connection.invalidate()
+                breaker.record_failure(classify_error(e), e)
+            stop.wait(self.ticks.get(instance, TABLE_SIZE_REFRESH_PERIOD))
+        mysql_connection.invalidate()
+
+    async def run_async(self, server, semaphore):
+        """
+        asyncio counterpart of run(), until cancelled; queries count against the engine's semaphore.
+        """
+        instance = server['instance']
+        mysql_connection = AsyncInstanceConnection(server)
+        prepared_connection = None
+        sweep = deque()
+        breaker = circuit_breakers.get(instance, 'table_sizes')
+        try:
+            while True:
+                if not breaker.allow():
+                    await asyncio.sleep(1)
+                    continue
+                async with semaphore:
+                    try:
+                        connection = await mysql_connection.get()
+                        cursor = await connection.cursor(dictionary=True)
+                        if connection is not prepared_connection:
+                            try:
+                                await cursor.execute("SET SESSION information_schema_stats_expiry = 0;")
+                            except mysql.connector.ProgrammingError:
+                                pass  # 5.7 has no statistics cache
+                            prepared_connection = connection
+                        await run_query_plan_async(self.plan(instance, sweep), cursor)
+                        await cursor.close()
+                        breaker.record_success()
+                    except mysql.connector.Error as e:
+                        await mysql_connection.invalidate()
+                        breaker.record_failure(classify_error(e), e)
+                await asyncio.sleep(self.ticks.get(instance, TABLE_SIZE_REFRESH_PERIOD))
+        finally:
+            # Cancelled because the server was removed from the configuration
+            await mysql_connection.invalidate()
+
+    def forget(self, instance):
+        self.cache.pop(instance, None)
+        self.ticks.pop(instance, None)
+
+    def describe(self):
+        return []
+
+    def collect(self, instances=None):
+        labels = ['instance', 'schema', 'table']
+        table_data = GaugeMetricFamily('mysql_table_data_bytes', 'Data size of a table (DATA_LENGTH)', labels=labels)
+        table_index = GaugeMetricFamily('mysql_table_index_bytes', 'Index size of a table (INDEX_LENGTH)', labels=labels)
+        table_free = GaugeMetricFamily('mysql_table_free_bytes', 'Allocated but unused bytes of a table (DATA_FREE)', labels=labels)
+        schema_data = GaugeMetricFamily('mysql_schema_data_bytes', 'Data size of all tables in a schema', labels=['instance', 'schema'])
+        schema_index = GaugeMetricFamily('mysql_schema_index_bytes', 'Index size of all tables in a schema', labels=['instance', 'schema'])
+        schema_free = GaugeMetricFamily('mysql_schema_free_bytes', 'Allocated but unused bytes of all tables in a schema', labels=['instance', 'schema'])
+        refreshed = GaugeMetricFamily('mysql_table_size_last_refresh_timestamp_seconds', 'Unix time the sizes of a schema were last read', labels=['instance', 'schema'])
+        for instance, cache in instance_items(self.cache, instances):
+            for schema, (refreshed_at, tables) in list(cache.items()):
+                data = index = free = 0
+                for table, data_length, index_length, data_free in tables:
+                    table_data.add_metric([instance, schema, table], data_length)
+                    table_index.add_metric([instance, schema, table], index_length)
+                    table_free.add_metric([instance, schema, table], data_free)
+                    data += data_length
+                    index += index_length
+                    free += data_free
+                schema_data.add_metric([instance, schema], data)
+                schema_index.add_metric([instance, schema], index)
+                schema_free.add_metric([instance, schema], free)
+                refreshed.add_metric([instance, schema], refreshed_at)
+        return [table_data, table_index, table_free, schema_data, schema_index, schema_free, refreshed]
+
+table_size_refresher = TableSizeRefresher()
+REGISTRY.register(table_size_refresher)
+
+# Custom collectors that keep per-instance state; /probe renders them with collect(instances=[target])
+INSTANCE_STATE_COLLECTORS = [global_status_collector, statement_digest_collector, innodb_metrics_collector,
+                             processlist_collector, lock_wait_collector, table_size_refresher]
+
+# Series an instance keeps while it is down, besides the exporter's own mysql_exporter_*
+# metrics: availability and the system metrics, which do not depend on MySQL answering
+DOWN_KEPT_METRICS = (mysql_up, mysql_scrape_success, mysql_last_scrape_success_timestamp_seconds,
+                     mysql_cpu_usage, mysql_memory_used, mysql_memory_free, mysql_disk_usage_percent,
+                     mysql_disk_read_io_requests, mysql_disk_write_io_requests, mysql_disk_read_bytes, mysql_disk_write_bytes)
+
+# Instances whose last collection pass succeeded
+instances_up = set()
+
+def drop_instance_series(instance, keep=(), keep_exporter_metrics=False):
+    """
+    Removes every series of an instance from the module's metrics, except those of the
+    metrics in keep (and of the mysql_exporter_* metrics with keep_exporter_metrics).
+    """
+    for metric in INSTANCE_METRICS:
+        if any(metric is kept for kept in keep):
+            continue
+        if keep_exporter_metrics and metric.describe()[0].name.startswith('mysql_exporter_'):
+            continue
+        metric.remove_by_labels({'instance': instance})
+
+def mark_mysql_up(instance):
+    """
+    Records a successful collection pass of an instance.
+    """
+    instances_up.add(instance)
+    mysql_scrape_success.labels(instance=instance).set(1)
+    mysql_last_scrape_success_timestamp_seconds.labels(instance=instance).set_to_current_time()
+
+def mark_mysql_down(instance):
+    """
+    Records a failed collection pass of an instance and returns True if the instance was up until now.
+
+    Only the up -> down transition does any work: the instance's MySQL series are
+    removed (so they go stale instead of dropping to a fake zero) together with
+    their per-instance state, and counters restart from the server's values once it
+    is back. Further failed passes only update mysql_up and mysql_scrape_success;
+    mysql_last_scrape_success_timestamp_seconds keeps the time of the last success.
+    """
+    mysql_up.labels(instance=instance).set(0)
+    mysql_scrape_success.labels(instance=instance).set(0)
+    if instance not in instances_up:
+        return False
+    instances_up.discard(instance)
+    drop_instance_series(instance, keep=DOWN_KEPT_METRICS, keep_exporter_metrics=True)
+    for state in [counter_deltas, global_status_collector, command_series_guard, replication_tracker] + INSTANCE_COLLECTORS:
+        if hasattr(state, 'forget'):
+            state.forget(instance)
+    logging.warning(f"{instance} is down; its MySQL series were removed until it is back")
+    return True
+
+class MySQLInstanceCollector:
+    """
+    Runs MySQL collection passes for one server and keeps the state that has to
+    survive between passes (the connection, the tier schedule and the last
+    result of every metric group).
+
+    The connection is kept open across passes (see InstanceConnection). Each pass
+    only queries the metric groups whose tier is due (see METRIC_GROUP_TIERS), so
+    static server variables no longer cost a round trip every second. Groups that
+    are not due keep reporting their last values. A server that cannot be reached
+    is only retried once per backoff window of its mysql circuit breaker.
+
+    The queries of a pass are the plan() query plan and the plans of the due
+    INSTANCE_COLLECTORS, so collect_once() here and the asyncio engine
+    (collect_mysql_metrics_async, with an AsyncInstanceConnection) run the same code.
+    """
+
+    def __init__(self, server, mysql_connection=None):
+        self.server = server
+        self.instance = server['instance']
+        self.data_dir = server['data_dir']
+        self.mysql_connection = mysql_connection or InstanceConnection(server)
+        self.breaker = circuit_breakers.get(self.instance, 'mysql')
+        self.scheduler = TierScheduler()
+
+        # Last result of each metric group, reused until the group's tier is due again
+        self.status = {}
+        self.variables = {}
+        self.slave_status = None
+
+    def plan(self):
+        """
+        Query plan of the core metric groups that are due (SHOW GLOBAL STATUS, SHOW
+        GLOBAL VARIABLES, SHOW SLAVE STATUS); updates the instance's metrics from them.
+        """
+        instance = self.instance
+        scheduler = self.scheduler
+        refreshed = False
+
+        if scheduler.due('global_status'):
+            rows = yield ("SHOW GLOBAL STATUS;", None)
+            self.status = {row['Variable_name']: row['Value'] for row in rows}
+            scheduler.mark_run('global_status')
+            refreshed = True
+
+        if scheduler.due('global_variables'):
+            rows = yield ("SHOW GLOBAL VARIABLES;", None)
+            self.variables = {row['Variable_name']: row['Value'] for row in rows}
+            instance_variables[instance] = self.variables
+            scheduler.mark_run('global_variables')
+            refreshed = True
+
+        if scheduler.due('slave_status'):
+            slave_rows = yield ("SHOW SLAVE STATUS;", None)
+            self.slave_status = slave_rows[0] if slave_rows else None
+            scheduler.mark_run('slave_status')
+            refreshed = True
+
+        if refreshed:
+            update_mysql_metrics(instance, self.status, self.variables, self.slave_status)
+
+    def due_collectors(self):
+        """
+        Yields the INSTANCE_COLLECTORS whose tier is due, marking each one run once the caller has run it.
+        """
+        for collector in INSTANCE_COLLECTORS:
+            if self.scheduler.due(collector.group):
+                yield collector
+                self.scheduler.mark_run(collector.group)
+
+    def record_success(self, queries_issued):
+        """
+        Finishes a successful pass: the query count, the data directory's disk usage and the instance's up state.
+        """
+        instance = self.instance
+        data_dir = self.data_dir
+        scheduler = self.scheduler
+        mysql_exporter_queries_per_scrape.labels(instance=instance).set(queries_issued)
+
+        # Get Disk Usage Metrics (servers without a local data directory have none)
+        if scheduler.due('disk_usage') and data_dir:
+            if data_dir_available(instance, data_dir):
                 disk_usage = psutil.disk_usage(data_dir)
                 mysql_disk_usage_percent.labels(instance=instance).set(disk_usage.percent)
 
                 # Get Disk I/O Metrics (Read/Write Requests)
                 # Note: This requires system-level monitoring; alternatively, use MySQL's status variables if available
                 # For simplicity, we'll skip detailed disk I/O metrics here
-            else:
-                mysql_disk_usage_percent.labels(instance=instance).set(0)
-                logging.error(f"Data directory does not exist for {instance}: {data_dir}")
-
-            # Get Uptime
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Uptime';")
-            result = cursor.fetchone()
-            uptime_seconds = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_uptime_seconds.labels(instance=instance).set(uptime_seconds)
-
-            # Get Temporary Tables Metrics
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Created_tmp_tables';")
-            result = cursor.fetchone()
-            created_tmp_tables = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_tmp_tables.labels(instance=instance).inc(created_tmp_tables - mysql_tmp_tables.labels(instance=instance)._value.get())
-
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Created_tmp_disk_tables';")
-            result = cursor.fetchone()
-            created_tmp_disk_tables = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_tmp_disk_tables.labels(instance=instance).inc(created_tmp_disk_tables - mysql_tmp_disk_tables.labels(instance=instance)._value.get())
-
-            cursor.execute("SHOW VARIABLES LIKE 'tmp_table_size';")
-            result = cursor.fetchone()
-            tmp_table_size = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_tmp_table_size.labels(instance=instance).set(tmp_table_size)
-
-            # Get Handler Metrics
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Handler_read_rnd_next';")
-            result = cursor.fetchone()
-            handler_read_rnd_next = int(result['Value']) if result and result['Value'].isdigit() else 0
-            mysql_handler_read_rnd_next.labels(instance=instance).inc(handler_read_rnd_next)
-
-            # Get Performance Schema Metrics
-            cursor.execute("SHOW GLOBAL STATUS LIKE 'Performance_schema_%';")
-            results = cursor.fetchall()
-            for row in results:
-                variable = row['Variable_name']
-                value = int(row['Value']) if row['Value'].isdigit() else 0
-                if variable == 'Performance_schema_events_waits_current':
-                    mysql_perf_schema_events_waits.labels(instance=instance).inc(value)
-                elif variable == 'Performance_schema_events_statements_current':
-                    mysql_perf_schema_events_statements.labels(instance=instance).inc(value)
+            scheduler.mark_run('disk_usage')
+        self.breaker.record_success()
+        mark_mysql_up(instance)
+
+    def record_failure(self, error):
+        """
+        Finishes a failed pass: marks the instance down and opens its mysql breaker.
+        """
+        if mark_mysql_down(self.instance):
+            # Re-read every metric group as soon as the instance is back
+            self.scheduler = TierScheduler()
+        self.breaker.record_failure(classify_error(error), str(error) or repr(error))
 
+    def collect_once(self):
+        """
+        Runs one collection pass and updates the Prometheus gauges/counters of the instance.
+        Returns whether the instance could be collected.
+        """
+        if not self.breaker.allow():
+            return False
+        try:
+            cursor = self.mysql_connection.get().cursor(dictionary=True)
+            queries_issued = run_query_plan(self.plan(), cursor)
+            for collector in self.due_collectors():
+                queries_issued += run_optional_collector(collector, self.instance, cursor)
             cursor.close()
-            connection.close()
+            self.record_success(queries_issued)
+            return True
         except Exception as e:
-            mysql_up.labels(instance=instance).set(0)
-            mysql_connections.labels(instance=instance).set(0)
-            mysql_max_connections.labels(instance=instance).set(0)
-            mysql_queries_total.labels(instance=instance).inc(0)
-            mysql_slow_queries.labels(instance=instance).inc(0)
-            mysql_questions.labels(instance=instance).inc(0)
-            mysql_commands.labels(instance=instance, command='all').inc(0)
-            mysql_replication_lag_seconds.labels(instance=instance).set(0)
-            mysql_slave_io_running.labels(instance=instance).set(0)
-            mysql_slave_sql_running.labels(instance=instance).set(0)
-            mysql_slave_retried_transactions.labels(instance=instance).inc(0)
-            mysql_innodb_buffer_pool_size.labels(instance=instance).set(0)
-            mysql_innodb_buffer_pool_used.labels(instance=instance).set(0)
-            mysql_innodb_buffer_pool_pages_data.labels(instance=instance).set(0)
-            mysql_innodb_buffer_pool_pages_free.labels(instance=instance).set(0)
-            mysql_innodb_row_lock_time_avg.labels(instance=instance).set(0)
-            mysql_innodb_row_lock_time_max.labels(instance=instance).set(0)
-            mysql_innodb_row_lock_time_total.labels(instance=instance).set(0)
-            mysql_innodb_transactions.labels(instance=instance).set(0)
-            mysql_innodb_data_reads.labels(instance=instance).set(0)
-            mysql_innodb_data_writes.labels(instance=instance).set(0)
-            mysql_query_cache_size.labels(instance=instance).set(0)
-            mysql_query_cache_hits.labels(instance=instance).inc(0)
-            mysql_query_cache_misses.labels(instance=instance).inc(0)
-            mysql_query_cache_free_memory.labels(instance=instance).set(0)
-            mysql_memory_used.labels(instance=instance).set(0)
-            mysql_memory_free.labels(instance=instance).set(0)
-            mysql_max_memory_usage.labels(instance=instance).set(0)
-            mysql_disk_usage_percent.labels(instance=instance).set(0)
-            mysql_uptime_seconds.labels(instance=instance).set(0)
-            mysql_tmp_tables.labels(instance=instance).inc(0)
-            mysql_tmp_disk_tables.labels(instance=instance).inc(0)
-            mysql_tmp_table_size.labels(instance=instance).set(0)
-            mysql_handler_read_rnd_next.labels(instance=instance).inc(0)
-            mysql_perf_schema_events_waits.labels(instance=instance).inc(0)
-            mysql_perf_schema_events_statements.labels(instance=instance).inc(0)
-            logging.error(f"Error collecting MySQL metrics for {instance}: {e}")
-        time.sleep(1)
-
-def collect_system_metrics(server):
-    """
-    Collects system metrics (CPU and Disk usage) for a given server and updates Prometheus gauges/counters.
+            if isinstance(e, mysql.connector.Error):
+                self.mysql_connection.invalidate()
+            self.record_failure(e)
+            return False
+
+def collect_mysql_metrics(server, stop=None):
     """
-    instance = server['instance']
-    data_dir = server['data_dir']
+    Collects MySQL metrics for a given server and updates Prometheus gauges/counters, until stop is set.
+    """
+    stop = stop or Event()
+    collector = MySQLInstanceCollector(server)
+    while not stop.is_set():
+        collector.collect_once()
+        stop.wait(MYSQL_METRICS_INTERVAL)
+    collector.mysql_connection.invalidate()
+
+def read_pid_file(variables):
+    """
+    Returns the PID stored in the server's @@pid_file, or None if it cannot be read.
+    """
+    pid_file = variables.get('pid_file')
+    if not pid_file:
+        return None
+    if not os.path.isabs(pid_file):
+        pid_file = os.path.join(variables.get('datadir', ''), pid_file)
+    try:
+        with open(pid_file) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def find_listening_pid(port):
+    """
+    Returns the PID of the process listening on a TCP port, or None if there is none (or it is not visible).
+    """
+    try:
+        for conn in psutil.net_connections(kind='tcp'):
+            if conn.status == psutil.CONN_LISTEN and conn.laddr and conn.laddr.port == port and conn.pid:
+                return conn.pid
+    except psutil.AccessDenied:
+        pass
+    return None
+
+def is_local_host(host):
+    """
+    Returns whether a server host is an address of this machine, i.e. whether its
+    mysqld can be among the local processes.
+    """
+    if host in ('', 'localhost', '::1') or host.startswith('127.'):
+        return True
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except OSError:
+        return False
+    local_addresses = {address.address for addresses_of_interface in psutil.net_if_addrs().values() for address in addresses_of_interface}
+    return any(address in local_addresses or address.startswith('127.') for address in addresses)
+
+# Last SHOW GLOBAL VARIABLES result per instance, used to find each server's mysqld process
+instance_variables = {}
+
+class SystemMetricsCollector:
+    """
+    Collects system metrics (data directory disk usage, mysqld CPU and memory) for one server.
+
+    The server's own mysqld process is resolved once, from @@pid_file or from the
+    process listening on the server's port, and cached until it exits (psutil's
+    is_running() also catches PID reuse), so each instance reports its own CPU
+    and memory instead of the sum over every mysqld on the host. CPU usage is the
+    growth of the cumulative CPU times between passes, so sampling never blocks.
+    Servers on other hosts (e.g. discovered replicas) have no local process and
+    export no CPU or memory; a failed lookup is retried on the backoff of the
+    instance's mysqld_process circuit breaker, since it scans every connection of
+    the host. While a value cannot be read its series is absent, not a fake 0.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.instance = server['instance']
+        self.data_dir = server['data_dir']
+        self.local = is_local_host(server['host'])
+        self.process = None
+        self.last_cpu = None
+        self.breaker = circuit_breakers.get(self.instance, 'mysqld_process')
+        # Metrics that have a series of the instance, so only a change removes one
+        self.exported = set()
+
+    def set(self, metric, value):
+        metric.labels(instance=self.instance).set(value)
+        self.exported.add(metric)
+
+    def remove(self, *metrics):
+        """
+        Removes the instance's series of metrics whose value cannot be read right now.
+        """
+        for metric in metrics:
+            if metric in self.exported:
+                self.exported.discard(metric)
+                metric.remove_by_labels({'instance': self.instance})
+
+    def resolve_process(self):
+        """
+        Finds and caches the server's mysqld process; returns None if it cannot be found.
+        """
+        if self.process is not None and self.process.is_running():
+            return self.process
+        self.process = None
+        self.last_cpu = None
+        if not self.breaker.allow():
+            return None
+        for pid in (read_pid_file(instance_variables.get(self.instance, {})), find_listening_pid(self.server['port'])):
+            if pid is None:
+                continue
+            try:
+                process = psutil.Process(pid)
+                if 'mysqld' in process.name().lower():
+                    self.process = process
+                    self.breaker.record_success()
+                    return process
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        self.breaker.record_failure('process', f"mysqld process not found (pid_file or port {self.server['port']})")
+        return None
+
+    def collect_once(self):
+        """
+        Runs one system metrics pass and updates the Prometheus gauges of the instance.
+        """
+        instance = self.instance
+        data_dir = self.data_dir
 
-    while True:
         try:
-            # Validate data directory
-            if not os.path.exists(data_dir):
-                logging.error(f"MYSQL_DATA_DIR does not exist for {instance}: {data_dir}")
-                mysql_disk_usage_percent.labels(instance=instance).set(0)
-            else:
+            # Validate data directory (servers without a local data directory have none)
+            if data_dir and data_dir_available(instance, data_dir):
                 # Get Disk usage percentage for MySQL data directory
                 disk_usage = psutil.disk_usage(data_dir)
-                mysql_disk_usage_percent.labels(instance=instance).set(disk_usage.percent)
+                self.set(mysql_disk_usage_percent, disk_usage.percent)
 
-            # Get CPU usage percentage of MySQL process
-            # Find MySQL process
-            mysql_processes = [proc for proc in psutil.process_iter(['name']) if 'mysqld' in proc.info['name'].lower()]
-            total_cpu = 0
-            for proc in mysql_processes:
-                try:
-                    cpu = proc.cpu_percent(interval=0.1)
-                    total_cpu += cpu
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                    continue
-            mysql_cpu_usage.labels(instance=instance).set(total_cpu)
+            # Get CPU and memory usage of this server's mysqld process
+            if not self.local:
+                return
+            process = self.resolve_process()
+            if process is None:
+                self.remove(mysql_cpu_usage, mysql_memory_used)
+                return
+            try:
+                with process.oneshot():
+                    cpu_times = process.cpu_times()
+                    memory_used = process.memory_info().rss
+                    if MYSQL_MEMORY_METRIC == 'pss':
+                        try:
+                            memory_used = getattr(process.memory_full_info(), 'pss', memory_used)
+                        except psutil.AccessDenied:
+                            pass
+            except psutil.NoSuchProcess:
+                # mysqld restarted; resolve it again on the next pass
+                self.process = None
+                self.remove(mysql_cpu_usage, mysql_memory_used)
+                return
 
-            # Optionally, collect memory metrics
-            # This requires accessing OS-level memory stats; alternatively, use MySQL's variables
-            # For simplicity, we skip detailed memory metrics here
+            now = time.monotonic()
+            cpu_seconds = cpu_times.user + cpu_times.system
+            if self.last_cpu is not None:
+                last_time, last_cpu_seconds = self.last_cpu
+                self.set(mysql_cpu_usage, max(0.0, (cpu_seconds - last_cpu_seconds) / (now - last_time) * 100))
+            self.last_cpu = (now, cpu_seconds)
+            self.set(mysql_memory_used, memory_used)
         except Exception as e:
-            mysql_cpu_usage.labels(instance=instance).set(0)
-            mysql_disk_usage_percent.labels(instance=instance).set(0)
+            self.remove(mysql_cpu_usage, mysql_memory_used, mysql_disk_usage_percent)
             logging.error(f"Error collecting system metrics for {instance}: {e}")
 
-        time.sleep(5)  # Adjust the frequency as needed
+def collect_system_metrics(server, stop=None):
+    """
+    Collects system metrics (CPU, memory and Disk usage) for a given server and updates Prometheus gauges/counters, until stop is set.
+    """
+    stop = stop or Event()
+    collector = SystemMetricsCollector(server)
+    while not stop.is_set():
+        collector.collect_once()
+        stop.wait(SYSTEM_METRICS_INTERVAL)
+
+class ScrapeDrivenCollector:
+    """
+    Prometheus collector that queries MySQL only when /metrics is scraped.
+
+    A scrape refreshes every server (in parallel, on a bounded worker pool) unless
+    the previous refresh is younger than the TTL, and then serves the metrics of
+    the wrapped registry. Scrapes that arrive while a refresh is in flight wait
+    for that refresh instead of starting their own, so concurrent scrapers such
+    as an HA Prometheus pair cost one round of queries.
+    """
+
+    def __init__(self, servers, registry=REGISTRY, ttl=None):
+        self.collectors = {}
+        for server in servers:
+            self.add(server)
+        self.registry = registry
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=SCRAPE_MAX_WORKERS, thread_name_prefix='scrape')
+        self.lock = Lock()
+        self.inflight = None
+        self.last_refresh = None
+
+    def add(self, server):
+        self.collectors[server['instance']] = (MySQLInstanceCollector(server), SystemMetricsCollector(server))
+
+    def remove(self, instance):
+        mysql_collector, _ = self.collectors.pop(instance)
+        mysql_collector.mysql_connection.invalidate()
+
+    def refresh(self):
+        """
+        Refreshes every server unless the cached results are still fresh, sharing
+        one in-flight refresh between concurrent callers.
+        """
+        with self.lock:
+            ttl = SCRAPE_CACHE_TTL if self.ttl is None else self.ttl
+            if self.last_refresh is not None and time.monotonic() - self.last_refresh < ttl:
+                return
+            inflight = self.inflight
+            if inflight is None:
+                self.inflight = Event()
+        if inflight is not None:
+            inflight.wait()
+            return
+
+        try:
+            futures = []
+            for mysql_collector, system_collector in list(self.collectors.values()):
+                futures.append(self.executor.submit(mysql_collector.collect_once))
+                futures.append(self.executor.submit(system_collector.collect_once))
+            for future in futures:
+                future.result()
+        finally:
+            with self.lock:
+                self.last_refresh = time.monotonic()
+                self.inflight.set()
+                self.inflight = None
+
+    def collect(self):
+        self.refresh()
+        yield from self.registry.collect()
+
+class ProbeTargetCollector:
+    """
+    Collector behind one /probe response: the probe result followed by the
+    probed target's own series, i.e. the samples of INSTANCE_METRICS labelled with
+    the target and the per-instance state of INSTANCE_STATE_COLLECTORS, so a probe
+    does not render the other targets.
+    """
+
+    def __init__(self, target, success, duration):
+        self.target = target
+        self.success = success
+        self.duration = duration
+
+    def collect(self):
+        yield GaugeMetricFamily('mysql_probe_success', 'Whether the probed target could be collected', value=1 if self.success else 0)
+        yield GaugeMetricFamily('mysql_probe_duration_seconds', 'Time spent collecting the probed target', value=self.duration)
+        for metric in INSTANCE_METRICS:
+            for family in metric.collect():
+                # collect() builds new families, so they can be filtered in place
+                family.samples = [sample for sample in family.samples if sample.labels.get('instance') == self.target]
+                if family.samples:
+                    yield family
+        for collector in INSTANCE_STATE_COLLECTORS:
+            for family in collector.collect(instances=[self.target]):
+                if family.samples:
+                    yield family
+
+class ProbeTargetLimitError(Exception):
+    """
+    Raised for a new /probe target while PROBE_MAX_TARGETS targets are kept.
+    """
+
+class TargetProber:
+    """
+    Collects targets on demand for /probe?target=, blackbox-exporter style.
+
+    Instances the supervisor already collects (loop and scrape mode) are not
+    collected again: their probe renders the series of the supervisor's collector.
+    Every other target gets a MySQLInstanceCollector, and with it a pooled
+    connection and tier schedule, the first time it is probed; it is dropped again,
+    together with its series and per-instance state, after PROBE_TARGET_IDLE_TIMEOUT
+    without probes. Collection runs on one shared worker pool of PROBE_MAX_WORKERS
+    threads, so the number of threads and connections in use follows the number of
+    concurrent probes, not the number of targets.
+    """
+
+    def __init__(self):
+        self.targets = {}
+        self.lock = Lock()
+        self.executor = None
+        self.last_sweep = time.monotonic()
+        # Scrape mode: refreshes the supervised instances (with the scrape TTL) before their probe is served
+        self.refresh_supervised = None
+
+    def supervised(self):
+        """
+        Returns the instances the supervisor collects outside of /probe.
+        """
+        if COLLECTION_MODE == 'probe':
+            return set()
+        return {server['instance'] for server in shard_servers(MYSQL_SERVERS + replica_discovery.servers())}
+
+    def server_for(self, target):
+        """
+        Returns the MYSQL_SERVERS-style entry of a target and whether it is an ad-hoc host[:port]
+        target; raises ValueError for a malformed or disallowed target.
+        """
+        for server in MYSQL_SERVERS + replica_discovery.servers():
+            if server['instance'] == target:
+                return server, False
+        host, _, port = target.rpartition(':') if ':' in target else (target, '', '')
+        if not host or (port and not (port.isdigit() and 0 < int(port) < 65536)):
+            raise ValueError(f"Invalid target {target!r}, expected an instance name or host[:port]")
+        server = dict(PROBE_SERVER_DEFAULTS, instance=target, host=host)
+        if port:
+            server['port'] = int(port)
+        address = f"{host}:{server['port']}".lower()
+        if not any(fnmatch.fnmatchcase(address, pattern.lower()) for pattern in PROBE_ALLOWED_TARGETS):
+            raise ValueError(f"Target {target!r} is not a configured instance and not in PROBE_ALLOWED_TARGETS")
+        return server, True
+
+    def entry_for(self, target, server, adhoc):
+        now = time.monotonic()
+        idle = []
+        with self.lock:
+            if now - self.last_sweep >= 60:
+                self.last_sweep = now
+                idle = [name for name, (_, _, last_probe, _) in self.targets.items() if now - last_probe >= PROBE_TARGET_IDLE_TIMEOUT]
+                idle = [(name, self.targets.pop(name)[0]) for name in idle]
+            entry = self.targets.get(target)
+            if entry is None:
+                if adhoc and sum(1 for kept in self.targets.values() if kept[3]) >= PROBE_MAX_TARGETS:
+                    raise ProbeTargetLimitError(f"Already probing {PROBE_MAX_TARGETS} targets (PROBE_MAX_TARGETS)")
+                entry = self.targets[target] = [MySQLInstanceCollector(server), Lock(), now, adhoc]
+            entry[2] = now
+        if idle:
+            # Servers the supervisor collects keep their series; only probe-only state is dropped
+            supervised = self.supervised()
+            for name, collector in idle:
+                collector.mysql_connection.invalidate()
+                if name not in supervised:
+                    forget_instance(name)
+                logging.info(f"Closed idle probe target {name}")
+        return entry
+
+    def collect_entry(self, entry):
+        # Overlapping probes of one target (e.g. an HA Prometheus pair) take turns
+        with entry[1]:
+            return entry[0].collect_once()
+
+    def probe(self, target):
+        """
+        Collects a target and returns the collector that renders its /probe response.
+        Raises ValueError for a target that may not be probed and ProbeTargetLimitError
+        when no further target can be kept.
+        """
+        started = time.perf_counter()
+        if target in self.supervised():
+            # A second collector would race the supervisor's on the instance's shared state
+            if self.refresh_supervised is not None:
+                self.refresh_supervised()
+            return ProbeTargetCollector(target, target in instances_up, time.perf_counter() - started)
+        server, adhoc = self.server_for(target)
+        entry = self.entry_for(target, server, adhoc)
+        with self.lock:
+            if self.executor is None:
+                # Created on first use, after the configuration file has been read
+                self.executor = ThreadPoolExecutor(max_workers=PROBE_MAX_WORKERS, thread_name_prefix='probe')
+        future = self.executor.submit(self.collect_entry, entry)
+        try:
+            success = future.result(timeout=PROBE_TIMEOUT)
+        except FutureTimeoutError:
+            logging.error(f"Probe of {target} timed out after {PROBE_TIMEOUT}s")
+            success = False
+        return ProbeTargetCollector(target, success, time.perf_counter() - started)
+
+target_prober = TargetProber()
+
+class ExpositionCache:
+    """
+    Immutable, pre-rendered /metrics response of a registry.
+
+    A background thread renders the text exposition once per MYSQL_METRICS_INTERVAL
+    and compresses it once; the pair of buffers is swapped in as a whole. Scrapes
+    only pick the buffer that matches their Accept-Encoding, so serving costs the
+    same for one scraper or many and takes the GIL away from collection only for
+    the socket write.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self.buffers = None
+
+    def render(self):
+        started = time.perf_counter()
+        text = generate_latest(self.registry)
+        compressed = gzip.compress(text, compresslevel=EXPOSITION_GZIP_LEVEL)
+        self.buffers = (text, compressed)
+        mysql_exporter_exposition_render_seconds.set(time.perf_counter() - started)
+        mysql_exporter_exposition_bytes.labels(encoding='identity').set(len(text))
+        mysql_exporter_exposition_bytes.labels(encoding='gzip').set(len(compressed))
+
+    def run(self):
+        """
+        Render loop.
+        """
+        while True:
+            time.sleep(MYSQL_METRICS_INTERVAL)
+            try:
+                self.render()
+            except Exception as e:
+                logging.error(f"Error rendering the /metrics exposition: {e}")
+
+    def serve(self, environ, start_response):
+        if self.buffers is None:
+            self.render()
+        text, compressed = self.buffers
+        headers = [('Content-Type', CONTENT_TYPE_PLAIN_0_0_4), ('Vary', 'Accept-Encoding')]
+        if gzip_accepted(environ.get('HTTP_ACCEPT_ENCODING', '')):
+            body = compressed
+            headers.append(('Content-Encoding', 'gzip'))
+        else:
+            body = text
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def make_exporter_app(registry=REGISTRY, exposition_cache=None):
+    """
+    WSGI app serving /probe?target= from a fresh registry per probe, and every other
+    path from the given registry, or from exposition_cache when one is given.
+    """
+    metrics_app = make_wsgi_app(registry)
+
+    def exporter_app(environ, start_response):
+        if environ['PATH_INFO'] != '/probe':
+            if exposition_cache is not None and environ['REQUEST_METHOD'] == 'GET':
+                return exposition_cache.serve(environ, start_response)
+            return metrics_app(environ, start_response)
+        target = parse_qs(environ.get('QUERY_STRING', '')).get('target', [''])[0]
+        if not target:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b'Missing target parameter\n']
+        try:
+            probe_collector = target_prober.probe(target)
+        except ValueError as e:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [f"{e}\n".encode()]
+        except ProbeTargetLimitError as e:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [f"{e}\n".encode()]
+        probe_registry = CollectorRegistry(auto_describe=False)
+        probe_registry.register(probe_collector)
+        return make_wsgi_app(probe_registry)(environ, start_response)
+
+    return exporter_app
+
+def start_exporter_http_server(port, registry=REGISTRY, exposition_cache=None):
+    """
+    Starts the HTTP server for /metrics and /probe in a daemon thread.
+    """
+    httpd = make_server('', port, make_exporter_app(registry, exposition_cache), ThreadingWSGIServer, handler_class=QuietRequestHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+class AsyncInstanceConnection:
+    """
+    asyncio counterpart of InstanceConnection, built on mysql.connector.aio.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.instance = server['instance']
+        self.connection = None
+        self.last_used = 0
+        self.has_connected = False
+
+    async def _connect(self):
+        start = time.perf_counter()
+        self.connection = await mysql.connector.aio.connect(
+            host=self.server['host'],
+            port=self.server['port'],
+            user=self.server['user'],
+            password=self.server['password'],
+            database=self.server['database'],
+            connection_timeout=CONNECTION_TIMEOUT,
+            autocommit=True
+        )
+        mysql_exporter_connect_duration_seconds.labels(instance=self.instance).observe(time.perf_counter() - start)
+        if self.has_connected:
+            mysql_exporter_reconnects.labels(instance=self.instance).inc()
+            logging.info(f"Reconnected to MySQL for {self.instance}")
+        self.has_connected = True
+
+    async def get(self):
+        """
+        Returns an open connection, reconnecting if it was invalidated or went stale while idle.
+        """
+        now = time.monotonic()
+        if self.connection is not None and now - self.last_used >= CONNECTION_HEALTH_CHECK_INTERVAL:
+            try:
+                await self.connection.ping(reconnect=False)
+            except mysql.connector.Error:
+                await self.invalidate()
+        if self.connection is None:
+            await self._connect()
+        self.last_used = now
+        return self.connection
+
+    async def invalidate(self):
+        """
+        Drops the current connection so the next get() performs a fresh handshake.
+        """
+        if self.connection is not None:
+            try:
+                await self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+async def run_query_plan_async(plan, cursor):
+    """
+    asyncio counterpart of run_query_plan.
+    """
+    queries_issued = 0
+    rows = None
+    try:
+        while True:
+            statement, params = plan.send(rows)
+            await cursor.execute(statement, params)
+            rows = await cursor.fetchall() if cursor.with_rows else []
+            queries_issued += 1
+    except StopIteration:
+        return queries_issued
+
+async def run_optional_collector_async(collector, instance, cursor):
+    """
+    asyncio counterpart of run_optional_collector.
+    """
+    started = time.perf_counter()
+    try:
+        return await run_query_plan_async(collector.plan(instance), cursor)
+    except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+        raise
+    except mysql.connector.Error as e:
+        logging.warning(f"{collector.group} collection failed for {instance}: {e}")
+        return 1
+    except Exception:
+        logging.exception(f"{collector.group} collector failed for {instance}")
+        return 1
+    finally:
+        mysql_exporter_collector_duration_seconds.labels(instance=instance, group=collector.group).set(time.perf_counter() - started)
+
+async def collect_mysql_metrics_async(server, semaphore):
+    """
+    Collects MySQL metrics for a given server on the shared event loop.
+
+    Runs the query plans of a MySQLInstanceCollector, like the threads engine, but
+    through run_query_plan_async on an AsyncInstanceConnection. At most
+    ASYNC_MAX_CONCURRENCY instances are queried at once (via semaphore), and a pass
+    that takes longer than ASYNC_COLLECTION_TIMEOUT is abandoned and counted as a failure.
+    """
+    instance = server['instance']
+    collector = MySQLInstanceCollector(server, AsyncInstanceConnection(server))
+
+    async def collect_pass():
+        connection = await collector.mysql_connection.get()
+        cursor = await connection.cursor(dictionary=True)
+        queries_issued = await run_query_plan_async(collector.plan(), cursor)
+        for optional_collector in collector.due_collectors():
+            queries_issued += await run_optional_collector_async(optional_collector, instance, cursor)
+        await cursor.close()
+        collector.record_success(queries_issued)
+
+    try:
+        while True:
+            started = time.monotonic()
+            if not collector.breaker.allow():
+                await asyncio.sleep(MYSQL_METRICS_INTERVAL)
+                continue
+            async with semaphore:
+                try:
+                    await asyncio.wait_for(collect_pass(), ASYNC_COLLECTION_TIMEOUT)
+                except Exception as e:
+                    # A timed-out pass may have left the protocol mid-result, so always reconnect
+                    await collector.mysql_connection.invalidate()
+                    collector.record_failure(e)
+            await asyncio.sleep(max(0, MYSQL_METRICS_INTERVAL - (time.monotonic() - started)))
+    finally:
+        # Cancelled because the server was removed from the configuration
+        await collector.mysql_connection.invalidate()
+
+async def collect_system_metrics_async(server, semaphore):
+    """
+    Runs SystemMetricsCollector passes for a given server in the default executor,
+    since psutil has no asyncio API.
+    """
+    collector = SystemMetricsCollector(server)
+    while True:
+        async with semaphore:
+            await asyncio.to_thread(collector.collect_once)
+        await asyncio.sleep(SYSTEM_METRICS_INTERVAL)
+
+async def run_async_engine(config_watcher):
+    """
+    Runs the MySQL and system collection of every server on one event loop, and
+    reconciles the servers with the configuration file on the same loop.
+    """
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+
+    def start_target(server):
+        stop = Event()
+        for thread in background_threads(server, stop, table_sizes=False):
+            thread.start()
+        tasks = [asyncio.ensure_future(collect_mysql_metrics_async(server, semaphore)),
+                 asyncio.ensure_future(collect_system_metrics_async(server, semaphore))]
+        if TABLE_SIZE_SCHEMAS:
+            tasks.append(asyncio.ensure_future(table_size_refresher.run_async(server, semaphore)))
+
+        def stop_target():
+            stop.set()
+            for task in tasks:
+                task.cancel()
+        return stop_target
+
+    supervisor = TargetSupervisor(start_target)
+    supervisor.reconcile(MYSQL_SERVERS)
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        servers = await asyncio.to_thread(config_watcher.poll)
+        if servers is not None or supervisor.discovery_version != replica_discovery.version:
+            supervisor.reconcile(MYSQL_SERVERS)
+
+class HashRing:
+    """
+    Consistent-hash ring over md5 with virtual nodes.
+    """
+
+    def __init__(self, nodes, virtual_nodes=None):
+        virtual_nodes = SHARD_VIRTUAL_NODES if virtual_nodes is None else virtual_nodes
+        points = sorted((self.hash(f"{node}#{i}"), node) for node in nodes for i in range(virtual_nodes))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key):
+        """
+        Returns the node owning key: the first ring point at or after the key's hash.
+        """
+        index = bisect.bisect_left(self.hashes, self.hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+def shard_servers(servers, shard_index=None, shard_count=None):
+    """
+    Returns the servers owned by one exporter replica (by default this one).
+    """
+    shard_index = SHARD_INDEX if shard_index is None else shard_index
+    shard_count = SHARD_COUNT if shard_count is None else shard_count
+    if shard_count <= 1:
+        return list(servers)
+    ring = HashRing([f"shard-{i}" for i in range(shard_count)])
+    return [server for server in servers if ring.node_for(server['instance']) == f"shard-{shard_index}"]
+
+class ReplicaDiscovery:
+    """
+    Finds the replicas of REPLICA_DISCOVERY_MASTERS in a background thread, on the
+    replica_discovery tier, so discovery never touches the per-second collection path.
+
+    Every exporter replica runs discovery against every listed source (on its own
+    connections), so with sharding each discovered replica is still picked up by
+    the shard the hash ring assigns it to. version is bumped whenever the set of
+    discovered servers changes.
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.replicas = {}
+        self.version = 0
+        self.lock = Lock()
+
+    def discover(self, master):
+        """
+        Returns (host, port, server_id) of the replicas currently connected to a source.
+        """
+        connection = self.connections.get(master['instance'])
+        if connection is None:
+            connection = self.connections[master['instance']] = InstanceConnection(master)
+        cursor = connection.get().cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute("SHOW REPLICAS;")
+            except mysql.connector.ProgrammingError:
+                cursor.execute("SHOW SLAVE HOSTS;")  # Before 8.0.22
+            rows = cursor.fetchall()
+            found = [(row['Host'], int(row['Port']), row.get('Server_Id', row.get('Server_id'))) for row in rows if row['Host']]
+            if len(found) < len(rows):
+                # Replicas without report_host: take their addresses from the binlog dump threads
+                cursor.execute("SELECT HOST FROM information_schema.PROCESSLIST WHERE COMMAND IN ('Binlog Dump', 'Binlog Dump GTID');")
+                known_hosts = {host for host, _, _ in found}
+                for row in cursor.fetchall():
+                    host = row['HOST'].rsplit(':', 1)[0]
+                    if host not in known_hosts:
+                        found.append((host, REPLICA_DISCOVERY_TEMPLATE.get('port', 3306), None))
+            return found
+        finally:
+            cursor.close()
+
+    def refresh(self):
+        now = time.time()
+        configured = {(server['host'], server['port']) for server in MYSQL_SERVERS}
+        # Sources are queried without holding the lock, so servers() (called by /probe and
+        # reconcile) never waits for a slow or unreachable source
+        results = []
+        for master in [server for server in MYSQL_SERVERS if server['instance'] in REPLICA_DISCOVERY_MASTERS]:
+            try:
+                results.append((master, self.discover(master)))
+            except mysql.connector.Error as e:
+                self.connections[master['instance']].invalidate()
+                logging.error(f"Replica discovery failed on {master['instance']}: {e}")
+        with self.lock:
+            before = set(self.replicas)
+            for master, found in results:
+                for host, port, server_id in found:
+                    if (host, port) in configured:
+                        continue
+                    fields = {'master': master['instance'], 'host': host, 'port': port, 'server_id': server_id}
+                    server = {key: value.format(**fields) if isinstance(value, str) else value
+                              for key, value in REPLICA_DISCOVERY_TEMPLATE.items()}
+                    server.update(host=host, port=port)
+                    self.replicas[(host, port)] = (master['instance'], server, now)
+            for key, (_, _, last_seen) in list(self.replicas.items()):
+                if now - last_seen > REPLICA_DISCOVERY_RETENTION:
+                    del self.replicas[key]
+            for master in REPLICA_DISCOVERY_MASTERS:
+                mysql_exporter_discovered_replicas.labels(instance=master).set(sum(1 for entry in self.replicas.values() if entry[0] == master))
+            if set(self.replicas) != before:
+                self.version += 1
+                logging.info(f"Discovered replicas: {', '.join(entry[1]['instance'] for entry in self.replicas.values()) or 'none'}")
+
+    def servers(self):
+        """
+        Returns the discovered replicas that are not configured servers.
+        """
+        configured = {server['instance'] for server in MYSQL_SERVERS} | {(server['host'], server['port']) for server in MYSQL_SERVERS}
+        with self.lock:
+            return [server for key, (_, server, _) in self.replicas.items() if key not in configured and server['instance'] not in configured]
+
+    def run(self, stop=None):
+        """
+        Discovery loop, until stop is set.
+        """
+        stop = stop or Event()
+        while not stop.is_set():
+            if REPLICA_DISCOVERY_MASTERS:
+                self.refresh()
+            stop.wait(COLLECTION_TIERS[METRIC_GROUP_TIERS['replica_discovery']])
+
+replica_discovery = ReplicaDiscovery()
+
+def forget_instance(instance):
+    """
+    Drops every series and all per-instance state of a server that is no longer collected.
+    """
+    drop_instance_series(instance)
+    instances_up.discard(instance)
+    for state in [counter_deltas, global_status_collector, command_series_guard, replication_tracker, table_size_refresher, circuit_breakers] + INSTANCE_COLLECTORS:
+        if hasattr(state, 'forget'):
+            state.forget(instance)
+    instance_variables.pop(instance, None)
+
+def background_threads(server, stop, table_sizes=True):
+    """
+    Returns the (unstarted) background threads a server needs in every mode and engine.
+    With table_sizes=False the table size refresher is left to the caller (the asyncio
+    engine runs it as a task).
+    """
+    threads = []
+    if HEARTBEAT_ENABLED and server['instance'] == HEARTBEAT_MASTER:
+        # Heartbeats are written continuously, on their own connection
+        threads.append(Thread(target=heartbeat_writer.run, args=(server, stop), daemon=True))
+    if table_sizes and TABLE_SIZE_SCHEMAS:
+        # Table sizes are refreshed in the background, on their own connection
+        threads.append(Thread(target=table_size_refresher.run, args=(server, stop), daemon=True))
+    return threads
+
+class TargetSupervisor:
+    """
+    Keeps the running per-server work in line with the configured servers.
+
+    start_target(server) starts the work of one server and returns a function
+    that stops it. The servers are the configured ones plus the replicas found
+    by ReplicaDiscovery. reconcile() only touches servers that were added, removed or
+    changed; untouched servers keep their connections, caches and counter
+    baselines, and a changed server keeps its counter baselines (they are keyed
+    by instance name). Removed servers have their series and state dropped.
+    """
+
+    def __init__(self, start_target):
+        self.start_target = start_target
+        self.targets = {}
+        self.discovery_version = None
+        self.lock = Lock()
+
+    def reconcile(self, servers):
+        self.discovery_version = replica_discovery.version
+        owned = {server['instance']: server for server in shard_servers(list(servers) + replica_discovery.servers())}
+        with self.lock:
+            removed, changed = [], []
+            for instance, (server, stop_target) in list(self.targets.items()):
+                if owned.get(instance) == server:
+                    continue
+                del self.targets[instance]
+                stop_target()
+                if instance in owned:
+                    # New credentials or address: try them right away rather than after the backoff
+                    circuit_breakers.forget(instance)
+                    changed.append(instance)
+                else:
+                    forget_instance(instance)
+                    removed.append(instance)
+            added = []
+            for instance, server in owned.items():
+                if instance not in self.targets:
+                    self.targets[instance] = (server, self.start_target(server))
+                    if instance not in changed:
+                        added.append(instance)
+        if added or removed or changed:
+            logging.info(f"Servers reconciled: added {added or '-'}, removed {removed or '-'}, restarted {changed or '-'}")
+
+# Default of every CONFIG_SETTINGS entry, which file values are checked against
+CONFIG_DEFAULTS = {name: copy.deepcopy(globals()[name]) for name in CONFIG_SETTINGS}
+
+def check_setting(name, value, default):
+    """
+    Raises ValueError unless a configuration file value has the type and shape of the setting's default.
+    """
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise ValueError(f"{name} must be true or false")
+    elif isinstance(default, (int, float)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or (default > 0 and value == 0):
+            raise ValueError(f"{name} must be a number {'> 0' if default > 0 else '>= 0'}")
+    elif isinstance(default, str):
+        if not isinstance(value, str):
+            raise ValueError(f"{name} must be a string")
+    elif isinstance(default, tuple):
+        if not isinstance(value, (list, tuple)) or len(value) != len(default):
+            raise ValueError(f"{name} must be a list of {len(default)} values")
+        for index, item in enumerate(value):
+            check_setting(f"{name}[{index}]", item, default[index])
+    elif isinstance(default, list):
+        if not isinstance(value, list):
+            raise ValueError(f"{name} must be a list")
+        for index, item in enumerate(value):
+            check_setting(f"{name}[{index}]", item, default[0] if default else '')
+    elif isinstance(default, dict):
+        if not isinstance(value, dict):
+            raise ValueError(f"{name} must be an object")
+        if default and set(value) != set(default):
+            raise ValueError(f"{name} must have exactly the keys {', '.join(sorted(default))}")
+        for key, item in value.items():
+            check_setting(f"{name}[{key!r}]", item, default[key] if default else '')
+
+def parse_config(config):
+    """
+    Validates a parsed configuration file and returns its (servers, settings).
+    """
+    if not isinstance(config, dict) or not isinstance(config.get('servers'), list):
+        raise ValueError("expected an object with a 'servers' list")
+    servers = []
+    for server in config['servers']:
+        missing = [key for key in ('instance', 'host', 'port', 'user', 'password', 'database') if key not in server]
+        if missing:
+            raise ValueError(f"server {server.get('instance', '?')} is missing {', '.join(missing)}")
+        server = dict({'data_dir': ''}, **server)
+        for key in ('instance', 'host', 'port', 'user', 'password', 'database', 'data_dir'):
+            check_setting(f"server {server['instance']!r} {key}", server[key], 3306 if key == 'port' else '')
+        servers.append(server)
+    instances = [server['instance'] for server in servers]
+    if len(set(instances)) != len(instances):
+        raise ValueError("instance names must be unique")
+    settings = config.get('settings', {})
+    if not isinstance(settings, dict):
+        raise ValueError("'settings' must be an object")
+    for name, value in settings.items():
+        if name not in CONFIG_SETTINGS:
+            raise ValueError(f"unknown setting {name}")
+        check_setting(name, value, CONFIG_DEFAULTS[name])
+        choices = CONFIG_SETTING_CHOICES.get(name)
+        if choices and any(item not in choices for item in (value.values() if isinstance(value, dict) else [value])):
+            raise ValueError(f"{name} must be one of {', '.join(choices)}")
+    tiers = settings.get('COLLECTION_TIERS', COLLECTION_TIERS)
+    for group, tier in settings.get('METRIC_GROUP_TIERS', METRIC_GROUP_TIERS).items():
+        if tier not in tiers:
+            raise ValueError(f"METRIC_GROUP_TIERS: {group} has unknown tier {tier}")
+    if settings.get('SHARD_INDEX', SHARD_INDEX) >= settings.get('SHARD_COUNT', SHARD_COUNT):
+        raise ValueError("SHARD_INDEX must be lower than SHARD_COUNT")
+    return servers, settings
+
+# Collectors that cache a type per name, and the settings the types are inferred from
+CONFIG_TYPE_CACHES = [
+    (global_status_collector, {'GLOBAL_STATUS_ALLOWLIST', 'GLOBAL_STATUS_DENYLIST', 'GLOBAL_STATUS_TYPES'}),
+    (innodb_metrics_collector, {'INNODB_METRICS_GAUGES'}),
+]
+
+class ConfigWatcher:
+    """
+    Polls CONFIG_FILE for changes and applies it.
+
+    The file is re-read when its modification time or size changes. An invalid
+    file is rejected as a whole: the previous configuration stays active and
+    mysql_exporter_config_reload_success drops to 0 until the file is fixed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.loaded = False
+
+    def poll(self):
+        """
+        Applies the file if it changed, and returns the new server list (None if nothing was applied).
+        """
+        global MYSQL_SERVERS
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return None
+        self.signature = signature
+        try:
+            with open(self.path) as config_file:
+                servers, settings = parse_config(json.load(config_file))
+        except (OSError, ValueError) as e:
+            mysql_exporter_config_reload_success.set(0)
+            logging.error(f"Invalid configuration file {self.path}, keeping the previous configuration: {e}")
+            return None
+        applied = set()
+        for name, value in settings.items():
+            if globals()[name] == value:
+                continue
+            if self.loaded and name in CONFIG_STARTUP_SETTINGS:
+                logging.warning(f"{name} changed in {self.path}; restart the exporter to apply it")
+                continue
+            globals()[name] = value
+            applied.add(name)
+        for collector, names in CONFIG_TYPE_CACHES:
+            if applied & names:
+                collector.reset_types()
+        MYSQL_SERVERS = servers
+        self.loaded = True
+        mysql_exporter_config_reload_success.set(1)
+        mysql_exporter_config_last_reload_success_timestamp_seconds.set_to_current_time()
+        logging.info(f"Loaded configuration file {self.path} ({len(servers)} servers)")
+        return servers
+
+    def run(self, supervisor):
+        """
+        Polling loop; reconciles the supervisor's servers after every applied change
+        and whenever replica discovery found or dropped replicas.
+        """
+        while True:
+            time.sleep(CONFIG_RELOAD_INTERVAL)
+            servers = self.poll()
+            if servers is not None or supervisor.discovery_version != replica_discovery.version:
+                supervisor.reconcile(MYSQL_SERVERS)
+
+class DeduplicatingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Logging handler that hands records to a QueueListener and suppresses repeats.
+
+    The first occurrence of a message is queued; identical messages (same level and
+    text) within LOG_DEDUP_WINDOW seconds of it are only counted, and a single
+    "N identical messages suppressed" record is queued once the window has passed.
+    A full queue drops the record instead of blocking the logging thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.seen = {}
+        self.seen_lock = Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            mysql_exporter_log_messages_dropped.inc()
+
+    def emit(self, record):
+        key = (record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self.seen_lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < LOG_DEDUP_WINDOW:
+                entry[1] += 1
+                mysql_exporter_log_messages_suppressed.inc()
+                return
+            self.seen[key] = [now, 0]
+        if entry is not None and entry[1]:
+            self.emit_suppressed(record, entry[1], now - entry[0])
+        super().emit(record)
+
+    def emit_suppressed(self, record, count, elapsed):
+        summary = logging.makeLogRecord({
+            'name': record.name, 'levelno': record.levelno, 'levelname': record.levelname,
+            'msg': f"{count} identical messages suppressed in the last {elapsed:.0f} s: {record.getMessage()}",
+        })
+        super().emit(summary)
+
+    def flush_expired(self):
+        """
+        Reports and forgets the messages whose window has passed.
+        """
+        now = time.monotonic()
+        with self.seen_lock:
+            expired = [(key, entry) for key, entry in self.seen.items() if now - entry[0] >= LOG_DEDUP_WINDOW]
+            for key, _ in expired:
+                del self.seen[key]
+        for (levelno, message), (first_seen, count) in expired:
+            if count:
+                self.emit_suppressed(logging.makeLogRecord({'levelno': levelno, 'levelname': logging.getLevelName(levelno), 'msg': message}),
+                                     count, now - first_seen)
+
+    def run(self):
+        """
+        Reports suppressed repeats of messages that stopped repeating, every second.
+        """
+        while True:
+            time.sleep(1)
+            self.flush_expired()
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging():
+    """
+    Routes every log record through a DeduplicatingQueueHandler and returns its queue.
+    Records are buffered until start_log_listener() starts writing them.
+    """
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DeduplicatingQueueHandler(log_queue)
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    Thread(target=handler.run, daemon=True).start()
+    return log_queue
+
+def start_log_listener(log_queue):
+    """
+    Starts the thread that writes queued records to LOG_FILE (with the LOG_* settings in
+    effect now, i.e. after the configuration file was read) and returns it.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    if LOG_FORMAT == 'json':
+        file_handler.setFormatter(JsonLogFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+    logging.getLogger().setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    # Write out what is still queued on exit
+    atexit.register(listener.stop)
+    return listener
 
 def signal_handler(sig, frame):
     logging.info("Shutting down exporter...")
@@ -405,24 +3298,65 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # Start Prometheus metrics server on port 8000
-    start_http_server(8000)
-    logging.info("Prometheus metrics server started on port 8000")
-    print("Prometheus metrics server started on port 8000")
+    # Read the configuration file, if there is one, before anything is started; the log
+    # file is opened afterwards so that its LOG_* settings apply
+    log_queue = setup_logging()
+    config_watcher = ConfigWatcher(CONFIG_FILE)
+    config_watcher.poll()
+    start_log_listener(log_queue)
 
-    # Start metric collection threads for each server
-    threads = []
-    for server in MYSQL_SERVERS:
-        # Start MySQL metrics collection thread
-        t_mysql = Thread(target=collect_mysql_metrics, args=(server,))
-        t_mysql.start()
-        threads.append(t_mysql)
-
-        # Start system metrics collection thread
-        t_system = Thread(target=collect_system_metrics, args=(server,))
-        t_system.start()
-        threads.append(t_system)
-
-    # Keep the main thread alive
-    for t in threads:
-        t.join()
\ No newline at end of file
+    exposition_cache = None
+    if COLLECTION_MODE == 'scrape':
+        # Serve a registry whose only collector refreshes the default registry on demand
+        scrape_collector = ScrapeDrivenCollector([])
+        registry = CollectorRegistry()
+        registry.register(scrape_collector)
+        target_prober.refresh_supervised = scrape_collector.refresh
+    else:
+        registry = REGISTRY
+        if COLLECTION_MODE == 'loop' and EXPOSITION_CACHE_ENABLED:
+            # Serve /metrics from a buffer rendered once per cycle
+            exposition_cache = ExpositionCache(registry)
+            Thread(target=exposition_cache.run, daemon=True).start()
+
+    # Start Prometheus metrics server (/metrics and /probe)
+    start_exporter_http_server(EXPORTER_PORT, registry=registry, exposition_cache=exposition_cache)
+    logging.info(f"Prometheus metrics server started on port {EXPORTER_PORT} ({COLLECTION_MODE} mode)")
+    print(f"Prometheus metrics server started on port {EXPORTER_PORT} ({COLLECTION_MODE} mode)")
+    if SHARD_COUNT > 1:
+        logging.info(f"Shard {SHARD_INDEX}/{SHARD_COUNT}: collecting the servers the hash ring assigns to this replica")
+
+    # Replica discovery runs in the background in every mode; found replicas are
+    # picked up by the next reconcile
+    Thread(target=replica_discovery.run, daemon=True).start()
+
+    if COLLECTION_MODE == 'loop' and COLLECTION_ENGINE == 'asyncio':
+        import mysql.connector.aio  # Only needed by the asyncio engine
+        asyncio.run(run_async_engine(config_watcher))
+    else:
+        def start_target(server):
+            stop = Event()
+            threads = background_threads(server, stop)
+            if COLLECTION_MODE == 'scrape':
+                # Collection happens inside the HTTP server threads
+                scrape_collector.add(server)
+            elif COLLECTION_MODE == 'loop':
+                # MySQL and system metrics collection threads
+                threads.append(Thread(target=collect_mysql_metrics, args=(server, stop), daemon=True))
+                threads.append(Thread(target=collect_system_metrics, args=(server, stop), daemon=True))
+            for thread in threads:
+                thread.start()
+
+            def stop_target():
+                stop.set()
+                if COLLECTION_MODE == 'scrape':
+                    scrape_collector.remove(server['instance'])
+                for thread in threads:
+                    thread.join()
+            return stop_target
+
+        supervisor = TargetSupervisor(start_target)
+        supervisor.reconcile(MYSQL_SERVERS)
+
+        # Watch the configuration file on the main thread
+        config_watcher.run(supervisor)
@@ -0,0 +1,117 @@
+"""
+Simulate a sharded mysql_metrics_exporter fleet and check how the consistent-hash
+ring spreads targets over the replicas.
+
+For every replica count, each replica runs as its own Python process with
+MYSQL_EXPORTER_SHARD_INDEX/MYSQL_EXPORTER_SHARD_COUNT set, collects its share of
+simulated targets once and reports which instances it exposes. The parent process
+checks that:
+  - every target is exposed by exactly one replica,
+  - no replica holds more than --max-imbalance times its fair share,
+  - going from N to N+1 replicas only moves targets onto the new replica, and
+    moves roughly 1/(N+1) of them.
+
+Usage:
+    python shard_simulation.py [--targets 1000] [--replicas 3 4 5] [--max-imbalance 1.3]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+def simulated_servers(targets):
+    return [
+        {'instance': f'sim-{i}', 'host': '127.0.0.1', 'port': 20000 + i, 'user': 'root',
+         'password': '', 'database': 'replicated_db', 'data_dir': ''}
+        for i in range(targets)
+    ]
+
+def run_child(targets):
+    # Imported here so that the shard settings are read from this process's environment
+    import benchmark_engines
+    import mysql_metrics_exporter as exporter
+
+    exporter.mysql.connector.connect = lambda **kwargs: benchmark_engines.SimulatedConnection(f"sim{kwargs['port']}", 0)
+    exporter.MYSQL_SERVERS = simulated_servers(targets)
+    for server in exporter.shard_servers(exporter.MYSQL_SERVERS):
+        exporter.MySQLInstanceCollector(server).collect_once()
+
+    exposed = set()
+    for family in exporter.REGISTRY.collect():
+        for sample in family.samples:
+            if 'instance' in sample.labels:
+                exposed.add(sample.labels['instance'])
+    print(json.dumps(sorted(exposed)))
+
+def run_fleet(replicas, targets):
+    """
+    Runs one process per replica and returns {instance: shard index}.
+    """
+    processes = []
+    for index in range(replicas):
+        env = dict(os.environ, MYSQL_EXPORTER_SHARD_INDEX=str(index), MYSQL_EXPORTER_SHARD_COUNT=str(replicas))
+        processes.append(subprocess.Popen(
+            [sys.executable, __file__, '--child', '--targets', str(targets)],
+            env=env, stdout=subprocess.PIPE, text=True
+        ))
+    owners = {}
+    duplicates = 0
+    for index, process in enumerate(processes):
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"replica {index} exited with {process.returncode}")
+        for instance in json.loads(output.strip().splitlines()[-1]):
+            if instance in owners:
+                duplicates += 1
+            owners[instance] = index
+    return owners, duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=int, default=1000)
+    parser.add_argument('--replicas', type=int, nargs='+', default=[3, 4, 5])
+    parser.add_argument('--max-imbalance', type=float, default=1.3, help='largest allowed share relative to targets/replicas')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.targets)
+        return
+
+    expected = {f'sim-{i}' for i in range(args.targets)}
+    failures = []
+    previous = None
+    print(f"{'replicas':>8} {'min':>6} {'max':>6} {'imbalance':>9} {'moved':>7} {'ideal':>7}")
+    for replicas in sorted(args.replicas):
+        owners, duplicates = run_fleet(replicas, args.targets)
+        if duplicates or set(owners) != expected:
+            failures.append(f"{replicas} replicas: {duplicates} targets exposed twice, {len(expected - set(owners))} not exposed")
+
+        loads = [0] * replicas
+        for index in owners.values():
+            loads[index] += 1
+        imbalance = max(loads) / (args.targets / replicas)
+        if imbalance > args.max_imbalance:
+            failures.append(f"{replicas} replicas: largest shard holds {imbalance:.2f}x its fair share")
+
+        moved_text = ideal_text = '-'
+        if previous is not None and replicas == previous[0] + 1:
+            moved = [instance for instance in expected if owners.get(instance) != previous[1].get(instance)]
+            # Consistent hashing: a new replica only takes targets, nothing moves between old replicas
+            strays = [instance for instance in moved if owners.get(instance) != replicas - 1]
+            if strays:
+                failures.append(f"{previous[0]} -> {replicas} replicas: {len(strays)} targets moved between existing replicas")
+            ideal = 1 / replicas
+            if len(moved) / args.targets > ideal * args.max_imbalance:
+                failures.append(f"{previous[0]} -> {replicas} replicas: {len(moved) / args.targets:.1%} of targets moved")
+            moved_text, ideal_text = f"{len(moved) / args.targets:.1%}", f"{ideal:.1%}"
+        print(f"{replicas:>8} {min(loads):>6} {max(loads):>6} {imbalance:>9.2f} {moved_text:>7} {ideal_text:>7}")
+        previous = (replicas, owners)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
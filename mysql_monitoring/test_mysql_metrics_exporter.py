@@ -0,0 +1,725 @@
+import json
+import logging
+import queue
+import re
+
+import pytest
+
+import mysql_metrics_exporter as exporter
+
+def run_plan(plan, *results):
+    """
+    Drives a query plan with canned rows, one list per statement, and returns the statements.
+    """
+    statements = []
+    rows = None
+    results = list(results)
+    try:
+        while True:
+            statements.append(plan.send(rows)[0])
+            rows = results.pop(0)
+    except StopIteration:
+        return statements
+
+@pytest.mark.parametrize('name, expected', [
+    # Point-in-time values, including pending I/O that the Innodb_data_* / Innodb_os_log_* patterns would catch
+    ('Innodb_data_pending_reads', 'gauge'),
+    ('Innodb_data_pending_writes', 'gauge'),
+    ('Innodb_data_pending_fsyncs', 'gauge'),
+    ('Innodb_os_log_pending_writes', 'gauge'),
+    ('Innodb_os_log_pending_fsyncs', 'gauge'),
+    ('Innodb_buffer_pool_pages_free', 'gauge'),
+    ('Threads_running', 'gauge'),
+    ('Key_blocks_unused', 'gauge'),
+    ('Prepared_stmt_count', 'gauge'),
+    ('Some_unknown_variable', 'gauge'),
+    # Cumulative counts, including the explicit names that a gauge pattern would otherwise catch
+    ('Innodb_data_reads', 'counter'),
+    ('Innodb_os_log_fsyncs', 'counter'),
+    ('Innodb_buffer_pool_wait_free', 'counter'),
+    ('Innodb_buffer_pool_pages_flushed', 'counter'),
+    ('Binlog_cache_use', 'counter'),
+    ('Binlog_cache_disk_use', 'counter'),
+    ('Innodb_row_lock_waits', 'counter'),
+    ('Questions', 'counter'),
+    ('Opened_tables', 'counter'),
+    ('Handler_read_rnd_next', 'counter'),
+    # Filtered out by GLOBAL_STATUS_DENYLIST
+    ('Com_select', None),
+    ('Ssl_cipher', None),
+])
+def test_infer_status_type(name, expected):
+    assert exporter.infer_status_type(name) == expected
+
+def test_infer_status_type_override(monkeypatch):
+    monkeypatch.setattr(exporter, 'GLOBAL_STATUS_TYPES', {'Innodb_data_pending_reads': 'counter'})
+    assert exporter.infer_status_type('Innodb_data_pending_reads') == 'counter'
+
+@pytest.mark.parametrize('name, counter_type, expected', [
+    ('log_lsn_current', 'value', 'gauge'),
+    ('os_pending_reads', 'counter', 'gauge'),
+    ('os_pending_writes', 'counter', 'gauge'),
+    ('trx_active_transactions', 'counter', 'gauge'),
+    ('lock_row_lock_current_waits', 'status_counter', 'gauge'),
+    ('buffer_pool_pages_free', 'status_counter', 'gauge'),
+    ('buffer_pool_reads', 'status_counter', 'counter'),
+    ('buffer_pool_pages_flushed', 'status_counter', 'counter'),
+    ('dml_inserts', 'status_counter', 'counter'),
+])
+def test_innodb_metrics_infer_type(name, counter_type, expected):
+    assert exporter.InnodbMetricsCollector.infer_type(name, counter_type) == expected
+
+INNODB_STATUS_5_7 = '''
+=====================================
+2024-03-11 09:41:07 0x7f3c5c1f8700 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 18 seconds
+-----------------
+BACKGROUND THREAD
+-----------------
+srv_master_thread loops: 9 srv_active, 0 srv_shutdown, 7412 srv_idle
+srv_master_thread log flush and writes: 7421
+----------
+SEMAPHORES
+----------
+OS WAIT ARRAY INFO: reservation count 12
+OS WAIT ARRAY INFO: signal count 11
+RW-shared spins 0, rounds 6, OS waits 3
+RW-excl spins 0, rounds 0, OS waits 0
+RW-sx spins 0, rounds 0, OS waits 0
+Spin rounds per wait: 6.00 RW-shared, 0.00 RW-excl, 0.00 RW-sx
+------------------------
+LATEST DETECTED DEADLOCK
+------------------------
+2024-03-11 09:37:52 0x7f3c5c0f4700
+*** (1) TRANSACTION:
+TRANSACTION 5386, ACTIVE 6 sec starting index read
+mysql tables in use 1, locked 1
+LOCK WAIT 2 lock struct(s), heap size 1136, 1 row lock(s)
+MySQL thread id 9, OS thread handle 139759528511232, query id 112 localhost root updating
+UPDATE t SET v = v + 1 WHERE id = 2
+*** (1) WAITING FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 24 page no 3 n bits 72 index PRIMARY of table `replicated_db`.`t` trx id 5386 lock_mode X locks rec but not gap waiting
+*** (2) TRANSACTION:
+TRANSACTION 5385, ACTIVE 11 sec starting index read
+mysql tables in use 1, locked 1
+3 lock struct(s), heap size 1136, 2 row lock(s)
+MySQL thread id 8, OS thread handle 139759528777472, query id 113 localhost root updating
+UPDATE t SET v = v + 1 WHERE id = 1
+*** (2) HOLDS THE LOCK(S):
+RECORD LOCKS space id 24 page no 3 n bits 72 index PRIMARY of table `replicated_db`.`t` trx id 5385 lock_mode X locks rec but not gap
+*** (2) WAITING FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 24 page no 3 n bits 72 index PRIMARY of table `replicated_db`.`t` trx id 5385 lock_mode X locks rec but not gap waiting
+*** WE ROLL BACK TRANSACTION (1)
+------------
+TRANSACTIONS
+------------
+Trx id counter 5392
+Purge done for trx's n:o < 5390 undo n:o < 0 state: running but idle
+History list length 27
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 421234996810592, not started
+0 lock struct(s), heap size 1136, 0 row lock(s)
+--------
+FILE I/O
+--------
+I/O thread 0 state: waiting for completed aio requests (insert buffer thread)
+I/O thread 1 state: waiting for completed aio requests (log thread)
+I/O thread 2 state: waiting for completed aio requests (read thread)
+I/O thread 3 state: waiting for completed aio requests (write thread)
+Pending normal aio reads: [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
+ ibuf aio reads:, log i/o's:, sync i/o's:
+Pending flushes (fsync) log: 1; buffer pool: 2
+412 OS file reads, 187 OS file writes, 61 OS fsyncs
+0.00 reads/s, 0 avg bytes/read, 0.00 writes/s, 0.00 fsyncs/s
+-------------------------------------
+INSERT BUFFER AND ADAPTIVE HASH INDEX
+-------------------------------------
+Ibuf: size 1, free list len 0, seg size 2, 0 merges
+merged operations:
+ insert 0, delete mark 0, delete 0
+discarded operations:
+ insert 0, delete mark 0, delete 0
+Hash table size 34673, node heap has 0 buffer(s)
+0.00 hash searches/s, 0.00 non-hash searches/s
+---
+LOG
+---
+Log sequence number 12979426
+Log flushed up to   12979426
+Pages flushed up to 12979426
+Last checkpoint at  12979417
+0 pending log flushes, 0 pending chkp writes
+33 log i/o's done, 0.00 log i/o's/second
+----------------------
+BUFFER POOL AND MEMORY
+----------------------
+Total large memory allocated 137428992
+Dictionary memory allocated 101299
+Buffer pool size   8191
+Free buffers       7753
+Database pages     438
+Old database pages 0
+Modified db pages  0
+Pending reads      0
+Pending writes: LRU 0, flush list 3, single page 0
+Pages made young 0, not young 0
+0.00 youngs/s, 0.00 non-youngs/s
+Pages read 403, created 35, written 153
+0.00 reads/s, 0.00 creates/s, 0.00 writes/s
+No buffer pool page gets since the last printout
+LRU len: 438, unzip_LRU len: 0
+I/O sum[0]:cur[0], unzip sum[0]:cur[0]
+--------------
+ROW OPERATIONS
+--------------
+0 queries inside InnoDB, 0 queries in queue
+0 read views open inside InnoDB
+Process ID=1, Main thread ID=139759380227840, state: sleeping
+Number of rows inserted 2, updated 8, deleted 0, read 16
+0.00 inserts/s, 0.00 updates/s, 0.00 deletes/s, 0.00 reads/s
+----------------------------
+END OF INNODB MONITOR OUTPUT
+============================
+'''
+
+INNODB_STATUS_8_0 = '''
+=====================================
+2024-03-11 09:52:30 139912392681216 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 5 seconds
+-----------------
+BACKGROUND THREAD
+-----------------
+srv_master_thread loops: 1 srv_active, 0 srv_shutdown, 934 srv_idle
+srv_master_thread log flush and writes: 0
+----------
+SEMAPHORES
+----------
+OS WAIT ARRAY INFO: reservation count 4
+--Thread 139912115734272 has waited at buf0flu.cc line 1433 for 0 seconds the semaphore:
+Mutex at 0x55f1c6e3a2a8, Mutex FLUSH_LIST created buf0buf.cc:1460, lock var 1
+OS WAIT ARRAY INFO: signal count 3
+RW-shared spins 0, rounds 0, OS waits 0
+RW-excl spins 0, rounds 0, OS waits 0
+RW-sx spins 0, rounds 0, OS waits 0
+Spin rounds per wait: 0.00 RW-shared, 0.00 RW-excl, 0.00 RW-sx
+------------
+TRANSACTIONS
+------------
+Trx id counter 2074
+Purge done for trx's n:o < 2072 undo n:o < 0 state: running but idle
+History list length 3
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 421387369538776, not started
+0 lock struct(s), heap size 1128, 0 row lock(s)
+--------
+FILE I/O
+--------
+I/O thread 0 state: waiting for completed aio requests (insert buffer thread)
+I/O thread 1 state: waiting for completed aio requests (log thread)
+I/O thread 2 state: waiting for completed aio requests (read thread)
+I/O thread 3 state: waiting for completed aio requests (read thread)
+I/O thread 4 state: waiting for completed aio requests (write thread)
+I/O thread 5 state: waiting for completed aio requests (write thread)
+Pending normal aio reads: [0, 0] , aio writes: [0, 0] ,
+ ibuf aio reads:, log i/o's:
+Pending flushes (fsync) log: 0; buffer pool: 0
+985 OS file reads, 219 OS file writes, 36 OS fsyncs
+0.00 reads/s, 0 avg bytes/read, 0.00 writes/s, 0.00 fsyncs/s
+-------------------------------------
+INSERT BUFFER AND ADAPTIVE HASH INDEX
+-------------------------------------
+Ibuf: size 1, free list len 0, seg size 2, 0 merges
+merged operations:
+ insert 0, delete mark 0, delete 0
+discarded operations:
+ insert 0, delete mark 0, delete 0
+Hash table size 34679, node heap has 0 buffer(s)
+0.00 hash searches/s, 0.00 non-hash searches/s
+---
+LOG
+---
+Log sequence number          19564413
+Log buffer assigned up to    19564413
+Log buffer completed up to   19564413
+Log written up to            19564413
+Log flushed up to            19564413
+Added dirty pages up to      19564413
+Pages flushed up to          19564413
+Last checkpoint at           19562197
+20 log i/o's done, 0.00 log i/o's/second
+----------------------
+BUFFER POOL AND MEMORY
+----------------------
+Total large memory allocated 0
+Dictionary memory allocated 424519
+Buffer pool size   8192
+Free buffers       7138
+Database pages     1050
+Old database pages 407
+Modified db pages  0
+Pending reads      0
+Pending writes: LRU 0, flush list 0, single page 0
+Pages made young 0, not young 0
+0.00 youngs/s, 0.00 non-youngs/s
+Pages read 908, created 142, written 179
+0.00 reads/s, 0.00 creates/s, 0.00 writes/s
+No buffer pool page gets since the last printout
+LRU len: 1050, unzip_LRU len: 0
+I/O sum[0]:cur[0], unzip sum[0]:cur[0]
+--------------
+ROW OPERATIONS
+--------------
+0 queries inside InnoDB, 0 queries in queue
+0 read views open inside InnoDB
+Process ID=1, Main thread ID=139912160016128 , state=sleeping
+Number of rows inserted 0, updated 0, deleted 0, read 0
+0.00 inserts/s, 0.00 updates/s, 0.00 deletes/s, 0.00 reads/s
+Number of system rows inserted 0, updated 315, deleted 0, read 4724
+0.00 inserts/s, 0.00 updates/s, 0.00 deletes/s, 0.00 reads/s
+----------------------------
+END OF INNODB MONITOR OUTPUT
+============================
+'''
+
+INNODB_STATUS_8_4 = '''
+=====================================
+2024-11-05 14:03:19 140201337714240 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 9 seconds
+-----------------
+BACKGROUND THREAD
+-----------------
+srv_master_thread loops: 4 srv_active, 0 srv_shutdown, 1566 srv_idle
+srv_master_thread log flush and writes: 0
+----------
+SEMAPHORES
+----------
+OS WAIT ARRAY INFO: reservation count 0
+OS WAIT ARRAY INFO: signal count 0
+RW-shared spins 0, rounds 0, OS waits 0
+RW-excl spins 0, rounds 0, OS waits 0
+RW-sx spins 0, rounds 0, OS waits 0
+Spin rounds per wait: 0.00 RW-shared, 0.00 RW-excl, 0.00 RW-sx
+------------
+TRANSACTIONS
+------------
+Trx id counter 2331
+Purge done for trx's n:o < 2329 undo n:o < 0 state: running but idle
+History list length 0
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 422061395216344, not started
+0 lock struct(s), heap size 1128, 0 row lock(s)
+--------
+FILE I/O
+--------
+I/O thread 0 state: waiting for completed aio requests (insert buffer thread)
+I/O thread 1 state: waiting for completed aio requests (read thread)
+I/O thread 2 state: waiting for completed aio requests (read thread)
+I/O thread 3 state: waiting for completed aio requests (read thread)
+I/O thread 4 state: waiting for completed aio requests (read thread)
+I/O thread 5 state: waiting for completed aio requests (write thread)
+I/O thread 6 state: waiting for completed aio requests (write thread)
+I/O thread 7 state: waiting for completed aio requests (write thread)
+I/O thread 8 state: waiting for completed aio requests (write thread)
+Pending normal aio reads: [0, 0, 0, 0] , aio writes: [0, 0, 0, 0] ,
+ ibuf aio reads:
+Pending flushes (fsync): 0
+1014 OS file reads, 253 OS file writes, 83 OS fsyncs
+0.00 reads/s, 0 avg bytes/read, 0.00 writes/s, 0.00 fsyncs/s
+-------------------------------------
+INSERT BUFFER AND ADAPTIVE HASH INDEX
+-------------------------------------
+Ibuf: size 1, free list len 0, seg size 2, 0 merges
+merged operations:
+ insert 0, delete mark 0, delete 0
+discarded operations:
+ insert 0, delete mark 0, delete 0
+Hash table size 34679, node heap has 0 buffer(s)
+0.00 hash searches/s, 0.00 non-hash searches/s
+---
+LOG
+---
+Log sequence number          21104387
+Log buffer assigned up to    21104387
+Log buffer completed up to   21104387
+Log written up to            21104387
+Log flushed up to            21104387
+Added dirty pages up to      21104387
+Pages flushed up to          21104387
+Last checkpoint at           21104387
+Log minimum file id is       6
+Log maximum file id is       6
+41 log i/o's done, 0.00 log i/o's/second
+----------------------
+BUFFER POOL AND MEMORY
+----------------------
+Total large memory allocated 0
+Dictionary memory allocated 498843
+Buffer pool size   8192
+Free buffers       6979
+Database pages     1209
+Old database pages 426
+Modified db pages  0
+Pending reads      0
+Pending writes: LRU 0, flush list 0
+Pages made young 0, not young 0
+0.00 youngs/s, 0.00 non-youngs/s
+Pages read 1067, created 142, written 196
+0.00 reads/s, 0.00 creates/s, 0.00 writes/s
+No buffer pool page gets since the last printout
+LRU len: 1209, unzip_LRU len: 0
+I/O sum[0]:cur[0], unzip sum[0]:cur[0]
+--------------
+ROW OPERATIONS
+--------------
+0 queries inside InnoDB, 0 queries in queue
+0 read views open inside InnoDB
+Process ID=1, Main thread ID=140200999470784 , state=sleeping
+Number of rows inserted 0, updated 0, deleted 0, read 0
+0.00 inserts/s, 0.00 updates/s, 0.00 deletes/s, 0.00 reads/s
+Number of system rows inserted 0, updated 317, deleted 0, read 5046
+0.00 inserts/s, 0.00 updates/s, 0.00 deletes/s, 0.00 reads/s
+----------------------------
+END OF INNODB MONITOR OUTPUT
+============================
+'''
+
+@pytest.mark.parametrize('text, expected, absent', [
+    (INNODB_STATUS_5_7,
+     {'history_list_length': 27, 'log_sequence_number': 12979426, 'last_checkpoint': 12979417, 'pending_log_flushes': 0,
+      'pending_fsync_log': 1, 'pending_fsync_buffer_pool': 2, 'pending_writes_lru': 0, 'pending_writes_flush_list': 3,
+      'pending_writes_single_page': 0, 'os_wait_reservations': 12},
+     ['pending_fsync_all', 'semaphore_waits']),
+    (INNODB_STATUS_8_0,
+     {'history_list_length': 3, 'log_sequence_number': 19564413, 'last_checkpoint': 19562197, 'pending_fsync_log': 0,
+      'pending_fsync_buffer_pool': 0, 'pending_writes_flush_list': 0, 'pending_writes_single_page': 0,
+      'os_wait_reservations': 4, 'semaphore_waits': 1},
+     ['pending_log_flushes', 'pending_fsync_all', 'deadlock_hash']),
+    (INNODB_STATUS_8_4,
+     {'history_list_length': 0, 'log_sequence_number': 21104387, 'last_checkpoint': 21104387, 'pending_fsync_all': 0,
+      'pending_writes_lru': 0, 'pending_writes_flush_list': 0, 'os_wait_reservations': 0},
+     ['pending_log_flushes', 'pending_fsync_log', 'pending_fsync_buffer_pool', 'pending_writes_single_page']),
+], ids=['5.7', '8.0', '8.4'])
+def test_parse_innodb_status(text, expected, absent):
+    parsed = exporter.parse_innodb_status(text)
+    assert {key: parsed.get(key) for key in expected} == expected
+    assert not any(key in parsed for key in absent)
+
+def test_parse_innodb_status_deadlock():
+    parsed = exporter.parse_innodb_status(INNODB_STATUS_5_7)
+    assert parsed['deadlock_lines'][0] == '2024-03-11 09:37:52 0x7f3c5c0f4700'
+    assert parsed['deadlock_lines'][-1] == '*** WE ROLL BACK TRANSACTION (1)'
+    assert parsed['deadlock_hash'] == exporter.parse_innodb_status(INNODB_STATUS_5_7)['deadlock_hash']
+
+def test_parse_innodb_status_unexpected_lines():
+    # Lines in an unknown format lose only their own values
+    text = INNODB_STATUS_5_7.replace('Pending flushes (fsync) log: 1; buffer pool: 2', 'Pending flushes (fsync) buffer pool: 2')
+    text = text.replace('Pending writes: LRU 0, flush list 3, single page 0', 'Pending writes: flush list 3')
+    text = text.replace('History list length 27', 'History list length')
+    parsed = exporter.parse_innodb_status(text)
+    assert parsed['pending_fsync_buffer_pool'] == 2
+    assert parsed['pending_writes_flush_list'] == 3
+    assert not any(key in parsed for key in ('pending_fsync_log', 'pending_writes_lru', 'history_list_length'))
+    assert parsed['last_checkpoint'] == 12979417
+    assert 'deadlock_hash' in parsed
+
+def test_config_reload_resets_status_types(tmp_path, monkeypatch):
+    monkeypatch.setattr(exporter, 'MYSQL_SERVERS', exporter.MYSQL_SERVERS)
+    monkeypatch.setattr(exporter, 'GLOBAL_STATUS_DENYLIST', exporter.GLOBAL_STATUS_DENYLIST)
+    collector = exporter.GlobalStatusCollector()
+    monkeypatch.setattr(exporter, 'CONFIG_TYPE_CACHES', [(collector, {'GLOBAL_STATUS_DENYLIST'})])
+    status = {'Uptime': '10', 'Status_variable_a': '1', 'Handler_read_key': '5'}
+    collector.update('db', status)
+    assert {family.name for family in collector.collect()} == {'mysql_global_status_uptime', 'mysql_global_status_status_variable_a',
+                                                               'mysql_global_status_handler_read_key'}
+    path = tmp_path / 'mysql_exporter.json'
+    path.write_text(json.dumps({'servers': [], 'settings': {'GLOBAL_STATUS_DENYLIST': ['Status_variable_*', 'Handler_*']}}))
+    assert exporter.ConfigWatcher(str(path)).poll() == []
+    collector.update('db', status)
+    assert {family.name for family in collector.collect()} == {'mysql_global_status_uptime'}
+
+def test_processlist_snapshot_keeps_its_bucket_bounds(monkeypatch):
+    monkeypatch.setattr(exporter, 'PROCESSLIST_AGE_BUCKETS', [1, 10])
+    collector = exporter.ProcesslistCollector()
+    rows = [{'COMMAND': 'Query', 'STATE': 'executing', 'TIME': age, 'TRX_AGE': None} for age in (0, 5, 50)]
+    run_plan(collector.plan('db'), rows)
+    monkeypatch.setattr(exporter, 'PROCESSLIST_AGE_BUCKETS', [0.5, 1, 5, 10, 30])
+    query_ages = list(collector.collect())[-1]
+    buckets = [(sample.labels['le'], sample.value) for sample in query_ages.samples if sample.name.endswith('_bucket')]
+    assert buckets == [('1.0', 1), ('10.0', 2), ('+Inf', 3)]
+
+def test_heartbeat_only_read_on_replicas(monkeypatch):
+    monkeypatch.setattr(exporter, 'HEARTBEAT_ENABLED', True)
+    monkeypatch.setattr(exporter, 'replication_tracker', exporter.ReplicationTracker())
+    collector = exporter.HeartbeatCollector()
+    assert run_plan(collector.plan('standalone')) == []
+    exporter.replication_tracker.replicas.add('replica')
+    assert run_plan(collector.plan('replica'), [{'ts_us': 1}]) == [f"SELECT ts_us FROM {exporter.HEARTBEAT_TABLE} WHERE id = 1;"]
+    assert any(sample.labels.get('instance') == 'replica' for sample in exporter.mysql_heartbeat_lag_seconds.collect()[0].samples)
+    exporter.replication_tracker.replicas.discard('replica')
+    assert run_plan(collector.plan('replica')) == []
+    assert not any(sample.labels.get('instance') == 'replica' for sample in exporter.mysql_heartbeat_lag_seconds.collect()[0].samples)
+
+def instance_samples(metric, instance):
+    return [sample for sample in metric.collect()[0].samples if sample.labels.get('instance') == instance]
+
+def test_system_metrics_absent_while_unknown(tmp_path, monkeypatch):
+    monkeypatch.setattr(exporter, 'find_listening_pid', lambda port: None)
+    server = {'instance': 'system-test', 'host': '127.0.0.1', 'port': 1, 'data_dir': str(tmp_path)}
+    collector = exporter.SystemMetricsCollector(server)
+    collector.set(exporter.mysql_cpu_usage, 12.5)
+    collector.set(exporter.mysql_memory_used, 2 ** 30)
+    collector.collect_once()
+    # mysqld not found: no CPU or memory series instead of zeros
+    assert instance_samples(exporter.mysql_cpu_usage, 'system-test') == []
+    assert instance_samples(exporter.mysql_memory_used, 'system-test') == []
+    assert len(instance_samples(exporter.mysql_disk_usage_percent, 'system-test')) == 1
+
+    def failing_disk_usage(path):
+        raise OSError('I/O error')
+    monkeypatch.setattr(exporter.psutil, 'disk_usage', failing_disk_usage)
+    collector.collect_once()
+    assert instance_samples(exporter.mysql_disk_usage_percent, 'system-test') == []
+    exporter.forget_instance('system-test')
+
+def test_counter_delta_store():
+    store = exporter.CounterDeltaStore()
+    # The first reading advances the counter to the raw value, later ones by the growth
+    assert store.delta('db', 'Questions', 100) == 100
+    assert store.delta('db', 'Questions', 130) == 30
+    assert store.delta('db', 'Questions', 130) == 0
+    # A reading below the previous one (FLUSH STATUS) is a reset
+    assert store.delta('db', 'Questions', 20) == 20
+    assert store.delta('db', 'Questions', 25) == 5
+    # A restart detected from Uptime restarts every counter from its raw value
+    assert store.observe_uptime('db', 5000) is False
+    assert store.observe_uptime('db', 10) is True
+    assert store.delta('db', 'Questions', 40, restarted=True) == 40
+    # Instances have their own baselines
+    assert store.delta('other', 'Questions', 7) == 7
+
+def test_counter_delta_store_reuses_forgotten_slots():
+    store = exporter.CounterDeltaStore()
+    store.delta('old', 'Queries', 10)
+    store.delta('old', 'Questions', 20)
+    store.forget('old')
+    assert store.observe_uptime('old', 1) is False
+    store.delta('new', 'Queries', 5)
+    store.delta('new', 'Questions', 6)
+    assert len(store.values) == 2
+    # A forgotten instance starts over from its raw values
+    assert store.delta('old', 'Queries', 15) == 15
+
+@pytest.mark.parametrize('gtid_set, expected', [
+    ('3e11fa47-71ca-11e1-9e33-c80aa9429562:1-100', 100),
+    ('3e11fa47-71ca-11e1-9e33-c80aa9429562:1-100:205,\n4f22ab58-82db-22f2-af44-d91bb0530673:1-7', 108),
+    ('3e11fa47-71ca-11e1-9e33-c80aa9429562:5', 1),
+    # Tagged GTIDs (MySQL 8.3+)
+    ('3e11fa47-71ca-11e1-9e33-c80aa9429562:1-10:nightly:1-5', 15),
+    ('', 0),
+    (None, 0),
+])
+def test_count_gtid_set(gtid_set, expected):
+    assert exporter.count_gtid_set(gtid_set) == expected
+
+@pytest.mark.parametrize('file_name, expected', [
+    ('master-bin.000042', 42),
+    ('binlog.1000001', 1000001),
+    ('mysql.bin.000007', 7),
+    ('binlog', 0),
+    ('', 0),
+    (None, 0),
+])
+def test_binlog_file_number(file_name, expected):
+    assert exporter.binlog_file_number(file_name) == expected
+
+@pytest.mark.parametrize('blocked_by, expected', [
+    ({}, 0),
+    ({1: [2]}, 1),
+    ({1: [2], 2: [3], 3: [4]}, 3),
+    # Several waiters on one blocker, and one waiter on several blockers
+    ({1: [9], 2: [9], 3: [9]}, 1),
+    ({1: [2, 3], 2: [4], 3: [5], 5: [6]}, 3),
+    # Cycles are cut where they close
+    ({1: [1]}, 1),
+    ({1: [2], 2: [1]}, 2),
+    ({1: [2], 2: [3], 3: [1], 4: [1]}, 4),
+])
+def test_lock_wait_longest_chain(blocked_by, expected):
+    assert exporter.LockWaitCollector.longest_chain(blocked_by) == expected
+
+def test_lock_wait_longest_chain_is_iterative():
+    # Far deeper than the recursion limit
+    blocked_by = {thread: [thread + 1] for thread in range(10000)}
+    assert exporter.LockWaitCollector.longest_chain(blocked_by) == 10000
+
+def config(settings=None, **server):
+    """
+    Returns a one-server configuration file with the given server fields and settings.
+    """
+    server = dict({'instance': 'db1', 'host': 'db1.example.com', 'port': 3306, 'user': 'exporter',
+                   'password': 'secret', 'database': 'mysql'}, **server)
+    result = {'servers': [{key: value for key, value in server.items() if value is not None}]}
+    if settings is not None:
+        result['settings'] = settings
+    return result
+
+def test_parse_config_accepts_valid_file():
+    servers, settings = exporter.parse_config(config({
+        'MYSQL_METRICS_INTERVAL': 2,
+        'COLLECTION_MODE': 'scrape',
+        'TABLE_SIZE_SCHEMAS': ['app_*'],
+        'CIRCUIT_BREAKER_BACKOFF': dict(exporter.CIRCUIT_BREAKER_BACKOFF, network=[1, 60]),
+    }))
+    assert servers == [dict(config()['servers'][0], data_dir='')]
+    assert settings['MYSQL_METRICS_INTERVAL'] == 2
+
+@pytest.mark.parametrize('file, message', [
+    ([], "'servers' list"),
+    ({'servers': {}}, "'servers' list"),
+    (config(host=None), 'missing host'),
+    (config(port='3306'), 'port must be a number'),
+    ({'servers': config()['servers'] * 2}, 'unique'),
+    (config(settings=[]), "'settings' must be an object"),
+    (config({'NO_SUCH_SETTING': 1}), 'unknown setting NO_SUCH_SETTING'),
+    (config({'MYSQL_METRICS_INTERVAL': 'fast'}), 'MYSQL_METRICS_INTERVAL must be a number > 0'),
+    (config({'MYSQL_METRICS_INTERVAL': 0}), 'MYSQL_METRICS_INTERVAL must be a number > 0'),
+    (config({'MYSQL_METRICS_INTERVAL': -1}), 'MYSQL_METRICS_INTERVAL must be a number > 0'),
+    (config({'MYSQL_METRICS_INTERVAL': True}), 'MYSQL_METRICS_INTERVAL must be a number > 0'),
+    (config({'HEARTBEAT_ENABLED': 1}), 'HEARTBEAT_ENABLED must be true or false'),
+    (config({'TABLE_SIZE_SCHEMAS': 'app_*'}), 'TABLE_SIZE_SCHEMAS must be a list'),
+    (config({'TABLE_SIZE_SCHEMAS': [1]}), 'TABLE_SIZE_SCHEMAS[0] must be a string'),
+    (config({'COLLECTION_MODE': 'bogus'}), 'COLLECTION_MODE must be one of'),
+    (config({'COLLECTION_TIERS': {'fast': 1}}), 'COLLECTION_TIERS must have exactly the keys'),
+    (config({'METRIC_GROUP_TIERS': dict(exporter.METRIC_GROUP_TIERS, global_status='turbo')}),
+     'global_status has unknown tier turbo'),
+    (config({'CIRCUIT_BREAKER_BACKOFF': dict(exporter.CIRCUIT_BREAKER_BACKOFF, network=[2])}),
+     "CIRCUIT_BREAKER_BACKOFF['network'] must be a list of 2 values"),
+    (config({'SHARD_INDEX': 2, 'SHARD_COUNT': 2}), 'SHARD_INDEX must be lower than SHARD_COUNT'),
+])
+def test_parse_config_rejects(file, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        exporter.parse_config(file)
+
+class FakeClock:
+    """
+    Stands in for the time module; monotonic() only moves when advanced.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(exporter, 'time', clock)
+    # Always jitter to the full window
+    monkeypatch.setattr(exporter.random, 'uniform', lambda low, high: high)
+    return clock
+
+@pytest.fixture
+def breaker():
+    yield exporter.circuit_breakers.get('test-breaker', 'mysql')
+    exporter.circuit_breakers.forget('test-breaker')
+
+def test_circuit_breaker_transitions(clock, breaker):
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+    breaker.record_failure('network', ConnectionError('refused'))
+    assert breaker.state == breaker.OPEN
+    clock.now += 1.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.failures == 0 and breaker.allow()
+
+def test_circuit_breaker_reopens_after_half_open_failure(clock, breaker):
+    breaker.record_failure('network', ConnectionError('refused'))
+    clock.now += 2
+    assert breaker.allow()
+    breaker.record_failure('network', ConnectionError('refused'))
+    assert breaker.state == breaker.OPEN and breaker.retry_at == clock.now + 4
+    assert not breaker.allow()
+
+def test_circuit_breaker_backoff_growth(clock, breaker):
+    backoffs = []
+    for _ in range(10):
+        breaker.record_failure('network', ConnectionError('refused'))
+        backoffs.append(breaker.retry_at - clock.now)
+    assert backoffs == [2, 4, 8, 16, 32, 64, 128, 256, 300, 300]
+    # A different failure class restarts from its own first window
+    breaker.record_failure('auth', PermissionError('denied'))
+    assert breaker.failures == 1 and breaker.retry_at - clock.now == 60
+    breaker.record_failure('network', ConnectionError('refused'))
+    assert breaker.failures == 1 and breaker.retry_at - clock.now == 2
+
+def test_circuit_breaker_backoff_is_jittered(monkeypatch, clock, breaker):
+    windows = []
+    monkeypatch.setattr(exporter.random, 'uniform', lambda low, high: windows.append((low, high)) or low)
+    breaker.record_failure('network', ConnectionError('refused'))
+    breaker.record_failure('network', ConnectionError('refused'))
+    assert windows == [(1, 2), (2, 4)]
+    assert breaker.retry_at - clock.now == 2
+
+def log_record(message, level=logging.WARNING):
+    return logging.makeLogRecord({'name': 'test', 'levelno': level, 'levelname': logging.getLevelName(level), 'msg': message})
+
+def queued_messages(log_queue):
+    messages = []
+    while not log_queue.empty():
+        messages.append(log_queue.get_nowait().getMessage())
+    return messages
+
+def counter_value(name):
+    return exporter.REGISTRY.get_sample_value(f'{name}_total')
+
+def test_log_handler_suppresses_repeats(clock):
+    log_queue = queue.Queue()
+    handler = exporter.DeduplicatingQueueHandler(log_queue)
+    suppressed = counter_value('mysql_exporter_log_messages_suppressed')
+    handler.emit(log_record('db1 is down'))
+    for _ in range(3):
+        clock.now += 10
+        handler.emit(log_record('db1 is down'))
+    # Same text at another level, and another text, are not repeats
+    handler.emit(log_record('db1 is down', logging.ERROR))
+    handler.emit(log_record('db2 is down'))
+    assert queued_messages(log_queue) == ['db1 is down', 'db1 is down', 'db2 is down']
+    assert counter_value('mysql_exporter_log_messages_suppressed') == suppressed + 3
+
+    clock.now += exporter.LOG_DEDUP_WINDOW - 30
+    handler.flush_expired()
+    assert queued_messages(log_queue) == [f'3 identical messages suppressed in the last {exporter.LOG_DEDUP_WINDOW} s: db1 is down']
+    # Messages that were not repeated expire without a summary
+    clock.now += 30
+    handler.flush_expired()
+    assert queued_messages(log_queue) == [] and handler.seen == {}
+
+def test_log_handler_reports_repeats_when_message_returns(clock):
+    log_queue = queue.Queue()
+    handler = exporter.DeduplicatingQueueHandler(log_queue)
+    handler.emit(log_record('db1 is down'))
+    clock.now += 1
+    handler.emit(log_record('db1 is down'))
+    clock.now += exporter.LOG_DEDUP_WINDOW
+    handler.emit(log_record('db1 is down'))
+    assert queued_messages(log_queue) == [
+        'db1 is down',
+        f'1 identical messages suppressed in the last {exporter.LOG_DEDUP_WINDOW + 1} s: db1 is down',
+        'db1 is down',
+    ]
+
+def test_log_handler_drops_when_queue_full(clock):
+    log_queue = queue.Queue(2)
+    handler = exporter.DeduplicatingQueueHandler(log_queue)
+    dropped = counter_value('mysql_exporter_log_messages_dropped')
+    for number in range(5):
+        handler.emit(log_record(f'message {number}'))
+    assert queued_messages(log_queue) == ['message 0', 'message 1']
+    assert counter_value('mysql_exporter_log_messages_dropped') == dropped + 3